@@ -0,0 +1,191 @@
+import random, sys, time
+import numpy as np
+from flock import Flock
+from spatial import BatchSpatialHash
+from world import World, GRID_CELL_SIZE, BOID_RADIUS, BOID_SIGHT, OBSTACLE_RADIUS, TIME_STEP
+from instrumentation import NULL_STATS
+
+
+class BatchFlock(Flock):
+
+    def __init__(self, world):
+        '''
+        A Flock holding the boids of many independent worlds. The rows of all worlds are stored one world after the
+        other in the usual flock arrays, and worlds tells the world of each row. The force rules are the ones of
+        Flock, but every difference wraps around the edges of the row's own world, and the weights are looked up
+        per world.
+        '''
+        super(BatchFlock, self).__init__(world)
+        self.worlds = np.zeros(0, dtype=np.intp)
+
+    def add_boids(self, positions, velocities, radius, sight, worlds=0):
+        '''
+        Appends a batch of boids to the flock arrays, in the worlds given by worlds.
+        '''
+        indices = super(BatchFlock, self).add_boids(positions, velocities, radius, sight)
+        worlds = np.broadcast_to(np.asarray(worlds, dtype=np.intp), (len(indices),))
+        self.worlds = np.concatenate((self.worlds, worlds))
+        return indices
+
+    def wrap(self, positions, rows=None):
+        worlds = self.worlds if rows is None else self.worlds[rows]
+        np.mod(positions, self.world.sizes[worlds], out=positions)
+
+    def difference(self, a, b, rows=None):
+        worlds = self.worlds if rows is None else self.worlds[rows]
+        return self.world.get_difference(a, b, worlds)
+
+    def get_weights(self, indices):
+        return self.world.get_weights(self.worlds[indices])
+
+    def get_neighbor_pairs(self, indices):
+        return self.world.grid.query_pairs(self.positions, self.worlds, indices, self.sights)
+
+    def get_close_obstacle_pairs(self, indices, points, radii):
+        return self.world.get_close_obstacle_pairs(points, self.worlds[indices], radii)
+
+    def get_close_predator_pairs(self, indices):
+        #Batched worlds have no predators
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+
+class BatchWorld(object):
+
+    def __init__(self, sizes, weights=(0, 0, 0, 10), obstacles=None, seed=None, time_step=TIME_STEP):
+        '''
+        Many small worlds simulated together, for Monte Carlo studies where a loop over World instances would
+        spend most of its time in the interpreter. sizes has one (width, height) row per world. weights is one
+        (cohesion, alignment, separation, avoidance) row per world, or one row for all, on the same scale as
+        World.set_weights. obstacles is a list with the obstacle centers of each world. The boids follow the rules
+        of the Flock, each world wraps around its own edges, and boids only see the boids and obstacles of their
+        own world. One step advances every world with the same array operations. There are no predators.
+        '''
+        self.sizes = np.asarray(sizes, dtype=float).reshape(-1, 2)
+        self.nr_of_worlds = len(self.sizes)
+        self.set_weights(weights)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.rng = np.random.default_rng(seed)
+        self.time_step = time_step
+        self.steps = 0
+        self.stats = NULL_STATS
+        self.grid = BatchSpatialHash(self.sizes, GRID_CELL_SIZE)
+        self.flock = BatchFlock(self)
+
+        obstacles = obstacles if obstacles is not None else [()]*self.nr_of_worlds
+        self.obstacle_positions = np.concatenate([np.asarray(o, dtype=float).reshape(-1, 2) for o in obstacles])
+        self.obstacle_worlds = np.concatenate([np.full(len(o), w, dtype=np.intp) for w, o in enumerate(obstacles)])
+        self.obstacle_radii = np.full(len(self.obstacle_positions), float(OBSTACLE_RADIUS))
+        self.obstacle_grid = BatchSpatialHash(self.sizes, GRID_CELL_SIZE)
+        self.obstacle_grid.rebuild(self.obstacle_positions, self.obstacle_worlds)
+        self.predator_positions = np.zeros((0, 2))
+
+    def populate(self, nr_of_boids, boid_radius=BOID_RADIUS, boid_sight=BOID_SIGHT):
+        '''
+        Adds nr_of_boids boids with random position and velocity to every world, like World.populate.
+        '''
+        worlds = np.repeat(np.arange(self.nr_of_worlds), nr_of_boids)
+        corners = np.floor(self.rng.random((len(worlds), 2))*self.sizes[worlds])
+        velocities = self.rng.uniform(-15, 15, (len(worlds), 2))
+        self.add_boids(corners + boid_radius, velocities, worlds, boid_radius, boid_sight)
+
+    def add_boids(self, positions, velocities, worlds, radius=BOID_RADIUS, sight=BOID_SIGHT):
+        '''
+        Adds boids with the given center positions and velocities to the worlds given by worlds. Boids are kept
+        sorted by world, so get_world_view can give each world its own rows. Positions outside their world are
+        wrapped around, like in World.add_boids.
+        '''
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        positions = np.mod(positions, self.sizes[np.broadcast_to(np.asarray(worlds, dtype=np.intp), len(positions))])
+        self.flock.add_boids(positions, velocities, radius, sight, worlds)
+        order = np.argsort(self.flock.worlds, kind='stable')
+        if np.any(order != np.arange(len(order))):
+            for name in ('positions', 'previous_positions', 'render_positions', 'velocities', 'prev_velocities',
+                         'radii', 'sights', 'ids', 'worlds'):
+                setattr(self.flock, name, getattr(self.flock, name)[order])
+        self.grid.rebuild(self.flock.positions, self.flock.worlds)
+
+    def set_weights(self, weights):
+        '''
+        Sets the (cohesion, alignment, separation, avoidance) weights, one row per world or one row for all.
+        '''
+        self.weights = np.array(np.broadcast_to(np.asarray(weights, dtype=float), (self.nr_of_worlds, 4)))
+
+    def get_weights(self, worlds):
+        '''
+        The separation, cohesion, alignment and avoidance weight of each world in worlds, as columns ready to be
+        multiplied with a force per row. Divided by 100 like World.get_separation_weight.
+        '''
+        w = self.weights[worlds]/100
+        return w[:, 2:3], w[:, 0:1], w[:, 1:2], w[:, 3:4]
+
+    def get_difference(self, a, b, worlds):
+        return self.grid.difference(a, b, worlds)
+
+    def get_close_obstacle_pairs(self, positions, worlds, radii):
+        return self.obstacle_grid.query_points(positions, worlds, radii)
+
+    def get_world_view(self, array):
+        '''
+        Returns a view of a flock array with a leading world dimension, like (worlds, boids, 2) for the positions.
+        Every world must have the same number of boids.
+        '''
+        return array.reshape((self.nr_of_worlds, -1) + array.shape[1:])
+
+    def get_counts(self):
+        return np.bincount(self.flock.worlds, minlength=self.nr_of_worlds)
+
+    def update_velocities(self):
+        with self.stats.phase('grid'):
+            self.grid.rebuild(self.flock.positions, self.flock.worlds)
+        self.flock.update_velocities()
+
+    def step(self, time_passed):
+        '''
+        Advances every world by time_passed, like World.step.
+        '''
+        self.update_velocities()
+        with self.stats.phase('integrate'):
+            self.flock.integrate(time_passed)
+        self.steps += 1
+
+
+def benchmark(nr_of_worlds=200, nr_of_boids=50, size=(400, 300), ticks=20, seed=1):
+    '''
+    Steps the same worlds as one BatchWorld and as a loop over World instances. Returns the ticks per second of
+    all the worlds for both.
+    '''
+    rng = np.random.default_rng(seed)
+    sizes = np.tile(size, (nr_of_worlds, 1))
+    weights = np.column_stack((rng.uniform(0, 50, nr_of_worlds), rng.uniform(0, 50, nr_of_worlds),
+                               rng.uniform(0, 100, nr_of_worlds), np.full(nr_of_worlds, 100.0)))
+    obstacles = [rng.uniform(0, 1, (2, 2))*size for w in range(nr_of_worlds)]
+    batch = BatchWorld(sizes, weights, obstacles, seed=seed)
+    batch.populate(nr_of_boids)
+    worlds = []
+    for w in range(nr_of_worlds):
+        world = World(size[0], size[1], *weights[w], seed=seed)
+        rows = batch.flock.worlds == w
+        world.add_boids(batch.flock.positions[rows], batch.flock.velocities[rows])
+        for pos in obstacles[w]:
+            #Obstacles are placed by their center in World.add_obstacle
+            world.add_obstacle(pos)
+        worlds.append(world)
+
+    start = time.perf_counter()
+    for i in range(ticks):
+        batch.step(TIME_STEP)
+    batch_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(ticks):
+        for world in worlds:
+            world.step(TIME_STEP)
+    loop_time = time.perf_counter() - start
+    return {'batch': ticks/batch_time, 'loop': ticks/loop_time}
+
+
+if __name__ == '__main__':
+    nr_of_worlds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    results = benchmark(nr_of_worlds)
+    print("%d worlds  batch: %.1f ticks/sec  loop over World: %.1f ticks/sec  speedup: %.1fx"
+          % (nr_of_worlds, results['batch'], results['loop'], results['batch']/results['loop']))
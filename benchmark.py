@@ -0,0 +1,243 @@
+import argparse, json, math, platform, random, subprocess, sys, time
+import numpy as np
+from world import World
+from creature import MAX_NEIGHBORS, MAX_BOID_VELOCITY
+
+#Constants
+BOID_COUNTS = (100, 1000, 10000, 50000)
+OBSTACLE_COUNTS = (0, 10, 100, 500)
+PREDATOR_COUNTS = (0, 5, 20, 50)
+SIGHT_RADII = (40.0, 80.0, 160.0)
+#Accuracy thresholds of the approximate cohesion and alignment
+AGGREGATE_THETAS = (0.0, 0.25, 0.5, 1.0)
+QUICK_BOID_COUNTS = (100, 1000)
+
+#Base case, the sweeps vary one parameter at a time around it
+BASE_BOIDS = 1000
+BASE_OBSTACLES = 10
+BASE_PREDATORS = 5
+BASE_SIGHT = 80.0
+#Boids per pixel, the world size is scaled with the number of boids
+DENSITY = 1000/(1200*600)
+
+WEIGHTS = (20, 20, 50, 100)
+TIME_STEP = 33.0
+SAMPLE_SIZE = 100
+MIN_TIME = 0.2
+
+
+def time_call(f, min_time=MIN_TIME, repeat=3):
+    '''
+    Calls f until at least min_time seconds have passed, repeat times, and returns the best time per call in
+    seconds.
+    '''
+    best = float("inf")
+    for i in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            f()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed/calls)
+    return best
+
+
+def create_world(boids, obstacles, predators, sight, seed=1):
+    '''
+    Creates a seeded world for a benchmark case. The world is made large enough to keep the density of boids
+    constant.
+    '''
+    random.seed(seed)
+    width = int(math.sqrt(2*boids/DENSITY))
+    height = width//2
+    world = World(width, height, *WEIGHTS, seed=seed)
+    world.populate(boids, boid_sight=sight)
+    for i in range(obstacles):
+        world.add_obstacle((world.random.randrange(width), world.random.randrange(height)))
+    for i in range(predators):
+        world.add_predator((world.random.randrange(width), world.random.randrange(height)))
+    #A few ticks lets the flock form, so the neighborhoods look like a running simulation
+    for i in range(3):
+        world.step(TIME_STEP)
+    world.grid.rebuild(world.flock.positions)
+    world.update_obstacle_index()
+    world.update_predator_index()
+    return world
+
+
+def per_object(f, creatures):
+    '''
+    Returns a function that calls f once for every creature in creatures, and the number of calls it makes.
+    '''
+    def run():
+        for creature in creatures:
+            f(creature)
+    return run, max(1, len(creatures))
+
+
+def get_exact_sums(flock, indices):
+    '''
+    The number of boids in sight of each boid, the sum of the offsets to them and the sum of their velocities,
+    from every neighbor pair. The reference the aggregates are measured against.
+    '''
+    n = len(flock)
+    i, j = flock.get_neighbor_pairs(indices)
+    offsets = flock.difference(flock.positions[j], flock.positions[i], i)
+    return (np.bincount(i, minlength=n).astype(float), flock.group_sum(i, offsets, n),
+            flock.group_sum(i, flock.prev_velocities[j], n))
+
+
+def get_aggregate_sums(flock, indices, theta):
+    flock.update_aggregates()
+    return flock.aggregates.query_sums(flock.positions[indices], flock.sights[indices], theta, indices)
+
+
+def get_aggregate_errors(flock, indices, theta):
+    '''
+    Mean errors of the aggregates with accuracy threshold theta against the exact sums, over the boids with any
+    boid in sight: the relative error of the count, the error of the mean offset used by cohesion as a fraction
+    of the sight radius, and the error of the mean velocity used by alignment as a fraction of MAX_BOID_VELOCITY.
+    '''
+    count, offsets, velocities = get_exact_sums(flock, indices)
+    approx_count, approx_offsets, approx_velocities = get_aggregate_sums(flock, indices, theta)
+    seen = count > 0
+    count, offsets, velocities = count[seen], offsets[seen], velocities[seen]
+    approx_count = np.maximum(approx_count[seen], 1)[:, None]
+    cohesion = np.hypot(*(approx_offsets[seen]/approx_count - offsets/count[:, None]).T)/flock.sights[seen]
+    alignment = np.hypot(*(approx_velocities[seen]/approx_count - velocities/count[:, None]).T)/MAX_BOID_VELOCITY
+    return {'count': float(np.mean(np.abs(approx_count[:, 0] - count)/count)) if len(count) else 0.0,
+            'cohesion': float(np.mean(cohesion)) if len(count) else 0.0,
+            'alignment': float(np.mean(alignment)) if len(count) else 0.0}
+
+
+def run_case(boids, obstacles, predators, sight, min_time=MIN_TIME):
+    '''
+    Times the neighbor queries, the force calculations and a full tick for one world configuration. Per object
+    operations are timed on a sample of creatures and reported per call. All timings are in seconds.
+    '''
+    world = create_world(boids, obstacles, predators, sight)
+    flock = world.flock
+    positions = flock.positions
+    indices = np.arange(len(flock))
+    sample = random.sample(world.boid_list, min(SAMPLE_SIZE, len(world.boid_list)))
+    neighborhoods = {b: world.get_close_neighbors(b, True) for b in sample}
+    close_obstacles = {b: world.get_close_obstacles(b) for b in sample}
+    close_predators = {b: world.get_close_predators(b) for b in sample}
+    i, j = flock.get_neighbor_pairs(indices)
+    pruned_i, pruned_j = flock.prune_pairs(i, j, MAX_NEIGHBORS, len(flock))
+
+    timings = {}
+
+    def add(name, f, calls=1):
+        timings[name] = time_call(f, min_time)/calls
+
+    #Grid bookkeeping and neighbor queries
+    add('grid_rebuild', lambda: world.grid.rebuild(positions))
+    add('grid_query_radius', *per_object(lambda b: world.grid.query_radius(b.pos, b.sight), sample))
+    add('grid_query_pairs', lambda: flock.get_neighbor_pairs(indices))
+    add('get_close_neighbors', *per_object(lambda b: world.get_close_neighbors(b, True), sample))
+    add('get_close_obstacles', *per_object(world.get_close_obstacles, sample))
+    add('get_close_predators', *per_object(world.get_close_predators, sample))
+    add('get_close_obstacle_pairs', lambda: world.get_close_obstacle_pairs(positions, flock.sights))
+    add('get_close_predator_pairs', lambda: world.get_close_predator_pairs(positions, flock.sights))
+
+    #Per object force rules
+    add('calc_separation_force', *per_object(lambda b: b.calc_separation_force(neighborhoods[b]), sample))
+    add('calc_cohesion_force', *per_object(lambda b: b.calc_cohesion_force(neighborhoods[b]), sample))
+    add('calc_alignment_force', *per_object(lambda b: b.calc_alignment_force(neighborhoods[b]), sample))
+    add('calc_obstacle_force', *per_object(lambda b: b.calc_obstacle_force(close_obstacles[b]), sample))
+    add('calc_predator_separation_force',
+        *per_object(lambda b: b.calc_separation_force(close_predators[b]), sample))
+
+    #Vectorized force rules for the whole flock
+    add('flock_prune_pairs', lambda: flock.prune_pairs(i, j, MAX_NEIGHBORS, len(flock)))
+    #The two neighbor modes from positions to the pairs used by the forces
+    add('flock_random_neighbors', lambda: flock.prune_pairs(*flock.get_neighbor_pairs(indices), MAX_NEIGHBORS,
+                                                            len(flock)))
+    add('flock_nearest_neighbors', lambda: flock.get_nearest_pairs(indices, MAX_NEIGHBORS))
+    add('flock_flocking_force', lambda: flock.calc_flocking_force(indices, pruned_i, pruned_j))
+    add('flock_obstacle_force', lambda: flock.calc_obstacle_force(indices))
+    add('flock_predator_force', lambda: flock.calc_predator_force(indices))
+    #Sums for cohesion and alignment over everything in sight, exact from the pairs or from the aggregates
+    add('flock_exact_sums', lambda: get_exact_sums(flock, indices))
+    errors = {}
+    for theta in AGGREGATE_THETAS:
+        add('flock_aggregate_sums_%g' % theta, lambda: get_aggregate_sums(flock, indices, theta))
+        errors['%g' % theta] = get_aggregate_errors(flock, indices, theta)
+
+    add('tick', lambda: world.step(TIME_STEP))
+    world.close()
+    return {'case': {'boids': boids, 'obstacles': obstacles, 'predators': predators, 'sight': sight,
+                     'size': list(world.get_size()), 'neighbor_pairs': int(len(i))},
+            'timings': timings, 'aggregate_errors': errors}
+
+
+def get_cases(quick=False):
+    '''
+    The benchmark cases. Each sweep varies one parameter and keeps the others at the base case. Duplicates of the
+    base case are removed.
+    '''
+    boid_counts = QUICK_BOID_COUNTS if quick else BOID_COUNTS
+    obstacle_counts = OBSTACLE_COUNTS[:2] if quick else OBSTACLE_COUNTS
+    predator_counts = PREDATOR_COUNTS[:2] if quick else PREDATOR_COUNTS
+    sight_radii = SIGHT_RADII[1:2] if quick else SIGHT_RADII
+    cases = []
+    for boids in boid_counts:
+        cases.append((boids, BASE_OBSTACLES, BASE_PREDATORS, BASE_SIGHT))
+    for obstacles in obstacle_counts:
+        cases.append((BASE_BOIDS, obstacles, BASE_PREDATORS, BASE_SIGHT))
+    for predators in predator_counts:
+        cases.append((BASE_BOIDS, BASE_OBSTACLES, predators, BASE_SIGHT))
+    for sight in sight_radii:
+        cases.append((BASE_BOIDS, BASE_OBSTACLES, BASE_PREDATORS, sight))
+    unique = []
+    for case in cases:
+        if case not in unique:
+            unique.append(case)
+    return unique
+
+
+def get_version():
+    '''
+    The git commit of the benchmarked code, if available.
+    '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(quick=False, min_time=MIN_TIME, log=None):
+    '''
+    Runs every benchmark case and returns the results, together with information about the machine and the
+    version of the code, as a dictionary ready to be written as JSON.
+    '''
+    results = []
+    for boids, obstacles, predators, sight in get_cases(quick):
+        if log:
+            log("boids: %d  obstacles: %d  predators: %d  sight: %.0f" % (boids, obstacles, predators, sight))
+        results.append(run_case(boids, obstacles, predators, sight, min_time))
+        if log:
+            log("  tick: %.2f ms" % (results[-1]['timings']['tick']*1000))
+    return {'meta': {'version': get_version(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': platform.python_version(), 'numpy': np.__version__,
+                     'machine': platform.machine(), 'units': 'seconds per call'},
+            'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark neighbor queries, forces and ticks without a display.')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write the results to')
+    parser.add_argument('--quick', action='store_true', help='only run a small subset of the cases')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='minimum time spent timing each call')
+    args = parser.parse_args(argv)
+    report = run_benchmarks(args.quick, args.min_time, log=lambda line: print(line, file=sys.stderr))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
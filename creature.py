@@ -1,39 +1,44 @@
 from pygame.sprite import Sprite
-import pygame, random
+import pygame, math
 import numpy as np
+from rendering import atlas, RED, GREEN, ORANGE
 
 #Constants
 MAX_PRED_VELOCITY = 0.2
 MAX_BOID_VELOCITY = 0.15
 ZERO_ARRAY = np.array([0.0, 0.0])
 MAX_NEIGHBORS = 10
-RED = (255,0,60)
-GREEN = (136,193,0)
-ORANGE = (255,138,0)
+#How a neighborhood larger than MAX_NEIGHBORS is reduced, a random sample or the nearest neighbors
+RANDOM_NEIGHBORS = 'random'
+NEAREST_NEIGHBORS = 'nearest'
+NEIGHBOR_MODES = (RANDOM_NEIGHBORS, NEAREST_NEIGHBORS)
 
-#Lookup dictionary for distances to reduce cost of calc separation force
-distance_lookup = {}
-
-class Thing(Sprite):
+class Thing(object):
+    __slots__ = ()
     id_counter = 0
 
     def __init__(self,world, y, x, width, height):
         '''
-        Thing class is a subclass of pygames sprite. Also the superclass of boid, predator and obstacle. This class
-        contain position, and the Sprite image.
+        Thing class is the superclass of boid, predator and obstacle. Obstacles and predators are also pygame sprites,
+        and this constructor sets up their integer id, position and Sprite image. Boids are slotted views of the
+        world's flock arrays instead, and do not use it.
         '''
         super().__init__()
-        self.thing_id = str(Thing.id_counter)
+        self.thing_id = Thing.id_counter
         Thing.id_counter += 1
         self.world = world
-        self.image = pygame.Surface((width, height))
-        self.image.set_colorkey((0,0,0))
+        self.image = self.create_image(width, height)
         self.rect = self.image.get_rect()
         self.rect.x = float(x)
         self.rect.y = float(y)
         self.pos = np.array([float(x)+width/2,float(y)+height/2])
 
-    def update(self, time_passed):
+    def create_image(self, width, height):
+        image = pygame.Surface((width, height))
+        image.set_colorkey((0,0,0))
+        return image
+
+    def update(self, alpha=1.0):
        pass
 
     def update_velocity(self):
@@ -49,21 +54,28 @@ class Thing(Sprite):
         '''
         When there are to many elements in a list, this method returns a random sample of it.
         A reasonable assumption when there are to many boids in the neighborhood for example. The boid
-        will only adjust itself according to a max number of boids it can keep track of at any time.
+        will only adjust itself according to a max number of boids it can keep track of at any time. The sample is
+        drawn from the world's seeded generator. If the world uses nearest neighbors, the k closest elements are
+        returned instead.
         :param elements: A list that should be pruned
         :param elements: threshold for pruning
         :return: A sample of k elements taken with no replacement
         '''
         if len(elements) > k:
-            return random.sample(elements, k)
+            self.world.stats.count('neighbors_pruned', len(elements) - k)
+            if self.world.neighbor_mode == NEAREST_NEIGHBORS:
+                diff = self.world.get_difference(np.array([e.pos for e in elements]), self.pos)
+                nearest = np.argsort(np.hypot(diff[:, 0], diff[:, 1]), kind='stable')[:k]
+                return [elements[n] for n in nearest]
+            return self.world.random.sample(elements, k)
         return elements
 
     def __repr__(self):
-        return 'id: ' + str(self.thing_id) + ' x: ' + str(self.rect.x) + ' y: ' + str(self.rect.y)
+        return 'id: ' + str(self.thing_id) + ' x: ' + str(self.pos[0]) + ' y: ' + str(self.pos[1])
 
 
 
-class Obstacle(Thing):
+class Obstacle(Thing, Sprite):
     def __init__(self, world, y, x, radius):
         '''
         Obstacle is a subclass of thing and contain a draw method, and an addition radius for the obstacle.
@@ -83,6 +95,8 @@ class Obstacle(Thing):
 
 
 class Creature(Thing):
+    __slots__ = ()
+
     def __init__(self,world, y, x, velocity, radius, sight):
         '''
         The Creature class is a common class for all creature's that can move. The class inherit from Thing, and include
@@ -93,15 +107,25 @@ class Creature(Thing):
         self.prev_velocity = velocity
 
         self.sight = sight
+        self.heading_index = -1
         super(Creature, self).__init__(world, y, x, radius*2, radius*2)
 
+    def create_image(self, width, height):
+        '''
+        Creatures are drawn with the shared images of the sprite atlas, so no image of their own is needed.
+        '''
+        return atlas.get_image(self.color, self.radius, None)
+
     def draw_creature(self):
         '''
-        Update the Sprite image, by drawing a filled circle and a line showing the direction the creature is heading.
+        Update the Sprite image to a filled circle and a line showing the direction the creature is heading. The
+        images are pre-rendered by the sprite atlas at quantized headings, so the image is only swapped when the
+        heading has changed enough to matter.
         '''
-        self.image.fill((0,0,0))
-        pygame.draw.ellipse(self.image, self.color, [0, 0, self.radius*2, self.radius*2])
-        pygame.draw.line( self.image, (1,1,1), (self.radius,self.radius), self.get_orientation(), 2)
+        heading_index = atlas.get_heading_index(self.velocity)
+        if heading_index != self.heading_index:
+            self.heading_index = heading_index
+            self.image = atlas.get_image(self.color, self.radius, heading_index)
 
     def set_new_pos(self, new_pos):
         '''
@@ -119,34 +143,46 @@ class Creature(Thing):
     def calc_repel_force(self, obstacles):
         '''
         Repel force creates a force designed to avoid obstacles in the boids field of view. To ensure that the motion is
-        smooth a look ahead vector is used to check intersecting obstacles. If there is a threat in front, the same vector
+        smooth a look ahead vector is used to check intersecting obstacles, every obstacle the vector passes through or
+        overlapping the creature is a threat. If there is a threat in front, the same vector
         and the obstacles position is used to create a new vector scaled by the force's manitude. If the threat is close
         the force will have a bigger influence on the creature's velocity. A create will respond only to the closest threat
         at each velocity update.
         '''
         norm_base = self.prev_velocity/np.linalg.norm(self.prev_velocity)
         ahead = self.pos + norm_base * self.sight
-        ahead2 = (norm_base * self.sight *0.5) + self.pos
         threat = None
         largest_distance = float("inf")
         for obstacle in obstacles:
-            diff = self.pos - obstacle.pos
+            diff = self.world.get_difference(self.pos, obstacle.pos)
             distance = np.linalg.norm(diff)
-            if self.line_intersect_sphere(ahead, ahead2, obstacle) or distance < obstacle.radius + self.radius:
+            if self.line_intersect_sphere(self.pos, ahead, obstacle) or distance < obstacle.radius + self.radius:
                 if largest_distance > distance:
                     threat = obstacle
                     largest_distance = distance
         if threat:
-            force = ahead - threat.pos
+            force = self.world.get_difference(ahead, threat.pos)
             magnitude = (np.linalg.norm(force))
             return force/magnitude
         else:
             return ZERO_ARRAY
 
     def line_intersect_sphere(self, v1, v2, o1):
-        return np.linalg.norm(v1-o1.pos) <= o1.radius or np.linalg.norm(v2-o1.pos) <= o1.radius
+        '''
+        True if the line segment from v1 to v2 passes through obstacle o1. The center is projected onto the segment,
+        clamped to its ends, to find the point of the segment closest to it.
+        '''
+        segment = self.world.get_difference(v2, v1)
+        center = self.world.get_difference(o1.pos, v1)
+        length2 = np.dot(segment, segment)
+        t = min(max(np.dot(center, segment)/length2, 0.0), 1.0) if length2 > 0 else 0.0
+        miss = center - t*segment
+        return np.dot(miss, miss) <= o1.radius**2
 
-    def update(self, time_passed):
+    def update(self, alpha=1.0):
+        pass
+
+    def move(self, time_passed):
         pass
 
     def get_orientation(self):
@@ -163,16 +199,10 @@ class Creature(Thing):
 
     def get_distance(self, diff):
         '''
-        A small enhancement of separation force calculations. The np.linalg.norm operation is quite expensive, and since
-        there are a finite amount of integer distance vectors, all scalar distance calculations are put in a dictionary.
+        Scalar length of a diff vector. This used to be memoized in a dictionary keyed by the truncated offset, but
+        math.hypot is about three times faster than any lookup (see distance.benchmark), and exact.
         '''
-        aprox_diff = str(int(diff[0])) + " " + str(int(diff[1]))
-        if aprox_diff in distance_lookup:
-            return distance_lookup[aprox_diff]
-        else:
-            distance = np.linalg.norm(diff)
-            distance_lookup[aprox_diff] = distance
-            return distance
+        return math.hypot(diff[0], diff[1])
 
     def calc_separation_force(self, n):
         '''
@@ -184,7 +214,7 @@ class Creature(Thing):
         if len(n) > 0:
             force = ZERO_ARRAY
             for b in n:
-                diff = self.pos - b.pos
+                diff = self.world.get_difference(self.pos, b.pos)
                 distance = self.get_distance(diff)
                 force = force + diff/distance #The force contribution of each individual boids is inverse of the distance
             force = force/len(n)
@@ -194,16 +224,17 @@ class Creature(Thing):
     def calc_cohesion_force(self, n):
         '''
         The calculated cohesion force encourage closeness between the creature and it's neighbors. THe average position
-        of the neighborhood is found and a vector pointing towards the center is returned by the method. The force can
+        of the neighborhood is found and a vector pointing towards the center is returned by the method. The average is
+        taken over the offsets to the neighbors, so neighbors across the wrapping edges are handled. The force can
         be added to the creature's velocity and will move the creature towards the percieved center by 1% each time
         the velocity is updated.
         '''
         if len(n) > 0:
-            avg_pos = ZERO_ARRAY
+            avg_offset = ZERO_ARRAY
             for b in n:
-                avg_pos = avg_pos + b.pos
-            avg_pos = avg_pos/len(n)
-            force = (avg_pos - self.pos)/100 #Moves boid towards perceived center by 1% each time
+                avg_offset = avg_offset + self.world.get_difference(b.pos, self.pos)
+            avg_offset = avg_offset/len(n)
+            force = avg_offset/100 #Moves boid towards perceived center by 1% each time
             return force
         return ZERO_ARRAY
 
@@ -231,21 +262,59 @@ class Creature(Thing):
 class Boid(Creature):
     '''
     Specialization of Creature class. Define how boids should move and relate to other Obstacles and Creatures.
+    The state of a boid is stored in the world's flock arrays, the boid itself is only a slotted record of the world
+    and its row, used for the per object rules. Boids are not sprites, the camera draws them straight from the flock
+    arrays with the shared images of the sprite atlas.
     '''
-    def __init__(self, world, y, x, radius, velocity, sight):
-        #Move velocity up to creature, and get_orientation
-        self.color = GREEN
-        super(Boid, self).__init__(world, y, x, velocity, radius, sight)
-        self.draw_creature()
+    __slots__ = ('world', 'index')
+    color = GREEN
+
+    def __init__(self, world, index):
+        self.world = world
+        self.index = index
 
-    def update(self, time_passed):
+    @staticmethod
+    def create_views(world, indices):
         '''
-        On each update a new position is calculated based on time_passed since last update, the velocity and the
-        position of the boid. To ensure wrap around modulo is used. Then the creature is redrawn. This is necessary
-        since the direction of the boid might have changed, and need to be updated.
+        Creates the boids for a batch of rows in the world's flock arrays.
         '''
-        self.set_new_pos((self.pos + (self.velocity*time_passed)) % np.array(self.world.get_size()))
-        self.draw_creature()
+        return [Boid(world, index) for index in np.asarray(indices, dtype=np.intp).tolist()]
+
+    @property
+    def thing_id(self):
+        return int(self.world.flock.ids[self.index])
+
+    @property
+    def radius(self):
+        return float(self.world.flock.radii[self.index])
+
+    @property
+    def sight(self):
+        return float(self.world.flock.sights[self.index])
+
+    @property
+    def pos(self):
+        return self.world.flock.positions[self.index].copy()
+
+    @pos.setter
+    def pos(self, value):
+        self.world.flock.positions[self.index] = value
+
+    @property
+    def velocity(self):
+        return self.world.flock.velocities[self.index].copy()
+
+    @velocity.setter
+    def velocity(self, value):
+        self.world.flock.velocities[self.index] = value
+
+    @property
+    def prev_velocity(self):
+        return self.world.flock.prev_velocities[self.index].copy()
+
+    @prev_velocity.setter
+    def prev_velocity(self, value):
+        self.world.flock.prev_velocities[self.index] = value
 
     def update_velocity(self):
         '''
@@ -272,14 +341,7 @@ class Boid(Creature):
         align = self.world.get_alignment_weight() * self.calc_alignment_force(neighbors)
         return sep + align + coh
 
-    def notify_of_position_change(self, old_pos, new_pos):
-        '''
-        Method overridden from the Creature class. The world needs to do some bookkeeping on the where each boid
-        is positioned in the world, to more efficiently calculate the neigborhoods required by each boid.
-        '''
-        self.world.set_new_element_position(old_pos-self.radius, new_pos-self.radius, self)
-
-class Predator(Creature):
+class Predator(Creature, Sprite):
 
     SEP_WEIGHT = 0.05
     COH_WEIGHT = 0.50
@@ -292,38 +354,58 @@ class Predator(Creature):
         '''
         self.color = RED
         super(Predator, self).__init__(world, y, x, velocity, radius, sight)
+        self.previous_pos = self.pos
         self.draw_creature()
 
-    def update(self, time_passed):
+    def move(self, time_passed):
         '''
-        At each update a new position for the predator is created by the last position, time passed in between updates
-        and the current velocity of the predator. The predator also has to be redrawn since the direction it's heading
-        might have changed, and the direction line must be updated.
+        A new position for the predator is created by the last position, time passed in between updates
+        and the current velocity of the predator.
         '''
+        self.previous_pos = self.pos
         self.set_new_pos((self.pos + self.velocity*time_passed) % np.array(self.world.get_size()))
+
+    def update(self, alpha=1.0):
+        '''
+        The predator is drawn at its position interpolated alpha of the way from the previous step, and has to be
+        redrawn since the direction it's heading might have changed, and the direction line must be updated.
+        '''
+        pos = (self.previous_pos + alpha*self.world.get_difference(self.pos, self.previous_pos)) \
+            % np.array(self.world.get_size())
+        self.rect.x = pos[0]-self.radius
+        self.rect.y = pos[1]-self.radius
         self.draw_creature()
 
-    def calc_chase_force(self, neighbors):
+    def calc_chase_force(self, neighbors, aggregate=None):
         '''
         The predators chasing behavior is very similar to the boids flocking behavior method. The share the same rules,
         except the rules cant by dynamically changed. The result of these three rules is that the predator is attracted
         to big clusters of boids, and therefore chase boids. The boids on the other hand try to create separation between
-        the predator and itself.
+        the predator and itself. If aggregate is given, the (count, offset sum, velocity sum) of all the boids in sight
+        from World.get_predator_aggregates, cohesion and alignment are taken from it instead of the neighbors.
         '''
         sep = self.SEP_WEIGHT * self.calc_separation_force(neighbors)
-        coh = self.COH_WEIGHT * self.calc_cohesion_force(neighbors)
-        align = self.ALIGN_WEIGHT * self.calc_alignment_force(neighbors)
+        if aggregate is None:
+            coh = self.COH_WEIGHT * self.calc_cohesion_force(neighbors)
+            align = self.ALIGN_WEIGHT * self.calc_alignment_force(neighbors)
+            return sep + align + coh
+        count, offset_sum, velocity_sum = aggregate
+        if count == 0:
+            return sep
+        coh = self.COH_WEIGHT * offset_sum/count/100
+        align = self.ALIGN_WEIGHT * (velocity_sum/count - self.prev_velocity)/8
         return sep + align + coh
 
-    def update_velocity(self):
+    def update_velocity(self, aggregate=None):
         '''
         At each update the velocity of the predator is updated. Force vectors that encourage chasing and obstacle avoidance
         is summed together with the previous velocity to create a new velocity vector. This velocity vector is also bounded
-        by the MAX_PRED_VELOCITY, by scaling the normalized velocity vector by this constant.
+        by the MAX_PRED_VELOCITY, by scaling the normalized velocity vector by this constant. See calc_chase_force for
+        aggregate.
         '''
         self.prev_velocity = self.velocity
         neighbors = self.prune(self.world.get_close_neighbors(self, False), MAX_NEIGHBORS)
         obstacles = self.world.get_close_obstacles(self)
         predators = self.world.get_close_predators(self)
-        self.velocity = self.velocity +  self.calc_chase_force(neighbors) + self.calc_obstacle_force(obstacles) + 0.2 * self.calc_separation_force(predators)
+        self.velocity = self.velocity +  self.calc_chase_force(neighbors, aggregate) + self.calc_obstacle_force(obstacles) + 0.2 * self.calc_separation_force(predators)
         self.velocity = self.velocity/np.linalg.norm(self.velocity) * MAX_PRED_VELOCITY
\ No newline at end of file
@@ -0,0 +1,40 @@
+import math, sys, timeit
+import numpy as np
+
+
+def benchmark(n=100000, spread=80.0, repeat=5):
+    '''
+    Compares the old string keyed distance lookup against computing the distance directly, both per vector like
+    Creature.get_distance and for all vectors at once with np.hypot. Returns the best time per distance in
+    nanoseconds for each method. A bounded cache with a precomputed table for small offsets was measured too, and
+    was dropped since it took about three times as long as math.hypot.
+    '''
+    rng = np.random.default_rng(0)
+    diffs = rng.uniform(-spread, spread, (n, 2))
+    rows = list(diffs)
+    string_lookup = {}
+
+    def old_lookup():
+        for diff in rows:
+            key = str(int(diff[0])) + " " + str(int(diff[1]))
+            if key not in string_lookup:
+                string_lookup[key] = np.linalg.norm(diff)
+            string_lookup[key]
+
+    def direct():
+        for diff in rows:
+            math.hypot(diff[0], diff[1])
+
+    def vectorized():
+        np.hypot(diffs[:, 0], diffs[:, 1])
+
+    results = {}
+    for name, f in (('string_lookup', old_lookup), ('math_hypot', direct), ('np_hypot_batch', vectorized)):
+        results[name] = min(timeit.repeat(f, number=1, repeat=repeat))/n*1e9
+    return results
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, ns in benchmark(n).items():
+        print("%-16s %8.1f ns per distance" % (name, ns))
@@ -0,0 +1,516 @@
+import time
+import numpy as np
+from creature import MAX_BOID_VELOCITY, MAX_NEIGHBORS, RANDOM_NEIGHBORS, NEAREST_NEIGHBORS
+from spatial import create_spatial_hash, AggregatePyramid
+
+#Cell size of the finer grid searched in rings for the nearest neighbors
+NEAREST_CELL_SIZE = 20.0
+#How many times k boids the first ring of the nearest neighbor search is expected to hold
+NEAREST_RING_FILL = 1.5
+#Rings are only searched when the first one is smaller than this fraction of the sight radius, with larger rings
+#the extra queries of the finer grid cost more than they save
+NEAREST_RING_LIMIT = 0.6
+#Cell size of the finest level of the aggregates used for approximate cohesion and alignment
+AGGREGATE_CELL_SIZE = 20.0
+#How many times k pairs of a crowded boid are expected to pass the key threshold of keep_lowest
+PRUNE_MARGIN = 2.0
+
+
+class Flock(object):
+
+    def __init__(self, world):
+        '''
+        The Flock class keeps the state of every boid in the world in contiguous numpy arrays, one row per boid.
+        Instead of letting each boid find its neighbors and sum up forces in Python loops, all boids are updated
+        at once with batched array operations. The Boid sprites only hold an index into these arrays and are
+        used for drawing.
+        '''
+        self.world = world
+        self.positions = np.zeros((0, 2))
+        self.previous_positions = np.zeros((0, 2))
+        self.render_positions = np.zeros((0, 2))
+        self.velocities = np.zeros((0, 2))
+        self.prev_velocities = np.zeros((0, 2))
+        self.radii = np.zeros(0)
+        self.sights = np.zeros(0)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.salt = 0
+        self.neighbor_list = None
+        self.neighbor_mode = RANDOM_NEIGHBORS
+        self.nearest_grid = None
+        self.aggregate_theta = None
+        self.aggregates = None
+        self.scheduler = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add_boids(self, positions, velocities, radius, sight):
+        '''
+        Appends a batch of boids to the flock arrays. radius and sight can be one value for all boids, or one value
+        per boid. Returns the indices of the new rows, which the Boid sprites use to look up their state.
+        '''
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        velocities = np.asarray(velocities, dtype=float).reshape(-1, 2)
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(positions),))
+        sight = np.broadcast_to(np.asarray(sight, dtype=float), (len(positions),))
+        start = len(self)
+        self.positions = np.concatenate((self.positions, positions))
+        self.previous_positions = np.concatenate((self.previous_positions, positions))
+        self.render_positions = np.concatenate((self.render_positions, positions))
+        self.velocities = np.concatenate((self.velocities, velocities))
+        self.prev_velocities = np.concatenate((self.prev_velocities, velocities))
+        self.radii = np.concatenate((self.radii, radius))
+        self.sights = np.concatenate((self.sights, sight))
+        self.ids = np.concatenate((self.ids, np.arange(start, start + len(positions), dtype=np.int64)))
+        if self.neighbor_list:
+            self.neighbor_list.invalidate()
+        return range(start, len(self))
+
+    def update_velocities(self):
+        '''
+        Vectorized counterpart of Boid.update_velocity. All boids read the velocities from the start of the tick,
+        so the result does not depend on the order the boids are stored in. The same rules are used: flocking,
+        obstacle avoidance and separation from predators, followed by scaling to MAX_BOID_VELOCITY.
+        A new salt for the random neighbor prune is drawn from the world's generator each tick.
+        The velocities are double buffered. The buffers are swapped once per tick, the velocities of the last tick
+        become prev_velocities, which is only read, and the new velocities are only written to the other buffer.
+        If the flock has a scheduler, only the boids it selects get a new velocity, the others keep their velocity.
+        '''
+        if len(self) == 0:
+            return
+        self.prev_velocities, self.velocities = self.velocities, self.prev_velocities
+        self.salt = int(self.world.rng.integers(0, 2**62))
+        #Only the predators walk the aggregates, the boids sum their pairs in sight
+        if self.aggregate_theta is not None and len(self.world.predator_positions):
+            self.update_aggregates()
+        if self.scheduler is None:
+            self.velocities[:] = self.bound_velocities(self.prev_velocities + self.calc_forces(), MAX_BOID_VELOCITY)
+            return
+        with self.world.stats.phase('schedule'):
+            indices = self.scheduler.select(self)
+        start = time.perf_counter()
+        if len(indices) == len(self):
+            self.velocities[:] = self.bound_velocities(self.prev_velocities + self.calc_forces(), MAX_BOID_VELOCITY)
+        else:
+            self.velocities[:] = self.prev_velocities
+            forces = self.calc_forces(indices)
+            self.velocities[indices] = self.bound_velocities(self.prev_velocities[indices] + forces, MAX_BOID_VELOCITY)
+        self.scheduler.record_update(len(indices), time.perf_counter() - start)
+
+    def close(self):
+        '''
+        Frees any resources held by the flock. The serial flock has none.
+        '''
+        pass
+
+    def integrate(self, time_passed):
+        '''
+        Moves all boids according to their velocity and the time passed since last update. The world wraps
+        around, so modulo is used like in Creature.update. The positions before the move are kept for interpolation,
+        the two position buffers are swapped like the velocities.
+        '''
+        self.previous_positions, self.positions = self.positions, self.previous_positions
+        np.add(self.previous_positions, self.velocities * time_passed, out=self.positions)
+        self.wrap(self.positions)
+
+    def interpolate(self, alpha, indices=None):
+        '''
+        Sets render_positions to the positions alpha of the way from the previous positions to the current ones. A
+        boid that wrapped around an edge is moved the short way across it. If indices is given, only those boids
+        are moved, like the ones on screen.
+        '''
+        if indices is None:
+            diff = self.difference(self.positions, self.previous_positions)
+            self.render_positions = self.previous_positions + alpha*diff
+            self.wrap(self.render_positions)
+            return
+        previous = self.previous_positions[indices]
+        render = previous + alpha*self.difference(self.positions[indices], previous, indices)
+        self.wrap(render, indices)
+        self.render_positions[indices] = render
+
+    def wrap(self, positions, rows=None):
+        '''
+        Wraps positions around the edges of the world in place, one row per boid, for the boids given by rows or
+        every boid if rows is None.
+        '''
+        np.mod(positions, np.array(self.world.get_size(), dtype=float), out=positions)
+
+    def difference(self, a, b, rows=None):
+        '''
+        The shortest vectors from b to a, where each row belongs to the boid given by rows, or to the boid with the
+        same index if rows is None. Every boid of this flock share one world, so rows is not used, but a flock with
+        boids in many worlds needs it.
+        '''
+        return self.world.get_difference(a, b)
+
+    def get_weights(self, indices):
+        '''
+        Returns the separation, cohesion, alignment and avoidance weights used for the boids given by indices.
+        '''
+        return (self.world.get_separation_weight(), self.world.get_cohesion_weight(),
+                self.world.get_alignment_weight(), self.world.get_avoidance_weight())
+
+    def get_close_obstacle_pairs(self, indices, points, radii):
+        '''
+        (i, k) pairs of each obstacle k with its center inside radii[i] of points[i], a point near boid indices[i].
+        '''
+        return self.world.get_close_obstacle_pairs(points, radii)
+
+    def get_close_predator_pairs(self, indices):
+        '''
+        (i, k) pairs of each predator k inside the sight of boid indices[i].
+        '''
+        return self.world.get_close_predator_pairs(self.positions[indices], self.sights[indices])
+
+    def calc_forces(self, indices=None):
+        '''
+        Returns the sum of all steering forces for the boids given by indices, or every boid if indices is None.
+        The state of the whole flock is read, but only the requested rows are computed.
+        '''
+        if indices is None:
+            indices = np.arange(len(self))
+        stats = self.world.stats
+        in_sight = None
+        with stats.phase('neighbors'):
+            if self.neighbor_mode == NEAREST_NEIGHBORS:
+                i, j = self.get_nearest_pairs(indices, MAX_NEIGHBORS)
+            else:
+                i, j = in_sight = self.get_neighbor_pairs(indices)
+                pruned = len(i)
+                i, j = self.prune_pairs(i, j, MAX_NEIGHBORS, len(self))
+                stats.count('neighbors_pruned', pruned - len(i))
+        #The aggregates are summed before the forces phase, so their time is not counted twice
+        aggregate_forces = None
+        if self.aggregate_theta is not None:
+            aggregate_forces = self.calc_aggregate_forces(indices, in_sight)
+        with stats.phase('forces'):
+            return (self.calc_flocking_force(indices, i, j, aggregate_forces) + self.calc_obstacle_force(indices)
+                    + self.calc_predator_force(indices))
+
+    def get_neighbor_pairs(self, indices):
+        '''
+        Finds every pair (i, j) where boid j is inside the sight radius of boid i, for each i in indices. The world's
+        grid is used, so it must have been rebuilt from the current positions. If the flock has a neighbor list,
+        the pairs are read from it instead.
+        '''
+        if self.neighbor_list:
+            return self.neighbor_list.query_pairs(self.positions, indices, self.sights)
+        return self.world.grid.query_pairs(self.positions, indices, self.sights)
+
+    def prune_pairs(self, i, j, k, n):
+        '''
+        Vectorized counterpart of Thing.prune. Each pair gets a random key, and only the k pairs with the lowest
+        keys are kept for each boid. This is equivalent to a random sample of k neighbors without replacement.
+        The keys are a hash of the boid ids and the salt of the tick, so the same neighbors are kept no matter how
+        the flock is split up between processes.
+        '''
+        return self.keep_lowest(i, j, k, n, lambda ci, cj: self.get_pair_keys(self.ids[ci], self.ids[cj], self.salt),
+                                2.0**32)
+
+    def get_nearest_pairs(self, indices, k):
+        '''
+        Topological neighborhoods: the pairs (i, j) where j is one of the k boids nearest to boid i inside its sight
+        radius, for each i in indices. In a dense flock the boids are searched in a finer grid, in rings of growing
+        radius. A boid with at least k neighbors inside its ring is done, since every boid outside the ring is
+        further away. The others are searched again with twice the radius, until the sight radius is reached. Only
+        the boids with more than k neighbors inside their last ring are sorted. In a sparse flock most boids would
+        need the full sight radius anyway, and the pairs of the usual grid query are sorted instead.
+        The rings pay off in dense flocks, about twice as fast as the random prune with 10k boids in 2400x1200 or
+        50k boids in 4800x2400. In sparse flocks this is an accuracy option rather than a speed one, with 1000
+        boids in 1200x600 the sort by distance costs about a third more than the random prune.
+        Ties are broken by id, so both ways find the same neighbors as a brute force search. The pairs are returned
+        sorted by boid, distance and id, so the forces are summed in the same order however the flock is split up.
+        '''
+        n = len(self)
+        width, height = self.world.get_size()
+        #The first ring is expected to hold NEAREST_RING_FILL*k boids if the flock was spread evenly
+        radius = np.sqrt(NEAREST_RING_FILL*k*width*height/(np.pi*max(n, 1)))
+        if n == 0 or radius > NEAREST_RING_LIMIT*self.sights.min():
+            i, j = self.get_neighbor_pairs(indices)
+            return self.sort_nearest_pairs(*self.keep_lowest(i, j, k, n, self.get_distance_keys, self.sights**2))
+        if self.nearest_grid is None:
+            self.nearest_grid = create_spatial_hash(width, height, NEAREST_CELL_SIZE)
+        grid = self.nearest_grid
+        grid.rebuild(self.positions)
+        pending = np.asarray(indices, dtype=np.intp)
+        pairs_i = []
+        pairs_j = []
+        while len(pending):
+            ring = np.minimum(radius, self.sights)
+            i, j = grid.query_pairs(self.positions, pending, ring)
+            counts = np.bincount(i, minlength=n)
+            done = np.zeros(n, dtype=bool)
+            done[pending] = (counts[pending] >= k) | (ring[pending] >= self.sights[pending])
+            found = done[i]
+            i, j = self.keep_lowest(i[found], j[found], k, n, self.get_distance_keys, ring**2)
+            pairs_i.append(i)
+            pairs_j.append(j)
+            pending = pending[~done[pending]]
+            radius *= 2
+        return self.sort_nearest_pairs(np.concatenate(pairs_i), np.concatenate(pairs_j))
+
+    def sort_nearest_pairs(self, i, j):
+        '''
+        Sorts pairs by boid, then by distance and id.
+        '''
+        order = self.get_pair_order(i, j, self.get_distance_keys(i, j))
+        return i[order], j[order]
+
+    def get_pair_order(self, i, j, keys):
+        '''
+        The order that sorts pairs by boid i, then by key and then by the id of j. keys must be floats that are not
+        negative or integers below 2**32. The boid and the key are packed into one integer, a float key as its
+        float32 bits, which sort like the number, and sorted with one argsort. Only the pairs that share a packed
+        integer with another pair are sorted again by the exact key and the id, with the much slower lexsort.
+        '''
+        if keys.dtype == np.uint64:
+            low = keys
+        else:
+            low = keys.astype(np.float32).view(np.uint32).astype(np.uint64)
+        packed = (i.astype(np.uint64) << np.uint64(32)) | low
+        order = np.argsort(packed)
+        packed = packed[order]
+        tied = np.flatnonzero(packed[1:] == packed[:-1])
+        if len(tied):
+            #The tied pairs are in runs of equal packed integers, each run is sorted again in its own slots
+            slots = np.union1d(tied, tied + 1)
+            ties = order[slots]
+            order[slots] = ties[np.lexsort((self.ids[j[ties]], keys[ties], packed[slots]))]
+        return order
+
+    def update_aggregates(self):
+        '''
+        Rebuilds the pyramid of cell aggregates, the number of boids, their positions and their velocities from the
+        start of the tick, from which the predators take cohesion and alignment when aggregate_theta is set.
+        '''
+        if self.aggregates is None:
+            width, height = self.world.get_size()
+            self.aggregates = AggregatePyramid(create_spatial_hash(width, height, AGGREGATE_CELL_SIZE))
+        with self.world.stats.phase('aggregates'):
+            self.aggregates.grid.rebuild(self.positions)
+            self.aggregates.rebuild(self.positions, self.prev_velocities)
+
+    def get_aggregate_sums(self, points, radius, exclude=None):
+        '''
+        The number of boids inside radius of each point, the sum of the offsets to them and the sum of their
+        velocities, approximated from the aggregates with aggregate_theta as the accuracy threshold. See
+        AggregatePyramid.query_sums.
+        '''
+        self.aggregates.stats = self.world.stats
+        return self.aggregates.query_sums(points, radius, self.aggregate_theta, exclude)
+
+    def get_distance_keys(self, i, j):
+        '''
+        Keys that sort pairs by the distance between the boids, the squared distances.
+        '''
+        diff = self.difference(self.positions[i], self.positions[j], i)
+        return diff[:, 0]**2 + diff[:, 1]**2
+
+    def keep_lowest(self, i, j, k, n, get_keys, limit):
+        '''
+        Keeps the k pairs with the lowest keys for each boid i. get_keys(i, j) is only called for the pairs of the
+        crowded boids, the boids with more than k pairs. limit is the largest key a pair can have, for every boid or
+        one per boid. Pairs with equal keys are ordered by the id of j, so the pairs kept do not depend on the order
+        they were found in.
+        Only the pairs with keys up to a threshold are sorted, the threshold PRUNE_MARGIN*k pairs of a boid would be
+        under if its keys were spread evenly up to the limit. A boid left with fewer than k pairs under it has all
+        its pairs sorted, so the same pairs are kept as if every pair was sorted. numpy has no partition of groups
+        of different sizes, so the pairs left are sorted, see get_pair_order.
+        '''
+        counts = np.bincount(i, minlength=n)
+        crowded = counts[i] > k
+        if not crowded.any():
+            return i, j
+        #The masks are turned into indices first, indexing with a mask that is mostly random is far slower
+        crowded = np.flatnonzero(crowded)
+        ci = i[crowded]
+        cj = j[crowded]
+        keys = get_keys(ci, cj)
+        threshold = np.broadcast_to(limit, (n,))*np.minimum(PRUNE_MARGIN*k/np.maximum(counts, 1), 1.0)
+        under = keys <= threshold[ci]
+        short = np.bincount(ci[np.flatnonzero(under)], minlength=n) < k
+        candidate = np.flatnonzero(under | short[ci])
+        ci = ci[candidate]
+        cj = cj[candidate]
+        keys = keys[candidate]
+        order = self.get_pair_order(ci, cj, keys)
+        ci = ci[order]
+        cj = cj[order]
+        crowded_counts = np.bincount(ci, minlength=n)
+        rank = np.arange(len(ci)) - (np.cumsum(crowded_counts) - crowded_counts)[ci]
+        keep = np.flatnonzero(rank < k)
+        spared = np.flatnonzero(counts[i] <= k)
+        return np.concatenate((i[spared], ci[keep])), np.concatenate((j[spared], cj[keep]))
+
+    def calc_flocking_force(self, indices, i, j, aggregate_forces=None):
+        '''
+        Separation, cohesion and alignment for all boids at once. See Creature.calc_separation_force,
+        Creature.calc_cohesion_force and Creature.calc_alignment_force for the rules. Sums over the neighborhood
+        are done with np.bincount, one column at a time. If aggregate_theta is set, cohesion and alignment are
+        taken over every boid in sight instead of the pruned neighborhood, from the aggregates, and only separation
+        is summed over the pairs. aggregate_forces is the result of calc_aggregate_forces if it was already called.
+        '''
+        n = len(self)
+        counts = np.bincount(i, minlength=n).astype(float)[indices]
+        has_neighbors = counts > 0
+        counts[~has_neighbors] = 1.0
+
+        diff = self.difference(self.positions[i], self.positions[j], i)
+        distance = np.hypot(diff[:, 0], diff[:, 1])
+        distance[distance == 0] = np.inf
+        sep = self.group_sum(i, diff / distance[:, None], n)[indices] / counts[:, None]
+        if self.aggregate_theta is not None:
+            if aggregate_forces is None:
+                aggregate_forces = self.calc_aggregate_forces(indices)
+            coh, align, in_sight = aggregate_forces
+            has_neighbors |= in_sight
+        else:
+            #avg_pos - pos is the same as the average of the negated diff vectors
+            coh = -self.group_sum(i, diff, n)[indices] / counts[:, None] / 100
+            avg_velocity = self.group_sum(i, self.prev_velocities[j], n)[indices] / counts[:, None]
+            align = (avg_velocity - self.prev_velocities[indices]) / 8
+
+        separation, cohesion, alignment, avoidance = self.get_weights(indices)
+        force = separation * sep + cohesion * coh + alignment * align
+        force[~has_neighbors] = 0.0
+        return force
+
+    def calc_aggregate_forces(self, indices, in_sight=None):
+        '''
+        Cohesion and alignment over every boid inside the sight radius, summed exactly from the (i, j) pairs in
+        sight. The random prune starts from those pairs and passes them as in_sight, the nearest neighbor mode only
+        searches rings smaller than the sight, so they are queried here. Summing the pairs costs less than walking
+        the aggregates, which only pays off for the few long sighted predators. Returns the two forces, zero for
+        boids with no boid in sight, and a mask of the boids that have any.
+        '''
+        with self.world.stats.phase('aggregates'):
+            i, j = in_sight if in_sight is not None else self.get_neighbor_pairs(indices)
+            n = len(self)
+            #np.take gathers whole rows much faster than indexing, and every pair in sight is gathered here
+            diff = self.difference(np.take(self.positions, i, axis=0), np.take(self.positions, j, axis=0), i)
+            count = np.bincount(i, minlength=n).astype(float)[indices]
+            offsets = -self.group_sum(i, diff, n)[indices]
+            velocities = self.group_sum(i, np.take(self.prev_velocities, j, axis=0), n)[indices]
+        has_neighbors = count > 0
+        count[~has_neighbors] = 1.0
+        coh = offsets / count[:, None] / 100
+        align = (velocities / count[:, None] - self.prev_velocities[indices]) / 8
+        align[~has_neighbors] = 0.0
+        return coh, align, has_neighbors
+
+    def calc_obstacle_force(self, indices):
+        '''
+        Vectorized counterpart of Creature.calc_repel_force. Each boid looks ahead along a ray from its position to
+        the point sight ahead of it. An obstacle is a threat when the ray passes through it, by an exact segment
+        against circle test, or when it overlaps the boid. Every such obstacle has its center inside a circle around
+        the middle of the ray, so only that circle is searched in the obstacle grid, and all (boid, obstacle) pairs
+        found are tested in one pass. Each boid responds to the closest threat only.
+        '''
+        force = np.zeros((len(indices), 2))
+        if len(indices) == 0 or len(self.world.obstacle_radii) == 0:
+            return force
+        pos = self.positions[indices]
+        radii = self.radii[indices]
+        sight = self.sights[indices]
+        prev = self.prev_velocities[indices]
+        ray = prev / self.safe_norm(prev)[:, None] * sight[:, None]
+        reach = sight/2 + radii + self.world.obstacle_radii.max()
+        i, k = self.get_close_obstacle_pairs(indices, pos + ray/2, reach)
+        if len(i) == 0:
+            return force
+        obstacle_pos = self.world.obstacle_positions[k]
+        obstacle_radius = self.world.obstacle_radii[k]
+
+        #Project the obstacle center onto the ray, clamped to its ends, to find the point of the ray closest to it
+        center = self.difference(obstacle_pos, pos[i], indices[i])
+        ray_x, ray_y = ray[i, 0], ray[i, 1]
+        length2 = ray_x**2 + ray_y**2
+        t = np.divide(center[:, 0]*ray_x + center[:, 1]*ray_y, length2, out=np.zeros(len(i)), where=length2 > 0)
+        np.clip(t, 0.0, 1.0, out=t)
+        miss2 = (center[:, 0] - t*ray_x)**2 + (center[:, 1] - t*ray_y)**2
+        distance = np.hypot(center[:, 0], center[:, 1])
+        threat = (miss2 <= obstacle_radius**2) | (distance < obstacle_radius + radii[i])
+        i = i[threat]
+        #Sort the threats by boid and distance, the first threat of each boid is the closest one
+        order = np.lexsort((distance[threat], i))
+        closest = np.flatnonzero(threat)[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = i[order][1:] != i[order][:-1]
+        closest = closest[first]
+
+        threatened = i[order][first]
+        ahead = pos[threatened] + ray[threatened]
+        force[threatened] = self.difference(ahead, obstacle_pos[closest], indices[threatened])
+        force[threatened] /= self.safe_norm(force[threatened])[:, None]
+        return self.get_weights(indices)[3] * force
+
+    def calc_predator_force(self, indices):
+        '''
+        Boids try to separate themselves from predators inside their sight radius. Same rule as
+        Creature.calc_separation_force, with the predators found by the world's predator grid as the neighborhood.
+        '''
+        force = np.zeros((len(indices), 2))
+        pos = self.positions[indices]
+        i, k = self.get_close_predator_pairs(indices)
+        if len(i) == 0:
+            return force
+        diff = self.difference(pos[i], self.world.predator_positions[k], indices[i])
+        distance = np.hypot(diff[:, 0], diff[:, 1])
+        distance[distance == 0] = np.inf
+        count = np.bincount(i, minlength=len(indices))
+        force = self.group_sum(i, diff / distance[:, None], len(indices))
+        has_predators = count > 0
+        force[has_predators] /= count[has_predators][:, None]
+        return force
+
+    @staticmethod
+    def get_pair_keys(a, b, salt):
+        '''
+        Pseudo random integers in [0, 2**32) for each pair of ids (a, b), the high bits of the splitmix64 finalizer.
+        The same pair and salt always give the same number. The operations are done in place, since the arrays
+        hold every pair of the flock.
+        '''
+        x = a.astype(np.uint64)
+        x <<= np.uint64(32)
+        x |= b.astype(np.uint64)
+        x += np.uint64((salt*0x9e3779b97f4a7c15) & 0xffffffffffffffff)
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xbf58476d1ce4e5b9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94d049bb133111eb)
+        x ^= x >> np.uint64(31)
+        x >>= np.uint64(32)
+        return x
+
+    @staticmethod
+    def group_sum(i, values, n):
+        '''
+        Sums rows of values that share the same index in i. Returns an (n, 2) array.
+        '''
+        return np.stack((np.bincount(i, weights=values[:, 0], minlength=n),
+                         np.bincount(i, weights=values[:, 1], minlength=n)), axis=1)
+
+    def distance(self, a, b, rows=None):
+        '''
+        Distance between each point in a and the point in the same row of b. See difference for rows.
+        '''
+        diff = self.difference(a, b, rows)
+        return np.hypot(diff[:, 0], diff[:, 1])
+
+    @staticmethod
+    def safe_norm(vectors):
+        '''
+        Length of each row vector. Zero lengths are replaced by one, so zero vectors stay zero when divided.
+        '''
+        norm = np.hypot(vectors[:, 0], vectors[:, 1])
+        norm[norm == 0] = 1.0
+        return norm
+
+    @staticmethod
+    def bound_velocities(velocities, max_velocity):
+        '''
+        Normalizes each velocity and scales it by max_velocity, like the end of Boid.update_velocity.
+        '''
+        return velocities / Flock.safe_norm(velocities)[:, None] * max_velocity
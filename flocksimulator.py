@@ -1,9 +1,13 @@
 import sgc
 from sgc.locals import *
-import pygame, sys, random
+import pygame, sys, time
 from pygame.locals import *
 from world import World
-import cProfile
+from creature import RANDOM_NEIGHBORS, NEAREST_NEIGHBORS
+from instrumentation import TickStats, NULL_STATS, draw_overlay
+from rendering import Camera
+from pipeline import Simulation
+from scheduler import UpdateScheduler
 
 
 BLACK = (0,0,0)
@@ -13,83 +17,196 @@ BG_COLOR = WHITE
 #Screen width and height
 width, height = 1200, 600
 dim = [width, height]
+#The world is larger than the screen, the arrow keys move the camera around it
+WORLD_SIZE = (2400, 1200)
+CAMERA_SPEED = 15
 
-nr_of_boids = 200
+nr_of_boids = 800
 
-pygame.init()
-
-screen = pygame.display.set_mode(dim)
-pygame.display.set_caption('Boids')
-controls= sgc.surface.Screen(dim)
+#Screen area covered by the sliders, redrawn every frame
+CONTROLS_RECT = pygame.Rect(0, 0, 250, 170)
+#Where the instrumentation overlay is drawn, next to the sliders
+OVERLAY_POS = (260, 10)
+STATS_FILE = 'tick_stats.json'
+SNAPSHOT_FILE = 'snapshot.npz'
 
 
 #Slider gui elements
-sep_slider = sgc.Scale((100,35),label_col=BLACK,label="Separation", pos=(10, 10), min=0, max=200, min_step=1)
-sep_slider.add(0)
-coh_slider = sgc.Scale((100,35),label_col=BLACK ,label="Cohesion", pos=(10, 50), min=0, max=100, min_step=1,)
-coh_slider.add(0)
-align_slider = sgc.Scale((100,35),label_col=BLACK,label="Aligmnent", pos=(10, 90), min=0, max=100, min_step=1,)
-align_slider.add(0)
-avoid_slider = sgc.Scale((100,35),label_col=BLACK,label="Avoidance", pos=(10, 130), min=0, max=1000, min_step=1)
-avoid_slider.add(0)
-
-
-#World init and populating
-world = World(screen, coh_slider,align_slider, sep_slider, avoid_slider)
-world.populate(nr_of_boids)
+def create_sliders():
+    sep_slider = sgc.Scale((100,35),label_col=BLACK,label="Separation", pos=(10, 10), min=0, max=200, min_step=1)
+    sep_slider.add(0)
+    coh_slider = sgc.Scale((100,35),label_col=BLACK ,label="Cohesion", pos=(10, 50), min=0, max=100, min_step=1,)
+    coh_slider.add(0)
+    align_slider = sgc.Scale((100,35),label_col=BLACK,label="Aligmnent", pos=(10, 90), min=0, max=100, min_step=1,)
+    align_slider.add(0)
+    avoid_slider = sgc.Scale((100,35),label_col=BLACK,label="Avoidance", pos=(10, 130), min=0, max=1000, min_step=1)
+    avoid_slider.add(0)
+    return coh_slider, align_slider, sep_slider, avoid_slider
+
+
+def call(function, *args):
+    return function(*args)
+
+
+def export_stats(world, path):
+    world.stats.export(path)
+
+
+def get_settings(world, snapshot=None):
+    '''
+    Whether stats are collected, whether the flock has an update scheduler, and the neighbor mode. In pipelined
+    mode the world belongs to the simulation thread, so they are read from its latest snapshot instead.
+    '''
+    if snapshot is not None:
+        return snapshot.enabled, snapshot.scheduling, snapshot.neighbor_mode
+    return world.stats.enabled, world.flock.scheduler is not None, world.neighbor_mode
+
+
+def handle_events(world, camera, send=call, snapshot=None):
+    '''
+    Handles keyboard and mouse events, and forwards every event to the sliders. Mouse positions are turned into
+    world positions by the camera. Changes to the world are made through send, which calls them right away, or
+    queues them for the simulation thread in pipelined mode. The settings the keys toggle are read from snapshot
+    in pipelined mode, see get_settings. Returns True when the window has been closed.
+    '''
+    stats_enabled, scheduling, neighbor_mode = get_settings(world, snapshot)
+    stopping = False
+    for event in pygame.event.get():
+        sgc.event(event)
+        if event.type == QUIT:
+            stopping = True
+        if event.type == pygame.KEYDOWN:
+            if event.key == K_o:
+                send(world.add_obstacle, camera.to_world(pygame.mouse.get_pos()))
+            if event.key == K_p:
+                mods = pygame.key.get_mods()
+                if mods & pygame.KMOD_SHIFT:
+                    send(world.remove_all_predators)
+                else:
+                    send(world.add_predator, camera.to_world(pygame.mouse.get_pos()))
+            if event.key == K_i:
+                send(world.set_stats, NULL_STATS if stats_enabled else TickStats())
+            if event.key == K_e and stats_enabled:
+                send(export_stats, world, STATS_FILE)
+            if event.key == K_s:
+                send(world.save, SNAPSHOT_FILE)
+            if event.key == K_l:
+                camera.next_mode()
+            if event.key == K_u:
+                send(world.set_scheduler, None if scheduling else UpdateScheduler())
+            if event.key == K_n:
+                send(world.set_neighbor_mode, NEAREST_NEIGHBORS if neighbor_mode == RANDOM_NEIGHBORS
+                     else RANDOM_NEIGHBORS)
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            if event.button == 3:
+                send(world.remove_obstacle, camera.to_world(pygame.mouse.get_pos()))
+    keys = pygame.key.get_pressed()
+    camera.move((keys[K_RIGHT] - keys[K_LEFT])*CAMERA_SPEED, (keys[K_DOWN] - keys[K_UP])*CAMERA_SPEED)
+    return stopping
 
 
 #Could abstract, make each creature decide what to do, and let another class
 #Calculate the new absolute position
-def run_simulation():
+def run_simulation(screen, world, sliders, pipelined=False):
+    '''
+    The main loop. Normally the world is stepped in the loop, between handling events and drawing. When pipelined,
+    a Simulation thread steps the world, and the loop only handles events, sends the changes to the simulation
+    as commands, and draws the latest snapshot. A slow frame and a slow step then no longer hold each other up.
+    The stats of the render loop are not collected in pipelined mode, the overlay shows the simulation's stats.
+    The loop never reads the world's state back while the simulation runs, it reads the snapshot, and remembers
+    the weights it sent, so each change of a slider is sent once.
+    '''
+    coh_slider, align_slider, sep_slider, avoid_slider = sliders
+    coh_slider.value = world.cohesion
+    align_slider.value = world.alignment
+    sep_slider.value = world.separation
+    avoid_slider.value = world.avoid
+    sent_weights = (world.cohesion, world.alignment, world.separation, world.avoid)
+    background = pygame.Surface(screen.get_size())
+    background.fill(BG_COLOR)
+    screen.blit(background, (0, 0))
+    pygame.display.update()
+    camera = Camera(screen.get_size(), world.get_size())
+    font = pygame.font.SysFont('monospace', 12)
+    overlay_rect = None
     clock = pygame.time.Clock()
-    number = 0
+    simulation = Simulation(world) if pipelined else None
+    send = simulation.send if simulation else call
+    if simulation:
+        simulation.start()
     stopping = False
     while not stopping:
+        #The frame rate is capped, but the simulation always advances in fixed steps of world.time_step
         time_passed = clock.tick(30)
+        stats = NULL_STATS if simulation else world.stats
 
         #Event handling
-        for event in pygame.event.get():
-            sgc.event(event)
-            if event.type == QUIT:
-                stopping = True
-            if event.type == pygame.KEYDOWN:
-                if event.key == K_o:
-                    world.add_obstacle(pygame.mouse.get_pos())
-                if event.key == K_p:
-                    mods = pygame.key.get_mods()
-                    if mods & pygame.KMOD_SHIFT:
-                        world.remove_all_predators()
-                    else:
-                        world.add_predator(pygame.mouse.get_pos())
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                if event.button == 3:
-                    world.remove_obstacle(pygame.mouse.get_pos())
-        screen.fill(BG_COLOR)
-
-
-        #Update  and redraw all creatures on screen
-        for creature in world.all_things:
-            creature.update_velocity()
-
-        world.all_things.update(time_passed)
-        world.all_things.draw(screen)
-        sgc.update(time_passed)
-        #When all object is drawn, the graphics is rendered
-        pygame.display.update()
-
-        #dtime = time_passed / 1000
-        #fps = 1 / dtime
-        #if number % 10 == 0:
-        #    print("FPS: ", fps)
-        #number += 1
+        with stats.phase('events'):
+            stopping = handle_events(world, camera, send, simulation.get_snapshot() if simulation else None)
+            weights = (coh_slider.value, align_slider.value, sep_slider.value, avoid_slider.value)
+            if weights != sent_weights:
+                send(world.set_weights, *weights)
+                sent_weights = weights
+
+        #Run the steps due since last frame, and redraw all creatures between the last two steps
+        if simulation:
+            simulation.check()
+            snapshot = simulation.get_snapshot()
+            dirty = camera.render_snapshot(screen, background, snapshot, snapshot.get_interpolation())
+            overlay = snapshot
+        else:
+            world.advance(time_passed)
+            frame_start = time.perf_counter()
+            with stats.phase('sprites'):
+                dirty = camera.render(screen, background, world, world.get_interpolation())
+            overlay = stats
+        with stats.phase('gui'):
+            screen.blit(background, CONTROLS_RECT, CONTROLS_RECT)
+            sgc.update(time_passed)
+            dirty.append(CONTROLS_RECT)
+            if overlay_rect:
+                screen.blit(background, overlay_rect, overlay_rect)
+                dirty.append(overlay_rect)
+                overlay_rect = None
+            if overlay.enabled:
+                overlay_rect = draw_overlay(screen, overlay, OVERLAY_POS, font)
+                if overlay_rect:
+                    dirty.append(overlay_rect)
+        #When all object is drawn, only the regions that changed are rendered
+        with stats.phase('display'):
+            pygame.display.update(dirty)
+        if not simulation:
+            stats.end_tick()
+            #The scheduler keeps the steps within the time left by drawing the frame
+            if world.flock.scheduler:
+                world.flock.scheduler.set_frame_cost(time.perf_counter() - frame_start)
+    if simulation:
+        simulation.stop()
     pygame.quit()
     sys.exit()
 
-run_simulation()
-#cProfile.run('run_simulation()', sort='cumtime')
 
+def main():
+    pygame.init()
+
+    screen = pygame.display.set_mode(dim)
+    pygame.display.set_caption('Boids')
+    controls= sgc.surface.Screen(dim)
+    sliders = create_sliders()
 
+    #World init and populating, or restoring a snapshot given on the command line. --pipelined steps the world
+    #in a thread of its own
+    args = sys.argv[1:]
+    pipelined = '--pipelined' in args
+    args = [arg for arg in args if arg != '--pipelined']
+    if args:
+        world = World.load(args[0])
+    else:
+        world = World(*WORLD_SIZE)
+        world.populate(nr_of_boids)
 
+    run_simulation(screen, world, sliders, pipelined)
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import argparse, asyncio, sys, time
+import numpy as np
+from world import World
+from creature import NEIGHBOR_MODES, RANDOM_NEIGHBORS
+from instrumentation import TickStats
+from recording import Recorder
+from scheduler import UpdateScheduler, TARGET_FPS
+import streaming
+
+
+def create_world(args):
+    '''
+    Creates a world from the command line arguments. Obstacles and predators are placed at random positions, drawn
+    from the world's seeded generator.
+    '''
+    world = World(args.width, args.height, args.cohesion, args.alignment, args.separation, args.avoidance,
+                  workers=args.workers, threads=args.threads, seed=args.seed, neighbor_skin=args.skin or 0,
+                  neighbor_mode=args.neighbors, aggregate_theta=args.theta)
+    world.populate(args.boids)
+    for i in range(args.obstacles):
+        world.add_obstacle((world.random.randrange(args.width), world.random.randrange(args.height)))
+    for i in range(args.predators):
+        world.add_predator((world.random.randrange(args.width), world.random.randrange(args.height)))
+    return world
+
+
+def run(world, ticks, dt, recorder=None):
+    '''
+    Steps the world ticks times with a fixed time step of dt milliseconds, as fast as possible and without any
+    rendering. If a recorder is given, every tick is recorded. Returns the number of ticks per second.
+    '''
+    start = time.perf_counter()
+    for i in range(ticks):
+        world.step(dt)
+        if recorder:
+            recorder.record(world)
+        world.stats.end_tick()
+    elapsed = time.perf_counter() - start
+    return ticks/elapsed if elapsed > 0 else float("inf")
+
+
+def dump_state(world, path):
+    '''
+    Writes the final state of the world to a numpy .npz file.
+    '''
+    predators = world.predators.sprites()
+    obstacles = world.obstacles.sprites()
+    np.savez(path,
+             size=np.array(world.get_size()),
+             boid_positions=world.flock.positions,
+             boid_velocities=world.flock.velocities,
+             predator_positions=np.array([p.pos for p in predators]).reshape(-1, 2),
+             predator_velocities=np.array([p.velocity for p in predators]).reshape(-1, 2),
+             obstacle_positions=np.array([o.pos for o in obstacles]).reshape(-1, 2))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Run the boids simulation without a display.')
+    parser.add_argument('--boids', type=int, default=200, help='number of boids')
+    parser.add_argument('--ticks', type=int, default=1000, help='number of ticks to simulate')
+    parser.add_argument('--dt', type=float, default=33.0, help='fixed time step in milliseconds')
+    parser.add_argument('--width', type=int, default=1200)
+    parser.add_argument('--height', type=int, default=600)
+    parser.add_argument('--separation', type=float, default=0)
+    parser.add_argument('--cohesion', type=float, default=0)
+    parser.add_argument('--alignment', type=float, default=0)
+    parser.add_argument('--avoidance', type=float, default=10)
+    parser.add_argument('--obstacles', type=int, default=0, help='number of randomly placed obstacles')
+    parser.add_argument('--predators', type=int, default=0, help='number of randomly placed predators')
+    parser.add_argument('--workers', type=int, default=0, help='number of worker processes, 0 runs in process')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='number of threads calculating the forces in process, 0 runs in the main thread')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--neighbors', choices=NEIGHBOR_MODES, default=RANDOM_NEIGHBORS,
+                        help='follow a random sample or the nearest of the neighbors in crowded neighborhoods')
+    parser.add_argument('--theta', type=float, default=None,
+                        help='take cohesion and alignment over everything in sight, the predators approximate it '
+                             'from cell aggregates with this accuracy threshold, 0 is exact')
+    parser.add_argument('--update-fraction', type=float, default=None,
+                        help='give only this share of the boids a new velocity each tick, in rotation')
+    parser.add_argument('--target-fps', type=float, default=None,
+                        help='give only as many boids a new velocity each tick as fit in this frame rate')
+    parser.add_argument('--skin', type=float, default=None,
+                        help='keep neighbor lists with this skin, 0 disables them. Pays off with short time steps, '
+                             'like --skin 20 --dt 8. A loaded world keeps its own skin unless this is given')
+    parser.add_argument('--dump', default=None, help='write the final state to this .npz file')
+    parser.add_argument('--load', default=None, help='start from a snapshot written by --save instead of a new world')
+    parser.add_argument('--save', default=None, help='save a snapshot of the world to this .npz file when done')
+    parser.add_argument('--record', default=None, help='record every tick into this directory')
+    parser.add_argument('--stats', default=None, help='collect per phase timings and write them to this JSON file')
+    parser.add_argument('--serve', type=int, default=None, metavar='PORT',
+                        help='stream every tick to viewers connecting to this port, see streaming.py')
+    parser.add_argument('--host', default='', help='address to stream on, all interfaces by default')
+    parser.add_argument('--rate', type=float, default=0, help='ticks per second when streaming, 0 is unlimited')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.load:
+        world = World.load(args.load, workers=args.workers, threads=args.threads, neighbor_skin=args.skin)
+    else:
+        world = create_world(args)
+    if args.stats:
+        world.set_stats(TickStats(history_length=args.ticks))
+    if args.update_fraction is not None or args.target_fps is not None:
+        world.set_scheduler(UpdateScheduler(args.target_fps or TARGET_FPS, args.update_fraction))
+    recorder = Recorder(args.record, world) if args.record else None
+    if args.serve is not None:
+        start = time.perf_counter()
+        server = asyncio.run(streaming.serve(world, args.ticks, args.dt, args.host, args.serve, args.rate,
+                                             recorder=recorder, log=print))
+        ticks_per_second = args.ticks/(time.perf_counter() - start)
+        print("Streamed frames: %d  kB/frame: %.1f" % (server.frames, server.bytes/1024/max(server.frames, 1)))
+    else:
+        ticks_per_second = run(world, args.ticks, args.dt, recorder)
+    if recorder:
+        recorder.close()
+    print("Ticks: %d  Boids: %d  Ticks/sec: %.1f" % (args.ticks, len(world.flock), ticks_per_second))
+    if args.seed is not None:
+        print("Checksum: %s" % world.get_checksum())
+    if world.flock.neighbor_list:
+        print("Neighbor list rebuild rate: %.2f" % world.flock.neighbor_list.get_rebuild_rate())
+    if world.flock.scheduler:
+        summary = world.flock.scheduler.summary()
+        print("Updated/tick: %.0f  Near threats/tick: %.0f  Staleness mean: %.2f  p95: %.0f  max: %d  Fraction: %.2f"
+              % (summary['updated_per_tick'], summary['priority_per_tick'], summary['mean_staleness'],
+                 summary['p95_staleness'], summary['max_staleness'], summary['fraction']))
+    if args.stats:
+        for line in world.stats.get_overlay_lines():
+            print(line)
+        world.stats.export(args.stats)
+    if args.dump:
+        dump_state(world, args.dump)
+    if args.save:
+        world.save(args.save)
+    world.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
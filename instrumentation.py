@@ -0,0 +1,159 @@
+import json, time
+from collections import deque, OrderedDict
+import numpy as np
+
+#Constants
+HISTORY_LENGTH = 300
+#Histogram bins from 10 microseconds to 1 second, in seconds
+HISTOGRAM_BINS = np.logspace(-5, 0, 26)
+OVERLAY_COLOR = (0,0,0)
+
+
+class NullPhase(object):
+    '''
+    Context manager that does nothing. Used for phases when the instrumentation is disabled.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class NullStats(object):
+    '''
+    Stand-in for TickStats when the instrumentation is disabled. Every method does nothing, so the cost of the
+    instrumentation hooks is a method call.
+    '''
+    enabled = False
+    null_phase = NullPhase()
+
+    def phase(self, name):
+        return self.null_phase
+
+    def count(self, name, value):
+        pass
+
+    def end_tick(self):
+        pass
+
+
+class Phase(object):
+    '''
+    Times one phase of a tick, and adds the time to the phase's total for the current tick when done.
+    '''
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        current = self.stats.current_timings
+        current[self.name] = current.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+class TickStats(object):
+    enabled = True
+
+    def __init__(self, history_length=HISTORY_LENGTH):
+        '''
+        Collects the time spent in each phase of a tick, and counters like the number of neighbors visited. The
+        timings and counters of the last history_length ticks are kept, and histograms and summaries are made from
+        these. Phases can be entered several times in a tick, the times are summed.
+        '''
+        self.history_length = history_length
+        self.timings = OrderedDict()
+        self.counters = OrderedDict()
+        self.current_timings = {}
+        self.current_counters = {}
+        self.ticks = 0
+
+    def phase(self, name):
+        '''
+        Returns a context manager timing the named phase.
+        '''
+        return Phase(self, name)
+
+    def count(self, name, value):
+        '''
+        Adds value to the named counter for the current tick.
+        '''
+        self.current_counters[name] = self.current_counters.get(name, 0) + value
+
+    def end_tick(self):
+        '''
+        Moves the timings and counters of the current tick into the history. Phases and counters not seen this tick
+        are recorded as zero.
+        '''
+        for history, current in ((self.timings, self.current_timings), (self.counters, self.current_counters)):
+            for name in current:
+                if name not in history:
+                    history[name] = deque([0]*min(self.ticks, self.history_length), maxlen=self.history_length)
+            for name, values in history.items():
+                values.append(current.get(name, 0))
+            current.clear()
+        self.ticks += 1
+
+    def get_histogram(self, name):
+        '''
+        Returns the counts and bin edges of the recent timings of a phase, with log spaced bins.
+        '''
+        return np.histogram(np.asarray(self.timings.get(name, ()), dtype=float), bins=HISTOGRAM_BINS)
+
+    def summary(self):
+        '''
+        Mean, median, 95th percentile and max of each phase in seconds, and mean per tick of each counter, over
+        the recent ticks.
+        '''
+        phases = OrderedDict()
+        for name, values in self.timings.items():
+            values = np.asarray(values, dtype=float)
+            phases[name] = {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+                            'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+        counters = OrderedDict((name, float(np.mean(values))) for name, values in self.counters.items())
+        return {'ticks': self.ticks, 'window': min(self.ticks, self.history_length), 'phases': phases,
+                'counters': counters}
+
+    def export(self, path):
+        '''
+        Writes the summary, the histograms and the raw recent timings and counters to a JSON file.
+        '''
+        report = self.summary()
+        report['histogram_bins'] = HISTOGRAM_BINS.tolist()
+        report['histograms'] = OrderedDict((name, self.get_histogram(name)[0].tolist()) for name in self.timings)
+        report['timings'] = OrderedDict((name, np.asarray(values).tolist()) for name, values in self.timings.items())
+        report['counters_history'] = OrderedDict((name, np.asarray(values).tolist())
+                                                 for name, values in self.counters.items())
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    def get_overlay_lines(self):
+        '''
+        Short text lines with the mean time per phase and counters, for drawing on screen.
+        '''
+        summary = self.summary()
+        lines = ["%-10s %6.2f ms" % (name, values['mean']*1000) for name, values in summary['phases'].items()]
+        lines += ["%-18s %8.0f" % (name, value) for name, value in summary['counters'].items()]
+        return lines
+
+
+def draw_overlay(screen, stats, pos, font):
+    '''
+    Draws the stats as text on screen, with the top left corner at pos. Returns the rect covered by the text.
+    '''
+    x, y = pos
+    rect = None
+    for line in stats.get_overlay_lines():
+        text = font.render(line, True, OVERLAY_COLOR)
+        line_rect = screen.blit(text, (x, y))
+        rect = line_rect if rect is None else rect.union(line_rect)
+        y += font.get_linesize()
+    return rect
+
+
+#Shared by everything that is not instrumented
+NULL_STATS = NullStats()
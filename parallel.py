@@ -0,0 +1,361 @@
+import math, sys, time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from flock import Flock
+from spatial import create_spatial_hash
+from instrumentation import NULL_STATS
+
+#Flock arrays shared with the worker processes, and the number of columns of each. All are float64, the ids are
+#exact up to 2**53
+SHARED_ARRAYS = (('positions', 2), ('prev_velocities', 2), ('radii', 1), ('sights', 1), ('ids', 1), ('forces', 2))
+
+#Shared memory blocks attached by a worker process, kept between tasks
+attached = {}
+#Tiles for each thread of a ThreadedFlock
+TILES_PER_THREAD = 2
+
+
+class TileWorld(object):
+
+    def __init__(self, size, cell_size, weights, obstacle_positions, obstacle_radii, predator_positions):
+        '''
+        The part of the World a worker process needs to calculate the forces on the boids in one tile. It has the
+        same methods as World for the flock to use, but no sprites. Weights use the same scale as World.set_weights.
+        '''
+        self.width, self.height = size
+        self.cohesion, self.alignment, self.separation, self.avoid = weights
+        self.stats = NULL_STATS
+        self.grid = create_spatial_hash(self.width, self.height, cell_size)
+        self.obstacle_positions = obstacle_positions
+        self.obstacle_radii = obstacle_radii
+        self.obstacle_grid = create_spatial_hash(self.width, self.height, cell_size)
+        self.obstacle_grid.rebuild(obstacle_positions)
+        self.predator_positions = predator_positions
+        self.predator_grid = create_spatial_hash(self.width, self.height, cell_size)
+        self.predator_grid.rebuild(predator_positions)
+
+    def get_size(self):
+        return self.width, self.height
+
+    def get_cohesion_weight(self):
+        return self.cohesion/100
+
+    def get_alignment_weight(self):
+        return self.alignment/100
+
+    def get_separation_weight(self):
+        return self.separation/100
+
+    def get_avoidance_weight(self):
+        return self.avoid/100
+
+    def get_difference(self, a, b):
+        return self.grid.difference(a, b)
+
+    def get_close_obstacle_pairs(self, positions, sights):
+        return self.obstacle_grid.query_points(positions, sights)
+
+    def get_close_predator_pairs(self, positions, sights):
+        return self.predator_grid.query_points(positions, sights)
+
+
+def get_tile_layout(width, height, nr_of_tiles):
+    '''
+    Splits the world into a grid of tiles_x by tiles_y tiles, with roughly square tiles and at least nr_of_tiles
+    tiles in total.
+    '''
+    tiles_x = max(1, int(round(math.sqrt(nr_of_tiles*width/height))))
+    tiles_y = max(1, int(math.ceil(nr_of_tiles/tiles_x)))
+    return tiles_x, tiles_y
+
+
+def get_tiles(positions, size, layout):
+    '''
+    Returns the tile each position belongs to.
+    '''
+    tiles_x, tiles_y = layout
+    tx = np.clip((positions[:, 0]*tiles_x // size[0]).astype(np.intp), 0, tiles_x - 1)
+    ty = np.clip((positions[:, 1]*tiles_y // size[1]).astype(np.intp), 0, tiles_y - 1)
+    return ty*tiles_x + tx
+
+
+def get_halo(positions, size, layout, tile, halo):
+    '''
+    Returns a mask of the positions closer than halo to the rectangle of tile. The world wraps around, so the
+    shortest distance across the edges is used.
+    '''
+    tiles_x, tiles_y = layout
+    width, height = size
+    tile_width = width/tiles_x
+    tile_height = height/tiles_y
+    center = np.array([(tile % tiles_x + 0.5)*tile_width, (tile // tiles_x + 0.5)*tile_height])
+    diff = positions - center
+    diff -= np.array(size)*np.round(diff/np.array(size))
+    dx = np.maximum(np.abs(diff[:, 0]) - tile_width/2, 0.0)
+    dy = np.maximum(np.abs(diff[:, 1]) - tile_height/2, 0.0)
+    return dx**2 + dy**2 < halo**2
+
+
+def attach(names, n):
+    '''
+    Attaches to the shared flock arrays in a worker process. The blocks are kept open between tasks, and only
+    reattached when the main process has created new ones.
+    '''
+    key = (names, n)
+    if key not in attached:
+        for blocks, arrays in attached.values():
+            for block in blocks:
+                block.close()
+        attached.clear()
+        blocks = [shared_memory.SharedMemory(name=name) for name in names]
+        arrays = {}
+        for block, (array_name, columns) in zip(blocks, SHARED_ARRAYS):
+            shape = (n, columns) if columns > 1 else (n,)
+            arrays[array_name] = np.ndarray(shape, dtype=float, buffer=block.buf)
+        attached[key] = (blocks, arrays)
+    return attached[key][1]
+
+
+def get_tick(flock):
+    '''
+    The world state every tile needs for one tick, besides the flock arrays.
+    '''
+    world = flock.world
+    return {'size': tuple(float(v) for v in world.get_size()),
+            'cell_size': world.grid.cell_size,
+            'weights': (world.cohesion, world.alignment, world.separation, world.avoid),
+            'obstacle_positions': world.obstacle_positions,
+            'obstacle_radii': world.obstacle_radii,
+            'predator_positions': world.predator_positions,
+            'salt': flock.salt,
+            'neighbor_mode': flock.neighbor_mode,
+            'aggregate_theta': flock.aggregate_theta}
+
+
+def calc_tile_forces(task):
+    '''
+    Worker task. Calculates the forces on every boid in one tile, and writes them into the shared forces array.
+    '''
+    names, n, tile, layout, halo, tick = task
+    return calc_tile(attach(names, n), tile, layout, halo, tick)
+
+
+def calc_tile(arrays, tile, layout, halo, tick):
+    '''
+    Calculates the forces on every boid in one tile from the flock arrays in arrays, and writes them into
+    arrays['forces']. The boids in the tile and the ones in the surrounding halo are copied into a small flock, in
+    the same order as in the full flock, with the same ids. The neighborhoods, the random prune and the order of all
+    sums are then the same as in the serial engine, so the result is identical in both neighbor modes, with ties in
+    the nearest neighbors broken by id. check_determinism tests this with the flocking weights set. Only the rows
+    of the tile's own boids are written, so tiles can run at the same time on one forces array.
+    '''
+    positions = arrays['positions']
+    size = tick['size']
+    own = get_tiles(positions, size, layout) == tile
+    if not own.any():
+        return 0
+    subset = np.flatnonzero(own | get_halo(positions, size, layout, tile, halo))
+
+    world = TileWorld(size, tick['cell_size'], tick['weights'], tick['obstacle_positions'],
+                      tick['obstacle_radii'], tick['predator_positions'])
+    flock = Flock(world)
+    flock.positions = positions[subset]
+    flock.prev_velocities = arrays['prev_velocities'][subset]
+    flock.radii = arrays['radii'][subset]
+    flock.sights = arrays['sights'][subset]
+    flock.ids = arrays['ids'][subset].astype(np.int64)
+    flock.salt = tick['salt']
+    flock.neighbor_mode = tick['neighbor_mode']
+    flock.aggregate_theta = tick['aggregate_theta']
+    world.grid.rebuild(flock.positions)
+    local = np.flatnonzero(own[subset])
+    arrays['forces'][subset[local]] = flock.calc_forces(local)
+    return len(local)
+
+
+class ParallelFlock(Flock):
+
+    def __init__(self, world, workers):
+        '''
+        A Flock that calculates the forces of a tick in a pool of worker processes. The world is split into
+        spatial tiles, one task per tile. The flock arrays are copied into shared memory once per tick, so the
+        workers can read the boids of their tile and its halo, a margin as wide as the largest sight radius,
+        without pickling. Each worker writes the forces of its own boids back into shared memory, and the
+        velocities and positions are then updated in the main process like in the serial Flock.
+        '''
+        super(ParallelFlock, self).__init__(world)
+        self.workers = workers
+        self.layout = get_tile_layout(world.width, world.height, workers)
+        self.pool = None
+        self.blocks = []
+        self.shared = {}
+
+    def calc_forces(self, indices=None):
+        '''
+        Forces for the whole flock are calculated by the worker pool. Calls for a subset of the boids are done in
+        this process.
+        '''
+        if indices is not None:
+            return super(ParallelFlock, self).calc_forces(indices)
+        self.share_arrays()
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        names = tuple(block.name for block in self.blocks)
+        tick = get_tick(self)
+        halo = float(self.sights.max())
+        nr_of_tiles = self.layout[0]*self.layout[1]
+        tasks = [(names, len(self), tile, self.layout, halo, tick) for tile in range(nr_of_tiles)]
+        with self.world.stats.phase('forces'):
+            self.pool.map(calc_tile_forces, tasks)
+        return self.shared['forces'].copy()
+
+    def share_arrays(self):
+        '''
+        Copies the flock arrays into shared memory. New blocks are created when the number of boids has changed.
+        '''
+        n = len(self)
+        if not self.blocks or self.shared['positions'].shape[0] != n:
+            self.release_arrays()
+            for array_name, columns in SHARED_ARRAYS:
+                shape = (n, columns) if columns > 1 else (n,)
+                block = shared_memory.SharedMemory(create=True, size=max(1, n*columns*8))
+                self.blocks.append(block)
+                self.shared[array_name] = np.ndarray(shape, dtype=float, buffer=block.buf)
+        for array_name, columns in SHARED_ARRAYS[:-1]:
+            self.shared[array_name][:] = getattr(self, array_name)
+
+    def release_arrays(self):
+        self.shared = {}
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def close(self):
+        '''
+        Stops the worker pool and frees the shared memory.
+        '''
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.release_arrays()
+
+
+class ThreadedFlock(Flock):
+
+    def __init__(self, world, threads):
+        '''
+        A Flock that calculates the forces of a tick in a pool of threads. The world is split into tiles like in
+        ParallelFlock, but the tiles read the flock arrays directly, since threads share memory, instead of through
+        shared memory blocks. Like in the worker processes, calc_tile copies the boids of the tile and its halo into
+        a small flock of its own, so no thread works on arrays another thread uses, and each tile writes only the
+        force rows of its own boids. That is what makes the threads safe, not the double buffered update. There are
+        TILES_PER_THREAD tiles for each thread, so a thread that is done with a sparse tile can take another one.
+        numpy releases the GIL in part of the array work, but no speedup has been measured, since the machine this
+        was written on has one CPU, where the threads only add overhead. Use benchmark_threads to measure it.
+        '''
+        super(ThreadedFlock, self).__init__(world)
+        self.threads = threads
+        self.layout = get_tile_layout(world.width, world.height, threads*TILES_PER_THREAD)
+        self.executor = None
+
+    def calc_forces(self, indices=None):
+        '''
+        Forces for the whole flock are calculated by the thread pool. Calls for a subset of the boids are done in
+        the calling thread.
+        '''
+        if indices is not None or len(self) == 0:
+            return super(ThreadedFlock, self).calc_forces(indices)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix='flock')
+        arrays = {'positions': self.positions, 'prev_velocities': self.prev_velocities, 'radii': self.radii,
+                  'sights': self.sights, 'ids': self.ids, 'forces': np.zeros((len(self), 2))}
+        tick = get_tick(self)
+        halo = float(self.sights.max())
+        nr_of_tiles = self.layout[0]*self.layout[1]
+        with self.world.stats.phase('forces'):
+            list(self.executor.map(lambda tile: calc_tile(arrays, tile, self.layout, halo, tick), range(nr_of_tiles)))
+        return arrays['forces']
+
+    def close(self):
+        '''
+        Stops the threads.
+        '''
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def benchmark_threads(thread_counts=(1, 2, 4, 8), nr_of_boids=10000, ticks=20, size=(4000, 3000), seed=1):
+    '''
+    Steps the same seeded world with the serial flock and with the thread pool for each thread count. Returns a
+    list of (threads, ticks per second, identical to serial) rows, where threads 0 is the serial flock.
+    '''
+    return benchmark_scaling(thread_counts, nr_of_boids, ticks, size, seed, option='threads')
+
+
+def benchmark_scaling(worker_counts=(1, 2, 4, 8), nr_of_boids=10000, ticks=20, size=(4000, 3000), seed=1,
+                      option='workers'):
+    '''
+    Steps the same seeded world with the serial flock and with the process pool for each worker count. Returns a
+    list of (workers, ticks per second, identical to serial) rows, where workers 0 is the serial flock. With
+    option 'threads' the counts are threads instead.
+    '''
+    from world import World
+    results = []
+    reference = None
+    for workers in (0,) + tuple(worker_counts):
+        world = World(size[0], size[1], 20, 20, 50, 100, seed=seed, **{option: workers})
+        world.populate(nr_of_boids)
+        for i in range(10):
+            world.add_obstacle((world.random.randrange(size[0]), world.random.randrange(size[1])))
+        world.step(33)
+        start = time.perf_counter()
+        for i in range(ticks):
+            world.step(33)
+        elapsed = time.perf_counter() - start
+        state = world.flock.positions.copy()
+        world.close()
+        if reference is None:
+            reference = state
+        results.append((workers, ticks/elapsed, bool(np.array_equal(state, reference))))
+    return results
+
+
+def check_determinism(nr_of_boids=3000, ticks=20, size=(1200, 600), seed=1, counts=(2, 4)):
+    '''
+    Steps the same seeded world with cohesion, alignment and separation set, in both neighbor modes, with the
+    serial flock and with counts workers and threads. Returns a list of (neighbor mode, engine, checksum, identical
+    to serial) rows. The boids start on the integer positions of populate, so there are many pairs at equal
+    distances, which the nearest neighbor mode has to break the same way in every engine.
+    '''
+    from world import World
+    from creature import NEIGHBOR_MODES
+    results = []
+    for mode in NEIGHBOR_MODES:
+        reference = None
+        for option, count in (('workers', 0),) + tuple((o, c) for o in ('workers', 'threads') for c in counts):
+            world = World(size[0], size[1], 20, 20, 50, 10, seed=seed, neighbor_mode=mode, **{option: count})
+            world.populate(nr_of_boids)
+            for i in range(ticks):
+                world.step(33)
+            checksum = world.get_checksum()
+            world.close()
+            reference = reference or checksum
+            engine = '%s %d' % (option, count) if count else 'serial'
+            results.append((mode, engine, checksum, checksum == reference))
+    return results
+
+
+if __name__ == '__main__':
+    boids = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print("CPUs: %d" % multiprocessing.cpu_count())
+    for mode, engine, checksum, identical in check_determinism():
+        print("neighbors: %-7s %-9s checksum: %s  identical to serial: %s" % (mode, engine, checksum, identical))
+    for workers, ticks_per_second, identical in benchmark_scaling(nr_of_boids=boids):
+        print("workers: %d  ticks/sec: %6.1f  identical to serial: %s" % (workers, ticks_per_second, identical))
+    for threads, ticks_per_second, identical in benchmark_threads(nr_of_boids=boids):
+        print("threads: %d  ticks/sec: %6.1f  identical to serial: %s" % (threads, ticks_per_second, identical))
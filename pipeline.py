@@ -0,0 +1,212 @@
+import collections, queue, sys, threading, time
+import numpy as np
+from world import World, MAX_STEPS_PER_FRAME
+
+#Constants
+#Number of snapshots kept in the ring buffer between the simulation and the render loop
+SNAPSHOT_BUFFER = 3
+
+
+def get_copy(array):
+    '''
+    A read only copy of array, so a snapshot can be shared between threads without either side changing it.
+    '''
+    copy = np.array(array, dtype=float)
+    copy.flags.writeable = False
+    return copy
+
+
+class Snapshot(object):
+    __slots__ = ('step', 'published', 'time_step', 'size', 'positions', 'previous_positions', 'velocities', 'radii',
+                 'predator_positions', 'predator_previous_positions', 'predator_velocities', 'predator_radii',
+                 'obstacles', 'stats_lines', 'neighbor_mode', 'scheduling')
+
+    def __init__(self, world, published):
+        '''
+        The state of the world the renderer needs, copied at the end of a step: the boid and predator positions of
+        the last two steps, their velocities for the headings, and the obstacles. The arrays are read only copies,
+        so the simulation can go on stepping while the snapshot is drawn. Obstacles never change once created, so
+        the obstacle sprites themselves are kept. published is the time.perf_counter() time the step finished. If
+        the world collects stats, their overlay lines are kept too, since the stats are only safe to read in the
+        simulation thread. For the same reason the settings the render loop toggles are kept: the neighbor mode,
+        and scheduling, whether the flock has an update scheduler.
+        '''
+        flock = world.flock
+        predators = world.predators.sprites()
+        self.step = world.steps
+        self.published = published
+        self.time_step = world.time_step
+        self.size = np.array(world.get_size(), dtype=float)
+        self.positions = get_copy(flock.positions)
+        self.previous_positions = get_copy(flock.previous_positions)
+        self.velocities = get_copy(flock.velocities)
+        self.radii = get_copy(flock.radii)
+        self.predator_positions = get_copy([p.pos for p in predators]).reshape(-1, 2)
+        self.predator_previous_positions = get_copy([p.previous_pos for p in predators]).reshape(-1, 2)
+        self.predator_velocities = get_copy([p.velocity for p in predators]).reshape(-1, 2)
+        self.predator_radii = get_copy([p.radius for p in predators])
+        self.obstacles = tuple(world.obstacles.sprites())
+        self.stats_lines = world.stats.get_overlay_lines() if world.stats.enabled else None
+        self.neighbor_mode = world.neighbor_mode
+        self.scheduling = flock.scheduler is not None
+
+    def get_interpolation(self, now=None):
+        '''
+        How far the wall clock is into the step after the snapshot, from 0 to 1, like World.get_interpolation.
+        Stays at 1 when the next snapshot is late.
+        '''
+        now = time.perf_counter() if now is None else now
+        return min(max((now - self.published)*1000/self.time_step, 0.0), 1.0)
+
+    def interpolate(self, previous, current, alpha):
+        '''
+        Positions alpha of the way from previous to current, moving the short way across the edges like
+        Flock.interpolate.
+        '''
+        diff = current - previous
+        diff -= self.size*np.round(diff/self.size)
+        return np.mod(previous + alpha*diff, self.size)
+
+    @property
+    def enabled(self):
+        return self.stats_lines is not None
+
+    def get_overlay_lines(self):
+        '''
+        The stats overlay lines of the step, so a snapshot can be drawn with draw_overlay like a TickStats.
+        '''
+        return self.stats_lines or []
+
+
+class Simulation(object):
+
+    def __init__(self, world, buffer_size=SNAPSHOT_BUFFER, max_steps=MAX_STEPS_PER_FRAME):
+        '''
+        Steps a world in a thread of its own, so a slow frame does not hold up the simulation and a slow step does
+        not hold up the event handling. The thread steps the world in real time, in fixed steps of world.time_step,
+        and publishes a Snapshot after every step into a ring buffer of the last buffer_size snapshots. The render
+        loop draws the latest one. While the simulation runs the world belongs to its thread. Other threads change
+        it by sending commands, which the thread runs between steps in the order they were sent.
+        '''
+        self.world = world
+        self.max_steps = max_steps
+        self.snapshots = collections.deque(maxlen=buffer_size)
+        self.commands = queue.Queue()
+        self.running = False
+        self.thread = None
+        self.error = None
+        self.publish()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='simulation')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, function, *args):
+        '''
+        Queues a call of function with args in the simulation thread, like send(world.add_obstacle, pos). Raises
+        the error of an earlier command or step, if there was one.
+        '''
+        self.check()
+        self.commands.put((function, args))
+
+    def check(self):
+        if self.error:
+            raise self.error
+
+    def get_snapshot(self):
+        '''
+        The latest snapshot. Appending to and reading from the end of a deque are atomic, so no lock is needed.
+        '''
+        return self.snapshots[-1]
+
+    def publish(self):
+        self.snapshots.append(Snapshot(self.world, time.perf_counter()))
+
+    def run_command(self, command):
+        #None is only sent by stop, to wake the thread up
+        if command is not None:
+            function, args = command
+            function(*args)
+
+    def run(self):
+        '''
+        Simulation thread. Steps are due every time_step milliseconds of wall clock time. Between steps the thread
+        waits for commands, and runs each as soon as it arrives. When the steps fall behind, several are run back
+        to back, but never more than max_steps, like World.advance.
+        '''
+        world = self.world
+        step_seconds = world.time_step/1000
+        next_step = time.perf_counter()
+        try:
+            while self.running:
+                wait = next_step - time.perf_counter()
+                if wait > 0:
+                    try:
+                        self.run_command(self.commands.get(timeout=wait))
+                    except queue.Empty:
+                        pass
+                    continue
+                while not self.commands.empty():
+                    self.run_command(self.commands.get_nowait())
+                next_step = max(next_step, time.perf_counter() - self.max_steps*step_seconds)
+                world.step(world.time_step)
+                world.stats.end_tick()
+                self.publish()
+                next_step += step_seconds
+        except Exception as e:
+            self.error = e
+
+    def stop(self):
+        '''
+        Stops the thread after the step it is running, and returns the world to the caller. Commands not run yet
+        are dropped.
+        '''
+        self.running = False
+        self.commands.put(None)
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.check()
+        return self.world
+
+
+def benchmark(nr_of_boids=2000, frame_cost=0.1, seconds=3.0, seed=1):
+    '''
+    Runs the same world with a render loop that takes frame_cost seconds a frame, once with the world stepped in
+    the loop by World.advance and once with a Simulation thread. The slow frame is a sleep, which like the display
+    update of pygame lets other threads run. Returns the frames per second and the steps per second of each.
+    '''
+    results = {}
+    for mode in ('serial', 'pipelined'):
+        world = World(1200, 600, 20, 20, 50, 100, seed=seed)
+        world.populate(nr_of_boids)
+        simulation = Simulation(world) if mode == 'pipelined' else None
+        if simulation:
+            simulation.start()
+        frames = 0
+        start = last = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            now = time.perf_counter()
+            if simulation:
+                snapshot = simulation.get_snapshot()
+                snapshot.interpolate(snapshot.previous_positions, snapshot.positions, snapshot.get_interpolation())
+            else:
+                world.advance((now - last)*1000)
+            last = now
+            time.sleep(frame_cost)
+            frames += 1
+        elapsed = time.perf_counter() - start
+        if simulation:
+            simulation.stop()
+        results[mode] = {'frames': frames/elapsed, 'steps': world.steps/elapsed}
+        world.close()
+    return results
+
+
+if __name__ == '__main__':
+    frame_cost = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+    print("Real time is %.1f steps/sec" % (1000/World(1, 1).time_step))
+    for mode, result in benchmark(frame_cost=frame_cost).items():
+        print("%-9s frames/sec: %5.1f  steps/sec: %5.1f" % (mode, result['frames'], result['steps']))
@@ -0,0 +1,228 @@
+import json, os, queue, sys, threading
+import numpy as np
+
+#Constants
+CHUNK_FRAMES = 256
+INDEX_FILE = 'index.json'
+FORMAT_VERSION = 1
+
+#Kinds of creatures stored in a recording
+BOID = 0
+PREDATOR = 1
+OBSTACLE = 2
+KIND_COLORS = {BOID: (136,193,0), PREDATOR: (255,0,60), OBSTACLE: (255,138,0)}
+
+#Columns stored for every chunk, and their data types
+CHUNK_COLUMNS = (('positions', np.float32), ('velocities', np.float32), ('kinds', np.uint8),
+                 ('offsets', np.int64))
+
+
+def get_chunk_path(path, chunk, column):
+    return os.path.join(path, 'chunk_%05d_%s.npy' % (chunk, column))
+
+
+def get_frame(world):
+    '''
+    Copies the positions, velocities and kinds of every creature in the world, boids first, then predators and
+    obstacles. Obstacles have zero velocity.
+    '''
+    predators = world.predators.sprites()
+    obstacles = world.obstacles.sprites()
+    n = len(world.flock)
+    positions = np.empty((n + len(predators) + len(obstacles), 2), dtype=np.float32)
+    velocities = np.zeros_like(positions)
+    kinds = np.empty(len(positions), dtype=np.uint8)
+    positions[:n] = world.flock.positions
+    velocities[:n] = world.flock.velocities
+    kinds[:n] = BOID
+    for row, predator in enumerate(predators, n):
+        positions[row] = predator.pos
+        velocities[row] = predator.velocity
+        kinds[row] = PREDATOR
+    for row, obstacle in enumerate(obstacles, n + len(predators)):
+        positions[row] = obstacle.pos
+        kinds[row] = OBSTACLE
+    return positions, velocities, kinds
+
+
+class Recorder(object):
+
+    def __init__(self, path, world, chunk_frames=CHUNK_FRAMES):
+        '''
+        Records the state of a world, one frame per call to record, into the directory path. Frames are collected
+        into chunks of chunk_frames frames. Each chunk is stored column by column as float32 .npy files, with the
+        rows of all its frames after each other and an offsets array telling where each frame starts, since the
+        number of creatures can change. The chunks are written by a background thread, so the tick loop only pays
+        for copying the arrays. index.json lists the chunks and is rewritten after every chunk, so a recording can
+        be read while it is still being made.
+        '''
+        self.path = path
+        self.chunk_frames = chunk_frames
+        os.makedirs(path, exist_ok=True)
+        self.index = {'version': FORMAT_VERSION, 'size': [float(v) for v in world.get_size()],
+                      'time_step': world.time_step, 'seed': world.seed, 'frames': 0, 'chunks': []}
+        self.frames = []
+        self.start_step = None
+        self.queue = queue.Queue()
+        self.error = None
+        self.writer = threading.Thread(target=self.write_chunks, name='recorder')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def record(self, world):
+        '''
+        Adds the current state of the world as a frame. Hands the chunk over to the writer thread when it is full.
+        '''
+        if self.error:
+            raise self.error
+        if not self.frames:
+            self.start_step = world.steps
+        self.frames.append(get_frame(world))
+        if len(self.frames) >= self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        if self.frames:
+            self.queue.put((self.start_step, self.frames))
+            self.frames = []
+
+    def write_chunks(self):
+        '''
+        Writer thread. Concatenates the frames of each chunk into columns and saves them, then updates the index.
+        '''
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                start_step, frames = item
+                self.write_chunk(start_step, frames)
+            except Exception as e:
+                self.error = e
+
+    def write_chunk(self, start_step, frames):
+        chunk = len(self.index['chunks'])
+        counts = [len(kinds) for positions, velocities, kinds in frames]
+        columns = {'positions': np.concatenate([f[0] for f in frames]),
+                   'velocities': np.concatenate([f[1] for f in frames]),
+                   'kinds': np.concatenate([f[2] for f in frames]),
+                   'offsets': np.concatenate(([0], np.cumsum(counts))).astype(np.int64)}
+        for column, dtype in CHUNK_COLUMNS:
+            np.save(get_chunk_path(self.path, chunk, column), columns[column].astype(dtype, copy=False))
+        self.index['chunks'].append({'start': self.index['frames'], 'frames': len(frames), 'step': start_step})
+        self.index['frames'] += len(frames)
+        self.write_index()
+
+    def write_index(self):
+        #Written to a temporary file first, so readers never see a half written index
+        tmp = os.path.join(self.path, INDEX_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, INDEX_FILE))
+
+    def close(self):
+        '''
+        Writes the last, partial chunk and waits for the writer thread to finish.
+        '''
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+        if not self.index['chunks']:
+            self.write_index()
+        if self.error:
+            raise self.error
+
+
+class Replay(object):
+
+    def __init__(self, path):
+        '''
+        Reads a recording made by Recorder. Chunks are memory mapped when first used, so any frame can be read
+        without decoding the frames before it, and only the pages touched are loaded from disk.
+        '''
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.size = tuple(self.index['size'])
+        self.time_step = self.index['time_step']
+        self.chunk_starts = np.array([c['start'] for c in self.index['chunks']], dtype=np.int64)
+        self.chunks = {}
+
+    def __len__(self):
+        return self.index['frames']
+
+    def get_chunk(self, chunk):
+        if chunk not in self.chunks:
+            self.chunks[chunk] = {column: np.load(get_chunk_path(self.path, chunk, column), mmap_mode='r')
+                                  for column, dtype in CHUNK_COLUMNS}
+        return self.chunks[chunk]
+
+    def get_frame(self, frame):
+        '''
+        Returns the positions, velocities and kinds of every creature in a frame, as read only memory mapped arrays.
+        Negative frames count from the end.
+        '''
+        if frame < 0:
+            frame += len(self)
+        if not 0 <= frame < len(self):
+            raise IndexError("frame %d out of range, the recording has %d frames" % (frame, len(self)))
+        chunk = int(np.searchsorted(self.chunk_starts, frame, side='right')) - 1
+        columns = self.get_chunk(chunk)
+        local = frame - self.chunk_starts[chunk]
+        start, end = columns['offsets'][local], columns['offsets'][local + 1]
+        return columns['positions'][start:end], columns['velocities'][start:end], columns['kinds'][start:end]
+
+    def get_step(self, frame):
+        '''
+        The world step a frame was recorded at.
+        '''
+        chunk = int(np.searchsorted(self.chunk_starts, frame, side='right')) - 1
+        info = self.index['chunks'][chunk]
+        return info['step'] + frame - info['start']
+
+
+def play(path, fps=30):
+    '''
+    Shows a recording in a pygame window. The recording plays forwards, space pauses, the arrow keys step one frame,
+    and clicking or dragging the mouse scrubs to the frame under the mouse along the width of the window.
+    '''
+    import pygame
+    replay = Replay(path)
+    pygame.init()
+    width, height = int(replay.size[0]), int(replay.size[1])
+    screen = pygame.display.set_mode((width, height))
+    font = pygame.font.SysFont('monospace', 12)
+    clock = pygame.time.Clock()
+    frame = 0
+    playing = True
+    while True:
+        clock.tick(fps)
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                return
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_SPACE:
+                    playing = not playing
+                if event.key == pygame.K_RIGHT:
+                    frame, playing = frame + 1, False
+                if event.key == pygame.K_LEFT:
+                    frame, playing = frame - 1, False
+        if pygame.mouse.get_pressed()[0]:
+            frame = int(pygame.mouse.get_pos()[0]/width*len(replay))
+        elif playing:
+            frame += 1
+        frame %= len(replay)
+
+        positions, velocities, kinds = replay.get_frame(frame)
+        screen.fill((228,228,197))
+        for pos, kind in zip(positions, kinds):
+            radius = 30 if kind == OBSTACLE else 8
+            pygame.draw.circle(screen, KIND_COLORS[int(kind)], (int(pos[0]), int(pos[1])), radius)
+        text = font.render("frame %d/%d  step %d" % (frame, len(replay), replay.get_step(frame)), True, (0,0,0))
+        screen.blit(text, (10, 10))
+        pygame.display.flip()
+
+
+if __name__ == '__main__':
+    play(sys.argv[1])
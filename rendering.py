@@ -0,0 +1,245 @@
+import math
+import numpy as np
+import pygame
+
+#Constants
+HEADING_STEPS = 64
+LINE_COLOR = (1,1,1)
+COLOR_KEY = (0,0,0)
+RED = (255,0,60)
+GREEN = (136,193,0)
+ORANGE = (255,138,0)
+
+#How the camera draws the boids: always as sprites, always as a density heatmap, or as a heatmap only when more
+#than LOD_LIMIT boids are in view
+SPRITE_MODE = 'sprites'
+HEATMAP_MODE = 'heatmap'
+AUTO_MODE = 'auto'
+RENDER_MODES = (AUTO_MODE, SPRITE_MODE, HEATMAP_MODE)
+LOD_LIMIT = 1500
+#Heatmap cells in pixels, and the number of boids in a cell drawn with the darkest color
+HEATMAP_CELL_SIZE = 8
+HEATMAP_SATURATION = 6
+HEATMAP_COLORS = ((136,193,0), (120,20,40))
+
+
+class SpriteAtlas(object):
+
+    def __init__(self, steps=HEADING_STEPS):
+        '''
+        The sprite atlas keeps pre-rendered creature images, one for each of steps quantized headings, for every
+        color and radius in use. Creatures pick the image matching their heading instead of drawing themselves
+        every frame. Images are rendered the first time a color and radius is asked for.
+        '''
+        self.steps = steps
+        self.images = {}
+
+    def get_heading_index(self, velocity):
+        '''
+        Quantizes the direction of velocity to one of the atlas headings. Returns None for a zero velocity, which
+        is drawn without a direction line.
+        '''
+        if velocity[0] == 0 and velocity[1] == 0:
+            return None
+        angle = math.atan2(velocity[1], velocity[0])
+        return int(round(angle/(2*math.pi)*self.steps)) % self.steps
+
+    def get_heading_indices(self, velocities):
+        '''
+        Vectorized get_heading_index for an array of velocities. Zero velocities get the index steps, which is the
+        image without a direction line.
+        '''
+        angles = np.arctan2(velocities[:, 1], velocities[:, 0])
+        indices = np.round(angles/(2*math.pi)*self.steps).astype(np.intp) % self.steps
+        indices[(velocities[:, 0] == 0) & (velocities[:, 1] == 0)] = self.steps
+        return indices
+
+    def get_image(self, color, radius, heading_index):
+        '''
+        Returns the shared image of a creature with the given color and radius, heading in the direction given by
+        heading_index. The image must not be drawn on, since every creature of the same kind use it.
+        '''
+        key = (color, radius)
+        if key not in self.images:
+            self.images[key] = self.render_creature(color, radius)
+        images = self.images[key]
+        if heading_index is None:
+            return images[-1]
+        return images[heading_index]
+
+    def render_creature(self, color, radius):
+        '''
+        Renders a filled circle with a line from the center showing the direction the creature is heading, for each
+        of the quantized headings. The last image has no direction line.
+        '''
+        images = []
+        for step in range(self.steps + 1):
+            image = pygame.Surface((radius*2, radius*2))
+            image.set_colorkey(COLOR_KEY)
+            image.fill(COLOR_KEY)
+            pygame.draw.ellipse(image, color, [0, 0, radius*2, radius*2])
+            if step < self.steps:
+                angle = 2*math.pi*step/self.steps
+                end = (radius + math.cos(angle)*radius, radius + math.sin(angle)*radius)
+                pygame.draw.line(image, LINE_COLOR, (radius, radius), end, 2)
+            images.append(image)
+        return images
+
+
+#Shared by all creatures
+atlas = SpriteAtlas()
+
+
+class Camera(object):
+
+    def __init__(self, view_size, world_size):
+        '''
+        The part of the world shown on the screen, so the world can be larger than the window. The camera position
+        is the world coordinate shown in the top left corner of the view. The view wraps around the edges of the
+        world like the creatures do.
+        '''
+        self.width, self.height = view_size
+        self.world_width, self.world_height = world_size
+        self.x = 0.0
+        self.y = 0.0
+        self.moved = True
+        self.drawn = []
+        self.mode = AUTO_MODE
+
+    def get_view(self):
+        '''
+        The (x, y, width, height) rectangle of the world in view.
+        '''
+        return self.x, self.y, self.width, self.height
+
+    def next_mode(self):
+        self.mode = RENDER_MODES[(RENDER_MODES.index(self.mode) + 1) % len(RENDER_MODES)]
+        self.moved = True
+
+    def render(self, screen, background, world, alpha):
+        '''
+        Draws the part of the world in view, with the creatures interpolated alpha of the way between the last two
+        steps. Only the boids in view are found, through the world's grid, and moved. In HEATMAP_MODE, or in
+        AUTO_MODE with more than LOD_LIMIT boids in view, the boids are drawn as a density heatmap, which costs the
+        same however many boids there are. Returns the screen rectangles that changed.
+        '''
+        visible = world.get_visible_boids(self.get_view())
+        sprites = world.update_sprites(alpha, visible)
+        if self.mode == HEATMAP_MODE or (self.mode == AUTO_MODE and len(visible) > LOD_LIMIT):
+            return self.draw_heatmap(screen, background, world.flock.render_positions[visible], sprites)
+        return self.draw(screen, background, sprites, self.get_boid_blits(world.flock, visible))
+
+    def render_snapshot(self, screen, background, snapshot, alpha):
+        '''
+        Like render, for a Snapshot published by a Simulation running in another thread. The snapshot has no grid,
+        so the boids in view are found by testing every position, and the predators are drawn from the snapshot
+        arrays instead of their sprites. Returns the screen rectangles that changed.
+        '''
+        positions = snapshot.interpolate(snapshot.previous_positions, snapshot.positions, alpha)
+        radii = snapshot.radii
+        x, y = self.to_screen((positions[:, 0], positions[:, 1]), radii)
+        visible = np.flatnonzero((x < self.width + radii) & (y < self.height + radii))
+        predators = snapshot.interpolate(snapshot.predator_previous_positions, snapshot.predator_positions, alpha)
+        blits = self.get_blits(predators, snapshot.predator_radii, snapshot.predator_velocities, RED)
+        if self.mode == HEATMAP_MODE or (self.mode == AUTO_MODE and len(visible) > LOD_LIMIT):
+            return self.draw_heatmap(screen, background, positions[visible], snapshot.obstacles, blits)
+        blits = self.get_blits(positions[visible], radii[visible], snapshot.velocities[visible]) + blits
+        return self.draw(screen, background, snapshot.obstacles, blits)
+
+    def get_boid_blits(self, flock, indices, color=GREEN):
+        '''
+        The (image, screen position) pairs of the boids given by indices that are in view, for Surface.blits. The
+        boids are read from the flock arrays, and each is drawn with the shared atlas image of its heading.
+        '''
+        return self.get_blits(flock.render_positions[indices], flock.radii[indices], flock.velocities[indices], color)
+
+    def get_blits(self, positions, radii, velocities, color=GREEN):
+        '''
+        The (image, screen position) pairs of the creatures with the given center positions, radii and velocities
+        that are in view, like get_boid_blits.
+        '''
+        radii = np.asarray(radii, dtype=float)
+        corners = positions - radii[:, None]
+        x, y = self.to_screen((corners[:, 0], corners[:, 1]), 2*radii)
+        inside = (x < self.width) & (y < self.height)
+        #The heading index steps is the last atlas image, the one without a direction line
+        headings = atlas.get_heading_indices(velocities[inside])
+        return [(atlas.get_image(color, radius, heading), (bx, by))
+                for radius, heading, bx, by in zip(radii[inside].tolist(), headings.tolist(), x[inside].tolist(),
+                                                   y[inside].tolist())]
+
+    def move(self, dx, dy):
+        if dx or dy:
+            self.x = (self.x + dx) % self.world_width
+            self.y = (self.y + dy) % self.world_height
+            self.moved = True
+
+    def center_on(self, pos):
+        self.move(pos[0] - self.width/2 - self.x, pos[1] - self.height/2 - self.y)
+
+    def to_world(self, screen_pos):
+        '''
+        The world position shown at a position on the screen, like the mouse position.
+        '''
+        return ((screen_pos[0] + self.x) % self.world_width, (screen_pos[1] + self.y) % self.world_height)
+
+    def to_screen(self, pos, margin=0):
+        '''
+        Where a world position is shown on the screen. Positions up to margin left of or above the view are placed
+        there rather than wrapped to the far side of the world, so things crossing the top or left edge of the view
+        are still drawn. Works on arrays of coordinates too.
+        '''
+        x = (pos[0] - self.x + margin) % self.world_width - margin
+        y = (pos[1] - self.y + margin) % self.world_height - margin
+        return x, y
+
+    def draw(self, screen, background, sprites, blits=()):
+        '''
+        Draws the (image, screen position) pairs in blits, and the sprites at their place in the view on top. What
+        was drawn last frame is cleared with the background first, or the whole view when the camera has moved.
+        Returns the screen rectangles that changed.
+        '''
+        if self.moved:
+            screen.blit(background, (0, 0))
+            dirty = [screen.get_rect()]
+            self.moved = False
+        else:
+            for rect in self.drawn:
+                screen.blit(background, rect, rect)
+            dirty = self.drawn
+        self.drawn = screen.blits(blits) if blits else []
+        for sprite in sprites:
+            x, y = self.to_screen(sprite.rect.topleft, max(sprite.rect.width, sprite.rect.height))
+            if x < self.width and y < self.height:
+                self.drawn.append(screen.blit(sprite.image, (x, y)))
+        return dirty + self.drawn
+
+    def draw_heatmap(self, screen, background, positions, sprites, blits=()):
+        '''
+        Level of detail drawing for crowded views. The boid positions are counted in square cells of
+        HEATMAP_CELL_SIZE pixels, and every cell holding boids is filled with a color between the two
+        HEATMAP_COLORS by its count. The sprites, like obstacles and predators, and the (image, screen position)
+        pairs in blits are drawn on top. The whole view is redrawn.
+        '''
+        cell = HEATMAP_CELL_SIZE
+        cols = -(-self.width//cell)
+        rows = -(-self.height//cell)
+        x, y = self.to_screen((positions[:, 0], positions[:, 1]))
+        inside = (x < self.width) & (y < self.height)
+        cells = (y[inside]//cell).astype(np.intp)*cols + (x[inside]//cell).astype(np.intp)
+        counts = np.bincount(cells, minlength=rows*cols).reshape(rows, cols)
+        level = np.minimum(counts/HEATMAP_SATURATION, 1.0)[:, :, None]
+        low, high = np.array(HEATMAP_COLORS, dtype=float)
+        colors = (low + level*(high - low)).astype(np.uint8)
+        colors[counts == 0] = COLOR_KEY
+        #surfarray indexes surfaces by column first
+        heatmap = pygame.surfarray.make_surface(colors.transpose(1, 0, 2))
+        heatmap.set_colorkey(COLOR_KEY)
+        screen.blit(background, (0, 0))
+        screen.blit(pygame.transform.scale(heatmap, (cols*cell, rows*cell)), (0, 0))
+        self.moved = False
+        self.drawn = []
+        self.draw(screen, background, sprites, blits)
+        #The next frame has to clear the heatmap as well
+        self.moved = True
+        return [screen.get_rect()]
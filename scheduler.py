@@ -0,0 +1,215 @@
+import copy, math, sys, time
+import numpy as np
+from creature import MAX_BOID_VELOCITY
+
+#Constants
+TARGET_FPS = 30
+#Fewest boids updated each tick by rotation, as a fraction of the flock, so every boid is updated now and then
+MIN_FRACTION = 0.05
+#Weight of the newest tick in the moving averages of the measured costs
+SMOOTHING = 0.2
+
+
+class UpdateScheduler(object):
+
+    def __init__(self, target_fps=TARGET_FPS, fraction=None, min_fraction=MIN_FRACTION):
+        '''
+        Decides which boids get a new velocity in a tick. Boids barely turn from one tick to the next, so at high
+        counts only a rotating share of the flock is updated each tick, and the rest keep the velocity they have.
+        Every boid is still moved every tick. Boids steering away from a predator or an obstacle are updated every
+        tick, since they are the ones turning sharply. Predators are always updated by the world.
+        If fraction is given, that share of the flock is updated each tick. Otherwise the share is sized from the
+        measured cost of the ticks, to keep a step and the frame_cost of drawing it within 1/target_fps seconds.
+        Sizing from measurements makes runs depend on the speed of the machine, so use a fixed fraction for seeded
+        runs that have to be repeated. The share never goes below min_fraction.
+        '''
+        self.target_fps = target_fps
+        self.fixed_fraction = fraction
+        self.min_fraction = min_fraction
+        self.fraction = 1.0 if fraction is None else fraction
+        self.frame_cost = 0.0
+        self.boid_cost = None
+        self.other_cost = None
+        self.cursor = 0
+        self.ticks = 0
+        self.updated_at = np.zeros(0, dtype=np.int64)
+        self.updated = 0
+        self.update_seconds = 0.0
+        self.totals = {'updated': 0, 'priority': 0, 'staleness': 0.0}
+        self.staleness = {'mean': 0.0, 'p95': 0, 'max': 0}
+        self.max_staleness = 0
+
+    def get_priority(self, flock):
+        '''
+        Indices of the boids steering away from a predator or an obstacle this tick. Predators and obstacles are
+        few, so the boids close enough to see them are found around all of them with one query of the world's grid.
+        Of these, a predator is a threat to the boids that have it in sight, like in Flock.calc_predator_force, and
+        an obstacle to the boids the flock's obstacle rule steers away from it.
+        '''
+        world = flock.world
+        reach = flock.sights.max() + flock.radii.max()
+        nr_of_predators = len(world.predator_positions)
+        centers = np.concatenate((world.predator_positions, world.obstacle_positions))
+        radii = np.concatenate((np.full(nr_of_predators, reach), reach + world.obstacle_radii))
+        k, j = world.grid.query_points(centers, radii)
+        predator = k < nr_of_predators
+        diff = world.get_difference(flock.positions[j[predator]], centers[k[predator]])
+        seen = j[predator][np.hypot(diff[:, 0], diff[:, 1]) < flock.sights[j[predator]]]
+        near = np.unique(j[~predator])
+        avoiding = near[np.abs(flock.calc_obstacle_force(near)).any(axis=1)]
+        return np.union1d(seen, avoiding)
+
+    def select(self, flock):
+        '''
+        Indices of the boids to update this tick, in order: the priority boids, new boids and the next boids in the
+        rotation.
+        Also records how many ticks old the velocity of every boid is once the selected ones are updated.
+        '''
+        n = len(flock)
+        if len(self.updated_at) != n:
+            #New boids have never been updated, and get a velocity from the flock rules on their first tick
+            self.updated_at = np.concatenate((self.updated_at[:n], np.full(max(n - len(self.updated_at), 0), -1)))
+        count = int(math.ceil(self.fraction*n))
+        if count >= n:
+            indices = np.arange(n)
+            priority = indices[:0]
+        else:
+            priority = np.union1d(self.get_priority(flock), np.flatnonzero(self.updated_at < 0))
+            count = max(count - len(priority), int(math.ceil(self.min_fraction*n)), 1)
+            rotation = (self.cursor + np.arange(min(count, n))) % n
+            self.cursor = (self.cursor + count) % n
+            indices = np.union1d(priority, rotation)
+        self.updated_at[indices] = self.ticks
+        staleness = self.ticks - self.updated_at
+        self.staleness = {'mean': float(staleness.mean()) if n else 0.0,
+                          'p95': int(np.searchsorted(np.cumsum(np.bincount(staleness)), 0.95*n)) if n else 0,
+                          'max': int(staleness.max()) if n else 0}
+        self.max_staleness = max(self.max_staleness, self.staleness['max'])
+        self.totals['updated'] += len(indices)
+        self.totals['priority'] += len(priority)
+        self.totals['staleness'] += self.staleness['mean']
+        stats = flock.world.stats
+        stats.count('velocities_updated', len(indices))
+        stats.count('priority_updated', len(priority))
+        stats.count('staleness_mean', self.staleness['mean'])
+        stats.count('staleness_max', self.staleness['max'])
+        return indices
+
+    def record_update(self, count, seconds):
+        '''
+        Called by the flock with the time it took to update count boids.
+        '''
+        self.updated = count
+        self.update_seconds = seconds
+
+    def set_frame_cost(self, seconds):
+        '''
+        The time spent drawing a frame besides stepping the world, which the steps have to leave room for.
+        '''
+        self.frame_cost = seconds
+
+    def end_tick(self, seconds):
+        '''
+        Called by the world with the time of the whole step. The cost of a step is modeled as a cost per updated
+        boid plus the cost of everything else, both averaged over the recent ticks, and the share of the flock
+        for the next tick is the one whose step fits in the time a frame has left.
+        '''
+        self.ticks += 1
+        if self.fixed_fraction is not None or self.updated == 0:
+            return
+        boid_cost = self.update_seconds/self.updated
+        other_cost = max(seconds - self.update_seconds, 0.0)
+        if self.boid_cost is None:
+            self.boid_cost, self.other_cost = boid_cost, other_cost
+        else:
+            self.boid_cost += SMOOTHING*(boid_cost - self.boid_cost)
+            self.other_cost += SMOOTHING*(other_cost - self.other_cost)
+        budget = 1.0/self.target_fps - self.frame_cost - self.other_cost
+        n = len(self.updated_at)
+        fraction = budget/(self.boid_cost*n) if self.boid_cost > 0 and n else 1.0
+        self.fraction = min(max(fraction, self.min_fraction), 1.0)
+
+    def summary(self):
+        '''
+        The share of the flock updated by the last tick, and since the scheduler was set, the mean number of boids
+        updated and of them updated for being near a threat per tick, and the mean and largest staleness, the
+        number of ticks since a boid's velocity was updated. The 95th percentile staleness is of the last tick.
+        '''
+        ticks = max(self.ticks, 1)
+        return {'fraction': self.fraction, 'updated_per_tick': self.totals['updated']/ticks,
+                'priority_per_tick': self.totals['priority']/ticks,
+                'mean_staleness': self.totals['staleness']/ticks, 'p95_staleness': self.staleness['p95'],
+                'max_staleness': self.max_staleness}
+
+
+def get_velocity_error(world):
+    '''
+    Runs the velocity update of the next tick once as scheduled and once for every boid, from the same state, and
+    returns the mean difference of the two velocities relative to MAX_BOID_VELOCITY, and the mean difference of
+    their headings in degrees. The world is left as it was.
+    '''
+    flock = world.flock
+    names = ('positions', 'previous_positions', 'velocities', 'prev_velocities')
+    saved = [getattr(flock, name).copy() for name in names]
+    rng_state, salt, scheduler = world.rng.bit_generator.state, flock.salt, flock.scheduler
+    world.grid.rebuild(flock.positions)
+    world.update_obstacle_index()
+    world.update_predator_index()
+    results = []
+    for trial in (copy.deepcopy(scheduler), None):
+        world.rng.bit_generator.state = rng_state
+        flock.scheduler = trial
+        flock.update_velocities()
+        results.append(flock.velocities.copy())
+        for name, array in zip(names, saved):
+            setattr(flock, name, array.copy())
+    world.rng.bit_generator.state, flock.salt, flock.scheduler = rng_state, salt, scheduler
+    scheduled, full = results
+    error = np.hypot(*(scheduled - full).T).mean()/MAX_BOID_VELOCITY
+    turn = np.arctan2(scheduled[:, 1], scheduled[:, 0]) - np.arctan2(full[:, 1], full[:, 0])
+    turn = np.abs((turn + math.pi) % (2*math.pi) - math.pi)
+    return float(error), float(np.degrees(turn).mean())
+
+
+def benchmark(fractions=(1.0, 0.5, 0.25, 0.1), target_fps=TARGET_FPS, nr_of_boids=10000, size=(4000, 3000),
+              ticks=40, seed=1):
+    '''
+    Steps the same seeded world with each fixed fraction, and with the fraction sized for target_fps. Returns
+    the ticks per second, the scheduler summary and the mean velocity error of each, measured every tenth tick
+    with get_velocity_error.
+    '''
+    from world import World
+    results = {}
+    for fraction in tuple(fractions) + (None,):
+        world = World(size[0], size[1], 20, 20, 50, 100, seed=seed)
+        world.populate(nr_of_boids)
+        for i in range(20):
+            world.add_obstacle((world.random.randrange(size[0]), world.random.randrange(size[1])))
+        for i in range(5):
+            world.add_predator((world.random.randrange(size[0]), world.random.randrange(size[1])))
+        scheduler = UpdateScheduler(target_fps, fraction)
+        world.set_scheduler(scheduler)
+        errors = []
+        elapsed = 0.0
+        for tick in range(ticks):
+            if tick % 10 == 9:
+                errors.append(get_velocity_error(world))
+            start = time.perf_counter()
+            world.step(world.time_step)
+            elapsed += time.perf_counter() - start
+        world.close()
+        result = scheduler.summary()
+        result['ticks_per_second'] = ticks/elapsed
+        result['velocity_error'], result['heading_error'] = np.mean(errors, axis=0)
+        results['target %d fps' % target_fps if fraction is None else 'fraction %.2f' % fraction] = result
+    return results
+
+
+if __name__ == '__main__':
+    nr_of_boids = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, result in benchmark(nr_of_boids=nr_of_boids).items():
+        print("%-14s ticks/sec: %5.1f  updated: %6.0f  near threats: %5.0f  staleness mean: %4.1f  p95: %3.0f  "
+              "max: %3d  velocity error: %5.1f%%  heading error: %4.1f deg"
+              % (name, result['ticks_per_second'], result['updated_per_tick'], result['priority_per_tick'],
+                 result['mean_staleness'], result['p95_staleness'], result['max_staleness'],
+                 result['velocity_error']*100, result['heading_error']))
@@ -0,0 +1,720 @@
+import math
+import numpy as np
+from instrumentation import NULL_STATS
+
+#Worlds with more cells than this use a SparseSpatialHash
+MAX_DENSE_CELLS = 2**16
+#The top level of an AggregatePyramid has at most this many nodes
+MAX_TOP_NODES = 4
+
+
+def create_spatial_hash(width, height, cell_size, periodic=True):
+    '''
+    Returns a SpatialHash for a world of the given size, or a SparseSpatialHash if the world has more than
+    MAX_DENSE_CELLS cells. Both answer the same queries.
+    '''
+    cols = max(1, int(width // cell_size))
+    rows = max(1, int(height // cell_size))
+    if cols*rows > MAX_DENSE_CELLS:
+        return SparseSpatialHash(width, height, cell_size, periodic)
+    return SpatialHash(width, height, cell_size, periodic)
+
+
+class SpatialHash(object):
+
+    def __init__(self, width, height, cell_size, periodic=True):
+        '''
+        The SpatialHash is a structure to efficiently retrieve local neighborhoods. The 2D world is split into a
+        coarse grid of cells at least cell_size wide. Instead of keeping a container per cell, all points are sorted
+        by cell into flat integer arrays once per tick, and each cell is described by an offset (cell_start) and a
+        length (cell_count) into the sorted order. If periodic is set, the world wraps around in both directions,
+        like the creature positions do.
+        '''
+        self.width = float(width)
+        self.height = float(height)
+        self.periodic = periodic
+        self.cell_size = cell_size
+        self.cols = max(1, int(width // cell_size))
+        self.rows = max(1, int(height // cell_size))
+        self.cell_width = self.width/self.cols
+        self.cell_height = self.height/self.rows
+        self.size = np.array([self.width, self.height])
+        nr_of_cells = self.cols*self.rows
+        #A stable argsort of 16 bit integers is a radix sort in numpy, which makes the rebuild linear
+        self.cell_dtype = np.uint16 if nr_of_cells <= np.iinfo(np.uint16).max else np.intp
+        self.stats = NULL_STATS
+        self.rebuild(np.zeros((0, 2)))
+
+    def __len__(self):
+        return len(self.order)
+
+    def get_cells(self, positions):
+        '''
+        Returns the column and row of the cell each position belongs to.
+        '''
+        cx = (positions[:, 0] // self.cell_width).astype(np.intp)
+        cy = (positions[:, 1] // self.cell_height).astype(np.intp)
+        if self.periodic:
+            return cx % self.cols, cy % self.rows
+        return np.clip(cx, 0, self.cols - 1), np.clip(cy, 0, self.rows - 1)
+
+    def rebuild(self, positions):
+        '''
+        Assigns every position to a cell and sorts the points by cell. Should be called once per tick, after the
+        points have moved. The sorted coordinates are stored as well, so neighborhood queries read contiguous memory.
+        '''
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        cx, cy = self.get_cells(positions)
+        cells = (cy*self.cols + cx).astype(self.cell_dtype)
+        self.order = np.argsort(cells, kind='stable')
+        self.cell_count = np.bincount(cells, minlength=self.cols*self.rows)
+        self.cell_start = np.cumsum(self.cell_count) - self.cell_count
+        self.sorted_x = positions[self.order, 0]
+        self.sorted_y = positions[self.order, 1]
+
+    def get_cell_ranges(self, cells):
+        '''
+        Returns the offset into the sorted order and the number of points of each cell in cells.
+        '''
+        return self.cell_start[cells], self.cell_count[cells]
+
+    def difference(self, a, b):
+        '''
+        The vector from b to a. In a periodic world the shortest vector across the boundaries is used.
+        '''
+        diff = np.asarray(a, dtype=float) - b
+        if self.periodic:
+            #In place, since the vectors can be every pair of the flock
+            wrap = diff/self.size
+            np.round(wrap, out=wrap)
+            wrap *= self.size
+            diff -= wrap
+        return diff
+
+    def get_cell_offsets(self, radius):
+        '''
+        Returns the column and row offsets of the square block of cells that has to be searched to find every point
+        inside radius. The block is symmetric around the center cell. If the block is wider than the world, each
+        column or row is only included once.
+        '''
+        rx = int(math.ceil(radius/self.cell_width))
+        ry = int(math.ceil(radius/self.cell_height))
+        if self.periodic and 2*rx + 1 >= self.cols:
+            dx = np.arange(self.cols)
+        else:
+            dx = np.arange(-rx, rx + 1)
+        if self.periodic and 2*ry + 1 >= self.rows:
+            dy = np.arange(self.rows)
+        else:
+            dy = np.arange(-ry, ry + 1)
+        return dx, dy
+
+    def query_radius(self, point, radius):
+        '''
+        Returns the indices of all points inside radius of a single point. This is the per object query, used when a
+        single creature ask for its neighborhood.
+        '''
+        cx, cy = self.get_cells(np.asarray(point, dtype=float).reshape(1, 2))
+        dx, dy = self.get_cell_offsets(radius)
+        xs = cx[0] + dx
+        ys = cy[0] + dy
+        if self.periodic:
+            xs %= self.cols
+            ys %= self.rows
+        else:
+            xs = xs[(xs >= 0) & (xs < self.cols)]
+            ys = ys[(ys >= 0) & (ys < self.rows)]
+        self.stats.count('grid_cells_scanned', len(dx)*len(dy))
+        start, count = self.get_cell_ranges((ys[:, None]*self.cols + xs[None, :]).ravel())
+        total = count.sum()
+        if total == 0:
+            return np.zeros(0, dtype=np.intp)
+        slots = np.arange(total) + np.repeat(start - (np.cumsum(count) - count), count)
+        self.stats.count('neighbors_visited', len(slots))
+        diff = self.difference(point, np.stack((self.sorted_x[slots], self.sorted_y[slots]), axis=1))
+        inside = diff[:, 0]**2 + diff[:, 1]**2 < radius**2
+        return self.order[slots[inside]]
+
+    def query_rect(self, x, y, width, height):
+        '''
+        Returns the indices of the stored points inside the rectangle with the top left corner (x, y), as they were
+        at the last rebuild. In a periodic world the rectangle wraps around the edges. Only the cells the rectangle
+        covers are visited, so the cost depends on the points inside it and not on the rest of the world.
+        '''
+        xs = np.arange(int(x // self.cell_width), int((x + width) // self.cell_width) + 1)
+        ys = np.arange(int(y // self.cell_height), int((y + height) // self.cell_height) + 1)
+        if self.periodic:
+            xs = np.arange(self.cols) if len(xs) >= self.cols else xs % self.cols
+            ys = np.arange(self.rows) if len(ys) >= self.rows else ys % self.rows
+        else:
+            xs = xs[(xs >= 0) & (xs < self.cols)]
+            ys = ys[(ys >= 0) & (ys < self.rows)]
+        self.stats.count('grid_cells_scanned', len(xs)*len(ys))
+        start, count = self.get_cell_ranges((ys[:, None]*self.cols + xs[None, :]).ravel())
+        total = count.sum()
+        if total == 0:
+            return np.zeros(0, dtype=np.intp)
+        slots = np.arange(total) + np.repeat(start - (np.cumsum(count) - count), count)
+        dx = self.sorted_x[slots] - x
+        dy = self.sorted_y[slots] - y
+        if self.periodic:
+            dx %= self.width
+            dy %= self.height
+        inside = (dx >= 0) & (dx < width) & (dy >= 0) & (dy < height)
+        return self.order[slots[inside]]
+
+    def query_points(self, points, radius):
+        '''
+        Vectorized query for many points at once. Returns two index arrays (i, j), one entry for each stored point j
+        inside radius of query point i. radius can be a single number or one radius per query point. In a periodic
+        world the query points may lie outside it, they are wrapped first.
+        '''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if self.periodic:
+            points = np.mod(points, self.size)
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(points),))
+        if len(points) == 0 or len(self) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        cx, cy = self.get_cells(points)
+        ids = np.arange(len(points))
+        dx, dy = self.get_cell_offsets(radius.max())
+        x = np.ascontiguousarray(points[:, 0])
+        y = np.ascontiguousarray(points[:, 1])
+        #With one radius for every point, the pairs are compared to one number instead of a gathered radius each
+        uniform = radius.min() == radius.max()
+        radius2 = radius[0]**2 if uniform else radius**2
+
+        #When the search block covers the whole world along an axis, the cell offset does not tell which image of a
+        #point is closest, so the shortest difference has to be found for every pair
+        round_x = self.periodic and len(dx) == self.cols
+        round_y = self.periodic and len(dy) == self.rows
+        self.stats.count('grid_cells_scanned', len(dx)*len(dy)*len(points))
+        pairs_i = []
+        pairs_j = []
+        for j in dy:
+            for i in dx:
+                nx = cx + i
+                ny = cy + j
+                qx = x
+                qy = y
+                if self.periodic:
+                    #Shift the query points by one world size when the cell is found across a wrapping edge
+                    qx = x - (nx // self.cols)*self.width
+                    qy = y - (ny // self.rows)*self.height
+                    nx = nx % self.cols
+                    ny = ny % self.rows
+                    valid = slice(None)
+                else:
+                    valid = (nx >= 0) & (nx < self.cols) & (ny >= 0) & (ny < self.rows)
+                src = ids[valid]
+                start, n_other = self.get_cell_ranges(ny[valid]*self.cols + nx[valid])
+                occupied = n_other > 0
+                src = src[occupied]
+                start = start[occupied]
+                n_other = n_other[occupied]
+                total = n_other.sum()
+                if total == 0:
+                    continue
+                self.stats.count('neighbors_visited', total)
+                #Expand each (point, cell) pair into one row per stored point in that cell
+                first = np.cumsum(n_other) - n_other
+                slots = np.arange(total) + np.repeat(start - first, n_other)
+                diff_x = np.repeat(qx[src], n_other) - self.sorted_x[slots]
+                diff_y = np.repeat(qy[src], n_other) - self.sorted_y[slots]
+                if round_x:
+                    diff_x -= self.width*np.round(diff_x/self.width)
+                if round_y:
+                    diff_y -= self.height*np.round(diff_y/self.height)
+                rep_i = np.repeat(src, n_other)
+                #Gathering by the indices of the pairs inside is much faster than by the mask, which is mostly random
+                inside = np.flatnonzero(diff_x**2 + diff_y**2 < (radius2 if uniform else radius2[rep_i]))
+                pairs_i.append(rep_i[inside])
+                pairs_j.append(self.order[slots[inside]])
+        if not pairs_i:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+    def query_pairs(self, positions, indices, radius):
+        '''
+        Vectorized neighborhood query for stored points. positions must be the array the hash was rebuilt from.
+        Returns (i, j) pairs where stored point j is inside radius of stored point i, for each i in indices. A point
+        is never its own neighbor.
+        '''
+        indices = np.asarray(indices, dtype=np.intp)
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(positions),))[indices]
+        i, j = self.query_points(positions[indices], radius)
+        i = indices[i]
+        not_self = np.flatnonzero(i != j)
+        return i[not_self], j[not_self]
+
+
+class SparseSpatialHash(SpatialHash):
+
+    def __init__(self, width, height, cell_size, periodic=True):
+        '''
+        A SpatialHash that only stores the occupied cells, for worlds far larger than the area the points cover.
+        Cells are numbered like in the SpatialHash, but instead of an offset and a length for every cell of the
+        world, the numbers of the occupied cells are kept sorted, and a cell is looked up by binary search. Memory
+        and rebuild time are proportional to the number of points, and empty space costs nothing.
+        '''
+        super(SparseSpatialHash, self).__init__(width, height, cell_size, periodic)
+
+    def rebuild(self, positions):
+        '''
+        Sorts the points by cell, and keeps the number, offset and length of each occupied cell.
+        '''
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        cx, cy = self.get_cells(positions)
+        cells = cy.astype(np.int64)*self.cols + cx
+        self.order = np.argsort(cells, kind='stable')
+        self.occupied, self.cell_start, self.cell_count = np.unique(cells[self.order], return_index=True,
+                                                                    return_counts=True)
+        self.sorted_x = positions[self.order, 0]
+        self.sorted_y = positions[self.order, 1]
+
+    def get_cell_ranges(self, cells):
+        '''
+        Returns the offset into the sorted order and the number of points of each cell in cells. Empty cells have
+        no points.
+        '''
+        if len(self.occupied) == 0:
+            return np.zeros(len(cells), dtype=np.intp), np.zeros(len(cells), dtype=np.intp)
+        found = np.minimum(np.searchsorted(self.occupied, cells), len(self.occupied) - 1)
+        hit = self.occupied[found] == cells
+        return self.cell_start[found], np.where(hit, self.cell_count[found], 0)
+
+
+class AggregatePyramid(object):
+
+    def __init__(self, grid):
+        '''
+        Per cell aggregates of the points of a SpatialHash, for Barnes-Hut style sums over large neighborhoods.
+        Level 0 holds the cells of the grid, and every level above merges blocks of 2x2 nodes of the level below,
+        until a level has at most MAX_TOP_NODES nodes. Each level keeps the numbers of its occupied nodes sorted,
+        like the SparseSpatialHash, with the number of points, the sum of their positions and the sum of a value
+        per point, like the velocity, for each. It must be rebuilt after the grid, from the same positions.
+        '''
+        self.grid = grid
+        self.stats = NULL_STATS
+        self.rebuild(np.zeros((0, 2)), np.zeros((0, 2)))
+
+    def rebuild(self, positions, values):
+        '''
+        Sums the points into the cells, and the cells into the levels above. Only the cells are built from the
+        points, each level above is summed from the nodes of the level below. The rectangle and the center of
+        mass of every node are kept for the queries. A level with at most MAX_DENSE_CELLS nodes is summed with
+        np.bincount over the node numbers, only a larger one has to sort them to find the occupied nodes.
+        '''
+        grid = self.grid
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self.values = np.asarray(values, dtype=float).reshape(-1, 2)
+        self.cx, self.cy = grid.get_cells(self.positions)
+        nodes = self.cy.astype(np.int64)*grid.cols + self.cx
+        weights = np.column_stack((np.ones(len(nodes)), self.positions, self.values))
+        cols, rows = grid.cols, grid.rows
+        node_width, node_height = grid.cell_width, grid.cell_height
+        self.levels = []
+        while True:
+            if cols*rows <= MAX_DENSE_CELLS:
+                sums = np.stack([np.bincount(nodes, weights=column, minlength=cols*rows) for column in weights.T],
+                                axis=1)
+                occupied = np.flatnonzero(sums[:, 0])
+                sums = sums[occupied]
+            else:
+                occupied, inverse = np.unique(nodes, return_inverse=True)
+                sums = np.stack([np.bincount(inverse.ravel(), weights=column, minlength=len(occupied))
+                                 for column in weights.T], axis=1)
+            #Nodes at the right and bottom edges can be smaller than the others
+            x0 = occupied % cols*node_width
+            y0 = occupied // cols*node_height
+            half = np.stack((np.minimum(node_width, grid.width - x0), np.minimum(node_height, grid.height - y0)),
+                            axis=1)/2
+            self.levels.append({'cols': cols, 'rows': rows, 'nodes': occupied, 'sums': sums,
+                                'centers': np.stack((x0, y0), axis=1) + half, 'half': half,
+                                'size': 2*half.max(axis=1), 'mass_centers': sums[:, 1:3]/sums[:, 0:1]})
+            if cols*rows <= MAX_TOP_NODES:
+                break
+            x, y = occupied % cols, occupied // cols
+            cols, rows = (cols + 1)//2, (rows + 1)//2
+            node_width, node_height = 2*node_width, 2*node_height
+            nodes = (y//2)*cols + x//2
+            weights = sums
+
+    def get_children(self, level, rows):
+        '''
+        The occupied children of the nodes in rows of a level, as (parent, child) pairs of rows into the node
+        arrays of the two levels.
+        '''
+        parent = self.levels[level]
+        child = self.levels[level - 1]
+        nodes = parent['nodes'][rows]
+        x = nodes % parent['cols']*2
+        y = nodes // parent['cols']*2
+        parents = []
+        children = []
+        for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            valid = np.flatnonzero((x + dx < child['cols']) & (y + dy < child['rows']))
+            numbers = (y[valid] + dy)*child['cols'] + x[valid] + dx
+            found = np.minimum(np.searchsorted(child['nodes'], numbers), len(child['nodes']) - 1)
+            hit = child['nodes'][found] == numbers
+            parents.append(valid[hit])
+            children.append(found[hit])
+        return np.concatenate(parents), np.concatenate(children)
+
+    def query_sums(self, points, radius, theta, exclude=None):
+        '''
+        Approximate sums over the stored points inside radius of each query point: the number of points, the sum
+        of the vectors from the query point to them, and the sum of their values. The pyramid is walked down from
+        the top level. A node entirely inside the radius is taken whole, and one entirely outside it is skipped. A
+        node crossing the edge of the radius is opened, unless it is at most theta times the radius wide, then it
+        is taken whole if its center of mass is inside the radius, and skipped if not. Opened cells of level 0 are
+        resolved point by point, so theta 0 gives the exact sums. exclude gives a stored point to leave out for
+        each query point, like the query point itself, or -1. radius can be one number or one per query point.
+        Returns the counts, the offset sums and the value sums.
+        '''
+        grid = self.grid
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        n = len(points)
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), (n,))
+        radius2 = radius**2
+        reach = theta*radius
+        exclude = np.full(n, -1, dtype=np.intp) if exclude is None else np.asarray(exclude, dtype=np.intp)
+        totals = np.zeros((n, 5))
+        if n == 0 or len(self.positions) == 0:
+            return totals[:, 0], totals[:, 1:3], totals[:, 3:5]
+        top = len(self.levels) - 1
+        top_nodes = len(self.levels[top]['nodes'])
+        q = np.repeat(np.arange(n), top_nodes)
+        rows = np.tile(np.arange(top_nodes), n)
+        for level in range(top, -1, -1):
+            nodes = self.levels[level]
+            self.stats.count('aggregate_nodes_visited', len(q))
+            diff = np.abs(grid.difference(nodes['centers'][rows], points[q]))
+            half = nodes['half'][rows]
+            near = np.maximum(diff - half, 0.0)
+            far = diff + half
+            r2 = radius2[q]
+            inside = far[:, 0]**2 + far[:, 1]**2 < r2
+            crossing = (near[:, 0]**2 + near[:, 1]**2 < r2) & ~inside
+            small = crossing & (nodes['size'][rows] <= reach[q])
+            take = inside | small
+            taken = q[take]
+            offsets = grid.difference(nodes['mass_centers'][rows[take]], points[taken])
+            #A small crossing node is only taken if its center of mass is inside the radius
+            keep = inside[take] | (offsets[:, 0]**2 + offsets[:, 1]**2 < r2[take])
+            taken = taken[keep]
+            taken_rows = rows[take][keep]
+            self.add_nodes(totals, taken, nodes['sums'][taken_rows], offsets[keep])
+            self.remove_excluded(totals, points, exclude, level, taken, nodes['nodes'][taken_rows])
+            opened = crossing & ~small
+            if level == 0:
+                self.add_points(totals, points, radius2, exclude, q[opened], nodes['nodes'][rows[opened]])
+                break
+            parents, rows = self.get_children(level, rows[opened])
+            q = q[opened][parents]
+        return totals[:, 0], totals[:, 1:3], totals[:, 3:5]
+
+    def remove_excluded(self, totals, points, exclude, level, q, nodes):
+        '''
+        Takes the excluded point of each query point in q back out, if it was in the node taken whole for it. The
+        point is in the node if its cell is in the node's block of cells.
+        '''
+        e = exclude[q]
+        cols = self.levels[level]['cols']
+        holds = (e >= 0) & ((self.cy[e] >> level).astype(np.int64)*cols + (self.cx[e] >> level) == nodes)
+        if holds.any():
+            q = q[holds]
+            e = e[holds]
+            own = np.column_stack((-np.ones(len(e)), self.positions[e], -self.values[e]))
+            self.add_nodes(totals, q, own, self.grid.difference(self.positions[e], points[q]))
+
+    @staticmethod
+    def add_nodes(totals, q, sums, offsets):
+        '''
+        Adds nodes taken whole to the totals of the query points q. The offset of a node is the vector from the
+        query point to its center of mass, so the offset sum grows by the number of points times the offset.
+        '''
+        n = len(totals)
+        totals[:, 0] += np.bincount(q, weights=sums[:, 0], minlength=n)
+        for column in range(2):
+            totals[:, 1 + column] += np.bincount(q, weights=sums[:, 0]*offsets[:, column], minlength=n)
+            totals[:, 3 + column] += np.bincount(q, weights=sums[:, 3 + column], minlength=n)
+
+    def add_points(self, totals, points, radius2, exclude, q, cells):
+        '''
+        Adds the points inside the radius in the opened cells to the totals of the query points q, one by one.
+        '''
+        grid = self.grid
+        start, count = grid.get_cell_ranges(cells)
+        total = count.sum()
+        if total == 0:
+            return
+        self.stats.count('neighbors_visited', total)
+        slots = np.arange(total) + np.repeat(start - (np.cumsum(count) - count), count)
+        q = np.repeat(q, count)
+        j = grid.order[slots]
+        offsets = grid.difference(self.positions[j], points[q])
+        inside = (offsets[:, 0]**2 + offsets[:, 1]**2 < radius2[q]) & (j != exclude[q])
+        q = q[inside]
+        j = j[inside]
+        sums = np.column_stack((np.ones(len(j)), self.positions[j], self.values[j]))
+        self.add_nodes(totals, q, sums, offsets[inside])
+
+
+class BatchSpatialHash(object):
+
+    def __init__(self, sizes, cell_size):
+        '''
+        A SpatialHash for points spread over many independent periodic worlds of different sizes. Every world is
+        split into its own grid of cells, and the cells of all worlds are numbered one world after the other, so a
+        single sort by cell groups the points by world and by cell at the same time. Each point has a world, and
+        is only ever a neighbor of points in the same world, wrapping around the edges of that world.
+        '''
+        self.sizes = np.asarray(sizes, dtype=float).reshape(-1, 2)
+        self.cell_size = cell_size
+        self.cols = np.maximum(1, (self.sizes[:, 0] // cell_size).astype(np.intp))
+        self.rows = np.maximum(1, (self.sizes[:, 1] // cell_size).astype(np.intp))
+        self.cell_width = self.sizes[:, 0]/self.cols
+        self.cell_height = self.sizes[:, 1]/self.rows
+        cells_per_world = self.cols*self.rows
+        self.cell_offset = np.cumsum(cells_per_world) - cells_per_world
+        nr_of_cells = int(cells_per_world.sum())
+        self.nr_of_cells = nr_of_cells
+        self.cell_dtype = np.uint16 if nr_of_cells <= np.iinfo(np.uint16).max else np.intp
+        self.stats = NULL_STATS
+        self.rebuild(np.zeros((0, 2)), np.zeros(0, dtype=np.intp))
+
+    def __len__(self):
+        return len(self.order)
+
+    def get_cells(self, positions, worlds):
+        '''
+        Returns the column and row of the cell each position belongs to, in the grid of its own world.
+        '''
+        cx = (positions[:, 0] // self.cell_width[worlds]).astype(np.intp) % self.cols[worlds]
+        cy = (positions[:, 1] // self.cell_height[worlds]).astype(np.intp) % self.rows[worlds]
+        return cx, cy
+
+    def rebuild(self, positions, worlds):
+        '''
+        Assigns every position to a cell of its world and sorts the points by cell. See SpatialHash.rebuild.
+        '''
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        worlds = np.asarray(worlds, dtype=np.intp)
+        cx, cy = self.get_cells(positions, worlds)
+        cells = (self.cell_offset[worlds] + cy*self.cols[worlds] + cx).astype(self.cell_dtype)
+        self.order = np.argsort(cells, kind='stable')
+        self.cell_count = np.bincount(cells, minlength=self.nr_of_cells)
+        self.cell_start = np.cumsum(self.cell_count) - self.cell_count
+        self.sorted_x = positions[self.order, 0]
+        self.sorted_y = positions[self.order, 1]
+
+    def difference(self, a, b, worlds):
+        '''
+        The shortest vector from b to a across the edges of the world of each row.
+        '''
+        size = self.sizes[worlds]
+        diff = np.asarray(a, dtype=float) - b
+        return diff - size*np.round(diff/size)
+
+    def get_offset_ranges(self, radius, cols, cell_width):
+        '''
+        For each world, the lowest and highest cell offset along one axis that has to be searched to find every
+        point inside radius, and whether the block covers the whole world. Like SpatialHash.get_cell_offsets, a
+        block wider than the world includes each column only once.
+        '''
+        r = np.ceil(radius/cell_width).astype(np.intp)
+        full = 2*r + 1 >= cols
+        low = np.where(full, 0, -r)
+        high = np.where(full, cols - 1, r)
+        return low, high, full
+
+    def query_points(self, points, worlds, radius):
+        '''
+        Vectorized query for many points at once, each in the world given by worlds. Returns two index arrays
+        (i, j), one entry for each stored point j in the same world inside radius of query point i. radius can be a
+        single number or one radius per query point. Works like SpatialHash.query_points, but the cell offsets
+        searched and the wrapping depend on the world of each point.
+        '''
+        worlds = np.asarray(worlds, dtype=np.intp)
+        points = np.mod(np.asarray(points, dtype=float).reshape(-1, 2), self.sizes[worlds])
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(points),))
+        if len(points) == 0 or len(self) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        low_x, high_x, full_x = self.get_offset_ranges(radius.max(), self.cols, self.cell_width)
+        low_y, high_y, full_y = self.get_offset_ranges(radius.max(), self.rows, self.cell_height)
+        cx, cy = self.get_cells(points, worlds)
+        cols = self.cols[worlds]
+        rows = self.rows[worlds]
+        width = self.sizes[worlds, 0]
+        height = self.sizes[worlds, 1]
+        offset = self.cell_offset[worlds]
+        x = np.ascontiguousarray(points[:, 0])
+        y = np.ascontiguousarray(points[:, 1])
+        radius2 = radius**2
+        #Query points in worlds where the search block covers the whole world need the shortest difference per pair
+        round_x = full_x[worlds]
+        round_y = full_y[worlds]
+        any_round = round_x.any() or round_y.any()
+        point_low_x, point_high_x = low_x[worlds], high_x[worlds]
+        point_low_y, point_high_y = low_y[worlds], high_y[worlds]
+        ids = np.arange(len(points))
+        pairs_i = []
+        pairs_j = []
+        for j in range(int(low_y.min()), int(high_y.max()) + 1):
+            in_y = (point_low_y <= j) & (j <= point_high_y)
+            for i in range(int(low_x.min()), int(high_x.max()) + 1):
+                valid = in_y & (point_low_x <= i) & (i <= point_high_x)
+                src = ids[valid]
+                if len(src) == 0:
+                    continue
+                self.stats.count('grid_cells_scanned', len(src))
+                nx = cx[src] + i
+                ny = cy[src] + j
+                #Shift the query points by one world size when the cell is found across a wrapping edge
+                qx = x[src] - (nx // cols[src])*width[src]
+                qy = y[src] - (ny // rows[src])*height[src]
+                other = offset[src] + (ny % rows[src])*cols[src] + nx % cols[src]
+                n_other = self.cell_count[other]
+                occupied = n_other > 0
+                src = src[occupied]
+                other = other[occupied]
+                qx = qx[occupied]
+                qy = qy[occupied]
+                n_other = n_other[occupied]
+                total = n_other.sum()
+                if total == 0:
+                    continue
+                self.stats.count('neighbors_visited', total)
+                first = np.cumsum(n_other) - n_other
+                slots = np.arange(total) + np.repeat(self.cell_start[other] - first, n_other)
+                rep_i = np.repeat(src, n_other)
+                diff_x = np.repeat(qx, n_other) - self.sorted_x[slots]
+                diff_y = np.repeat(qy, n_other) - self.sorted_y[slots]
+                if any_round:
+                    r = round_x[rep_i]
+                    w = width[rep_i[r]]
+                    diff_x[r] -= w*np.round(diff_x[r]/w)
+                    r = round_y[rep_i]
+                    h = height[rep_i[r]]
+                    diff_y[r] -= h*np.round(diff_y[r]/h)
+                inside = np.flatnonzero(diff_x**2 + diff_y**2 < radius2[rep_i])
+                pairs_i.append(rep_i[inside])
+                pairs_j.append(self.order[slots[inside]])
+        if not pairs_i:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+    def query_pairs(self, positions, worlds, indices, radius):
+        '''
+        Vectorized neighborhood query for stored points, like SpatialHash.query_pairs. positions and worlds must be
+        the arrays the hash was rebuilt from.
+        '''
+        indices = np.asarray(indices, dtype=np.intp)
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(positions),))[indices]
+        i, j = self.query_points(positions[indices], worlds[indices], radius)
+        i = indices[i]
+        not_self = np.flatnonzero(i != j)
+        return i[not_self], j[not_self]
+
+
+class NeighborList(object):
+
+    def __init__(self, grid, skin):
+        '''
+        A Verlet neighbor list for the points of a SpatialHash. Candidate pairs within the query radius plus skin
+        are found once, and later ticks only filter them by the current distances. As long as no point has moved
+        more than skin/2 since the build, two points inside radius of each other now were inside radius + skin at
+        the build, so the result is exact. The list is rebuilt when some point has moved further.
+        '''
+        self.grid = grid
+        self.skin = skin
+        self.stats = NULL_STATS
+        self.builds = 0
+        self.queries = 0
+        self.build_grid = None
+        self.invalidate()
+
+    def invalidate(self):
+        '''
+        Forces a rebuild on the next query, for example when points have been added.
+        '''
+        self.positions = None
+
+    def build(self, positions, radius):
+        '''
+        Finds the candidate pairs of every point within radius + skin. A grid with cells as wide as that is used,
+        so only the cells next to each point are searched. In a periodic world, the image of j closest to i does not
+        change while the list is used, as long as the world is wider than twice radius + skin, so the shift to that
+        image is stored with each pair.
+        '''
+        reach = radius.max() + self.skin
+        if self.build_grid is None or self.build_grid.cell_size != reach:
+            self.build_grid = create_spatial_hash(self.grid.width, self.grid.height, reach, self.grid.periodic)
+        self.build_grid.rebuild(positions)
+        self.i, self.j = self.build_grid.query_pairs(positions, np.arange(len(positions)), radius + self.skin)
+        self.positions = positions.copy()
+        self.shift_x = self.shift_y = 0.0
+        self.round_x = self.round_y = False
+        if self.grid.periodic:
+            self.round_x = self.grid.width <= 2*reach
+            self.round_y = self.grid.height <= 2*reach
+            self.shift_x = self.get_shift(positions[:, 0], self.grid.width)
+            self.shift_y = self.get_shift(positions[:, 1], self.grid.height)
+        self.builds += 1
+        self.stats.count('neighbor_list_rebuilds', 1)
+
+    def get_shift(self, x, size):
+        '''
+        The shift to the image of j closest to i along one axis, for every stored pair.
+        '''
+        diff = np.take(x, self.i) - np.take(x, self.j)
+        return size*np.round(diff/size)
+
+    def get_distances(self, x, shift, size, wrap):
+        '''
+        The squared difference of every stored pair along one axis, from the coordinates x continued from the build.
+        '''
+        diff = np.take(x, self.i)
+        diff -= np.take(x, self.j)
+        diff -= shift
+        if wrap:
+            diff -= size*np.round(diff/size)
+        diff *= diff
+        return diff
+
+    def query_pairs(self, positions, indices, radius):
+        '''
+        Same pairs as SpatialHash.query_pairs for the stored points in indices, read from the list, but not in the
+        same order. radius is one radius per point or a single number, and must be the same every tick.
+        '''
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(positions),))
+        moved = None
+        if self.positions is not None and len(self.positions) == len(positions):
+            moved = self.grid.difference(positions, self.positions)
+        if moved is None or (moved[:, 0]**2 + moved[:, 1]**2).max() > (self.skin/2)**2:
+            self.build(positions, radius)
+            moved = np.zeros_like(positions)
+        self.queries += 1
+        #Positions continued from the build without wrapping, so the shift of each pair stays valid
+        continued = self.positions + moved
+        i, j = self.i, self.j
+        distances = self.get_distances(continued[:, 0], self.shift_x, self.grid.width, self.round_x)
+        distances += self.get_distances(continued[:, 1], self.shift_y, self.grid.height, self.round_y)
+        #A single radius is compared as a number, instead of gathering it for every pair
+        if radius.min() == radius.max():
+            inside = np.flatnonzero(distances < radius[0]**2)
+        else:
+            inside = np.flatnonzero(distances < np.take(radius, i)**2)
+        if len(indices) != len(positions):
+            wanted = np.zeros(len(positions), dtype=bool)
+            wanted[indices] = True
+            inside = inside[wanted[np.take(i, inside)]]
+        self.stats.count('neighbors_visited', len(i))
+        return np.take(i, inside), np.take(j, inside)
+
+    def get_rebuild_rate(self):
+        '''
+        The fraction of queries that needed a rebuild.
+        '''
+        return self.builds/self.queries if self.queries else 0.0
@@ -0,0 +1,418 @@
+import argparse, asyncio, math, socket, struct, sys, time, zlib
+import numpy as np
+
+#Constants
+KEYFRAME_INTERVAL = 30
+#Bytes waiting in a client's send buffer before its frames are dropped
+MAX_CLIENT_BUFFER = 256*1024
+#Size of the kernel send buffer of a client's socket. Left to itself the kernel buffers megabytes, and a slow
+#client would be sent seconds old frames before its frames started to be dropped
+SOCKET_BUFFER = 64*1024
+#Seconds given to the clients to receive their last frames when the server closes
+CLOSE_TIMEOUT = 2.0
+#Positions are sent as multiples of this many pixels, or coarser in worlds too large for 16 bits
+POSITION_STEP = 1/4
+HEADING_STEPS = 256
+COMPRESSION_LEVEL = 1
+DEFAULT_PORT = 8765
+
+#Frame kinds. Keyframes hold absolute boid records, delta frames the change of the boids' motion since the
+#previous step, in 8 bit fields when every change fits and 16 bit fields when not
+KEYFRAME = 0
+DELTA8 = 1
+DELTA16 = 2
+
+#Frame header: kind, step, step the delta is from, boids, predators, obstacles, world width and height, and the
+#length of the compressed payload
+HEADER = struct.Struct('<BIIIHHffI')
+#Record layouts, as the numpy types of the x, y and heading fields
+RECORD_TYPES = {KEYFRAME: (np.uint16, np.uint16, np.uint8), DELTA8: (np.int8, np.int8, np.int8),
+                DELTA16: (np.int16, np.int16, np.int8)}
+
+
+def get_position_step(size):
+    '''
+    The quantization step of positions in a world of the given size, POSITION_STEP unless the world is wider than
+    16 bits of it.
+    '''
+    return max(POSITION_STEP, max(size)/2**16)
+
+
+def quantize(positions, velocities, size):
+    '''
+    Positions as unsigned 16 bit multiples of the position step of a world of the given size, and headings as one
+    of HEADING_STEPS directions in 8 bits.
+    '''
+    moduli = get_moduli(size)
+    q = np.floor(np.asarray(positions, dtype=float)/get_position_step(size)).astype(np.int64) % moduli[:2]
+    angles = np.arctan2(velocities[:, 1], velocities[:, 0]) if len(velocities) else np.zeros(0)
+    headings = np.round(angles/(2*math.pi)*HEADING_STEPS).astype(np.int64) % HEADING_STEPS
+    return q[:, 0].astype(np.uint16), q[:, 1].astype(np.uint16), headings.astype(np.uint8)
+
+
+def get_moduli(size):
+    '''
+    The values the x, y and heading fields wrap around at in a world of the given size, like the world wraps
+    around its edges.
+    '''
+    step = get_position_step(size)
+    return int(math.ceil(size[0]/step)), int(math.ceil(size[1]/step)), HEADING_STEPS
+
+
+def get_wrapped(fields, moduli):
+    '''
+    Differences of the x, y and heading fields wrapped into the signed range of each field, so a boid crossing an
+    edge moves a short way.
+    '''
+    return [(field + modulus//2) % modulus - modulus//2 for field, modulus in zip(fields, moduli)]
+
+
+def pack_records(kind, fields):
+    '''
+    Packs the x, y and heading fields into records and stores them byte plane by byte plane, all the first bytes
+    of x, then all the second bytes and so on. Small deltas then give long runs of equal bytes, which zlib packs
+    well.
+    '''
+    planes = [np.asarray(field).astype(dtype).view(np.uint8).reshape(len(field), np.dtype(dtype).itemsize).T
+              for field, dtype in zip(fields, RECORD_TYPES[kind])]
+    return np.ascontiguousarray(np.concatenate(planes)).tobytes()
+
+
+def unpack_records(kind, data, n):
+    '''
+    Reverses pack_records. Returns the x, y and heading fields of n records, and the bytes after them.
+    '''
+    fields = []
+    offset = 0
+    for dtype in RECORD_TYPES[kind]:
+        width = np.dtype(dtype).itemsize
+        planes = np.frombuffer(data, dtype=np.uint8, count=n*width, offset=offset).reshape(width, n)
+        fields.append(np.ascontiguousarray(planes.T).view(dtype).ravel())
+        offset += n*width
+    return fields, data[offset:]
+
+
+class FrameEncoder(object):
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        '''
+        Turns the state of a world into frames. The boids are quantized, and their motion is the change of the
+        quantized fields since the previous step. Boids turn slowly, so a delta frame only sends how much the motion
+        changed, which is mostly zero and compresses well. A keyframe holds the fields and the motion, and is sent
+        every keyframe_interval steps, or when the number of boids has changed. The few predators and obstacles are
+        always sent whole. A keyframe of the current step can also be asked for at any time, for clients joining or
+        recovering from dropped frames.
+        '''
+        self.keyframe_interval = keyframe_interval
+        self.state = None
+        self.motion = None
+        self.step = None
+        self.frames = 0
+        self.keyframe = None
+
+    def encode(self, world):
+        '''
+        Returns the frame for the current step of the world, a keyframe or a delta frame.
+        '''
+        size = world.get_size()
+        moduli = get_moduli(size)
+        flock = world.flock
+        predators = world.predators.sprites()
+        obstacles = world.obstacles.sprites()
+        boids = [field.astype(np.int64) for field in quantize(flock.positions, flock.velocities, size)]
+        others = quantize(np.array([p.pos for p in predators] + [o.pos for o in obstacles]).reshape(-1, 2),
+                          np.array([p.velocity for p in predators] + [(0.0, 0.0)]*len(obstacles)).reshape(-1, 2),
+                          size)
+        previous, previous_step, previous_motion = self.state, self.step, self.motion
+        key = (previous is None or self.frames % self.keyframe_interval == 0
+               or len(previous[0][0]) != len(boids[0]) or previous[4] != size)
+        if previous is None or len(previous[0][0]) != len(boids[0]) or previous[4] != size:
+            self.motion = [np.zeros(len(field), dtype=np.int64) for field in boids]
+        else:
+            self.motion = get_wrapped([b - a for a, b in zip(previous[0], boids)], moduli)
+        self.state = (boids, others, len(predators), len(obstacles), size)
+        self.step = world.steps
+        self.keyframe = None
+        self.frames += 1
+        if key:
+            return self.get_keyframe()
+        residuals = get_wrapped([m - p for m, p in zip(self.motion, previous_motion)], moduli)
+        small = all(len(r) == 0 or (r.min() >= -128 and r.max() <= 127) for r in residuals[:2])
+        kind = DELTA8 if small else DELTA16
+        return self.pack(kind, pack_records(kind, residuals), previous_step)
+
+    def get_keyframe(self):
+        '''
+        The keyframe of the last encoded step. It is only packed once per step, however many clients need it.
+        '''
+        if self.keyframe is None:
+            records = pack_records(KEYFRAME, self.state[0]) + pack_records(DELTA16, self.motion)
+            self.keyframe = self.pack(KEYFRAME, records, self.step)
+        return self.keyframe
+
+    def pack(self, kind, records, base_step):
+        boids, others, nr_of_predators, nr_of_obstacles, size = self.state
+        payload = zlib.compress(records + pack_records(KEYFRAME, others), COMPRESSION_LEVEL)
+        return HEADER.pack(kind, self.step, base_step, len(boids[0]), nr_of_predators, nr_of_obstacles,
+                           size[0], size[1], len(payload)) + payload
+
+
+class FrameDecoder(object):
+
+    def __init__(self):
+        '''
+        Rebuilds the world state from the frames of a FrameEncoder. Delta frames are applied to the state of the
+        step they were made from, and skipped when the decoder does not have it, until the next keyframe.
+        '''
+        self.step = None
+        self.boids = None
+        self.motion = None
+        self.skipped = 0
+
+    def decode(self, header, payload):
+        '''
+        Decodes a frame from its header fields and compressed payload. Returns a dictionary with the step, the
+        boid, predator and obstacle positions and the boid and predator headings in radians, or None if a delta
+        frame had to be skipped.
+        '''
+        kind, step, base_step, nr_of_boids, nr_of_predators, nr_of_obstacles, width, height, length = header
+        data = zlib.decompress(payload)
+        fields, data = unpack_records(kind, data, nr_of_boids)
+        if kind == KEYFRAME:
+            motion, data = unpack_records(DELTA16, data, nr_of_boids)
+        others, data = unpack_records(KEYFRAME, data, nr_of_predators + nr_of_obstacles)
+        if kind == KEYFRAME:
+            self.boids = [field.astype(np.int64) for field in fields]
+            self.motion = [field.astype(np.int64) for field in motion]
+        elif self.boids is None or base_step != self.step or len(self.boids[0]) != nr_of_boids:
+            self.skipped += 1
+            return None
+        else:
+            moduli = get_moduli((width, height))
+            self.motion = get_wrapped([m + r for m, r in zip(self.motion, fields)], moduli)
+            self.boids = [(b + m) % modulus for b, m, modulus in zip(self.boids, self.motion, moduli)]
+        self.step = step
+        step_size = get_position_step((width, height))
+        positions = (np.stack(self.boids[:2], axis=1) + 0.5)*step_size
+        other_positions = (np.stack(others[:2], axis=1).astype(float) + 0.5)*step_size
+        return {'step': step, 'size': (width, height), 'positions': positions,
+                'headings': self.boids[2]*2*math.pi/HEADING_STEPS,
+                'predator_positions': other_positions[:nr_of_predators],
+                'predator_headings': others[2][:nr_of_predators]*2*math.pi/HEADING_STEPS,
+                'obstacle_positions': other_positions[nr_of_predators:]}
+
+
+class Client(object):
+    '''
+    A connected viewer, and the count of frames sent to and dropped for it.
+    '''
+    def __init__(self, writer):
+        self.writer = writer
+        self.task = None
+        self.needs_keyframe = True
+        self.sent = 0
+        self.dropped = 0
+        self.bytes = 0
+
+
+class StreamServer(object):
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL, max_buffer=MAX_CLIENT_BUFFER):
+        '''
+        Streams the frames of a world over TCP to any number of clients, with asyncio. Every frame is encoded once
+        and written to each client without waiting for it. When more than max_buffer bytes are still waiting to
+        be sent to a client, its frames are dropped instead, so a slow viewer never slows the simulation down.
+        Once it has caught up, it gets a keyframe, since the delta frames it missed are gone.
+        '''
+        self.encoder = FrameEncoder(keyframe_interval)
+        self.max_buffer = max_buffer
+        self.clients = []
+        self.server = None
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle_client(self, reader, writer):
+        '''
+        Keeps a client registered until it disconnects. Clients never send anything, so reading only waits for the
+        end of the connection.
+        '''
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        client = Client(writer)
+        client.task = asyncio.current_task()
+        self.clients.append(client)
+        try:
+            while await reader.read(1024):
+                pass
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients.remove(client)
+            writer.close()
+
+    def publish(self, world):
+        '''
+        Encodes the current step of the world and hands it to every client that can take it.
+        '''
+        frame = self.encoder.encode(world)
+        self.frames += 1
+        self.bytes += len(frame)
+        for client in self.clients:
+            transport = client.writer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > self.max_buffer:
+                client.dropped += 1
+                self.dropped += 1
+                client.needs_keyframe = True
+                continue
+            data = self.encoder.get_keyframe() if client.needs_keyframe else frame
+            client.needs_keyframe = False
+            client.writer.write(data)
+            client.sent += 1
+            client.bytes += len(data)
+
+    async def close(self):
+        '''
+        Closes the connections once the frames written to them are sent, or after CLOSE_TIMEOUT seconds for
+        clients that stopped reading, and stops the server.
+        '''
+        clients = list(self.clients)
+        for client in clients:
+            client.writer.close()
+        tasks = [client.task for client in clients if client.task]
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=CLOSE_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            for client in clients:
+                if client.task in pending:
+                    client.writer.transport.abort()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+async def serve(world, ticks, dt, host='', port=DEFAULT_PORT, rate=0, keyframe_interval=KEYFRAME_INTERVAL,
+                recorder=None, log=None):
+    '''
+    Steps the world ticks times with a fixed time step of dt milliseconds, and streams every step. The steps run
+    in a worker thread, so the event loop keeps accepting and serving clients while a step is computed. If rate
+    is set, at most rate steps are run per second, else as many as possible. If a recorder is given, every tick
+    is recorded too, like in headless.run. Returns the server.
+    '''
+    server = StreamServer(keyframe_interval)
+    port = await server.start(host, port)
+    if log:
+        log("Streaming on port %d" % port)
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    for tick in range(ticks):
+        await loop.run_in_executor(None, world.step, dt)
+        if recorder:
+            recorder.record(world)
+        world.stats.end_tick()
+        server.publish(world)
+        delay = start + (tick + 1)/rate - time.perf_counter() if rate else 0
+        await asyncio.sleep(max(delay, 0))
+    await server.close()
+    return server
+
+
+async def watch(host, port, frames=None, log=None):
+    '''
+    Reference client. Connects to a StreamServer and rebuilds every frame, logging the frames per second, the
+    bandwidth and the number of boids once a second. Stops after frames frames if given, or when the server is
+    done. Returns the last decoded frame.
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    decoder = FrameDecoder()
+    frame = None
+    received = 0
+    received_bytes = 0
+    last = time.perf_counter()
+    last_count = last_bytes = 0
+    try:
+        while frames is None or received < frames:
+            try:
+                header = HEADER.unpack(await reader.readexactly(HEADER.size))
+                payload = await reader.readexactly(header[-1])
+            except asyncio.IncompleteReadError:
+                break
+            decoded = decoder.decode(header, payload)
+            frame = decoded or frame
+            received += 1
+            received_bytes += HEADER.size + len(payload)
+            now = time.perf_counter()
+            if log and now - last >= 1.0 and frame:
+                log("step %d  boids: %d  frames/sec: %.1f  kB/sec: %.1f  skipped: %d"
+                    % (frame['step'], len(frame['positions']), (received - last_count)/(now - last),
+                       (received_bytes - last_bytes)/1024/(now - last), decoder.skipped))
+                last, last_count, last_bytes = now, received, received_bytes
+    finally:
+        writer.close()
+    return frame
+
+
+def measure_bandwidth(nr_of_boids=10000, ticks=100, keyframe_interval=KEYFRAME_INTERVAL, seed=1, tick_rate=30):
+    '''
+    Encodes ticks steps of a seeded flock of nr_of_boids boids, and decodes them again. Returns the mean size of
+    the keyframes and the delta frames in bytes, the bandwidth in kB per second at tick_rate steps per second,
+    scaled to 10000 boids, and the largest position error of the decoded frames, which is at most half the
+    quantization step.
+    '''
+    from world import World
+    size = int(math.sqrt(nr_of_boids*1200*600/1000*2)), int(math.sqrt(nr_of_boids*1200*600/1000/2))
+    world = World(size[0], size[1], 20, 20, 50, 100, seed=seed)
+    world.populate(nr_of_boids)
+    encoder = FrameEncoder(keyframe_interval)
+    decoder = FrameDecoder()
+    sizes = {KEYFRAME: [], DELTA8: [], DELTA16: []}
+    error = 0.0
+    for tick in range(ticks):
+        world.step(33)
+        frame = encoder.encode(world)
+        header = HEADER.unpack(frame[:HEADER.size])
+        sizes[header[0]].append(len(frame))
+        decoded = decoder.decode(header, frame[HEADER.size:])
+        diff = world.get_difference(decoded['positions'], world.flock.positions)
+        error = max(error, float(np.abs(diff).max()))
+    world.close()
+    total = sum(sum(s) for s in sizes.values())
+    return {'boids': nr_of_boids, 'keyframe_bytes': float(np.mean(sizes[KEYFRAME])),
+            'delta_bytes': float(np.mean(sizes[DELTA8] + sizes[DELTA16])) if ticks > 1 else 0.0,
+            'wide_deltas': len(sizes[DELTA16]),
+            'kB_per_second_per_10k': total/ticks*tick_rate/1024*10000/nr_of_boids,
+            'raw_kB_per_second_per_10k': 32*nr_of_boids*tick_rate/1024*10000/nr_of_boids,
+            'max_position_error': error, 'position_step': get_position_step(size)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reference viewer for a run streamed by headless.py --serve, or '
+                                                 'a measurement of the stream bandwidth.')
+    parser.add_argument('host', nargs='?', default='localhost')
+    parser.add_argument('port', nargs='?', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--frames', type=int, default=None, help='stop after this many frames')
+    parser.add_argument('--bandwidth', type=int, default=0, metavar='BOIDS',
+                        help='measure the bandwidth of a flock of this many boids instead of connecting')
+    args = parser.parse_args(argv)
+    if args.bandwidth:
+        result = measure_bandwidth(args.bandwidth)
+        print("boids: %d  keyframe: %.0f bytes  delta frame: %.0f bytes  per 10k boids at 30 ticks/sec: "
+              "%.0f kB/sec (raw float64 positions and velocities: %.0f kB/sec)  max position error: %.3f px"
+              % (result['boids'], result['keyframe_bytes'], result['delta_bytes'],
+                 result['kB_per_second_per_10k'], result['raw_kB_per_second_per_10k'],
+                 result['max_position_error']))
+        return
+    asyncio.run(watch(args.host, args.port, args.frames, log=print))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
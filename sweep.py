@@ -0,0 +1,191 @@
+import argparse, csv, itertools, multiprocessing, random, sys, time
+import numpy as np
+from world import World, BOID_SIGHT, TIME_STEP
+
+#Constants
+PARAMETERS = ('separation', 'cohesion', 'alignment', 'avoidance', 'sight', 'boids')
+METRICS = ('polarization', 'nearest_neighbor_distance', 'clusters', 'largest_cluster', 'obstacle_collisions',
+           'seconds')
+#Clusters smaller than this are counted as stray boids, not as clusters
+MIN_CLUSTER_SIZE = 3
+
+DEFAULT_VALUES = {'separation': [50], 'cohesion': [20], 'alignment': [20], 'avoidance': [100],
+                  'sight': [BOID_SIGHT], 'boids': [200]}
+
+
+def get_grid_configs(values):
+    '''
+    Every combination of the values given for each parameter. values maps each name in PARAMETERS to a list.
+    '''
+    return [dict(zip(PARAMETERS, combination)) for combination in itertools.product(*(values[p] for p in PARAMETERS))]
+
+
+def get_random_configs(values, samples, seed=None):
+    '''
+    samples configurations with each parameter drawn uniformly between the smallest and largest of its values.
+    The number of boids is drawn as an integer.
+    '''
+    rng = random.Random(seed)
+    configs = []
+    for i in range(samples):
+        config = {}
+        for p in PARAMETERS:
+            low, high = min(values[p]), max(values[p])
+            config[p] = rng.randint(int(low), int(high)) if p == 'boids' else rng.uniform(low, high)
+        configs.append(config)
+    return configs
+
+
+def get_polarization(velocities):
+    '''
+    Length of the average heading, from 0 when the boids head in all directions to 1 when they all head the same
+    way.
+    '''
+    if len(velocities) == 0:
+        return 0.0
+    norm = np.hypot(velocities[:, 0], velocities[:, 1])
+    norm[norm == 0] = 1.0
+    return float(np.hypot(*(velocities/norm[:, None]).mean(axis=0)))
+
+
+def get_nearest_neighbor_distances(world):
+    '''
+    Distance from each boid to its nearest neighbor. The world's grid is searched within the boids' sight first,
+    and the radius is doubled for the boids with no neighbor found until every boid has one.
+    '''
+    positions = world.flock.positions
+    n = len(positions)
+    nearest = np.full(n, np.inf)
+    if n < 2:
+        return nearest
+    world.grid.rebuild(positions)
+    unresolved = np.arange(n)
+    radius = float(world.flock.sights.max())
+    while len(unresolved):
+        i, j = world.grid.query_pairs(positions, unresolved, radius)
+        diff = world.get_difference(positions[i], positions[j])
+        np.minimum.at(nearest, i, np.hypot(diff[:, 0], diff[:, 1]))
+        unresolved = unresolved[np.isinf(nearest[unresolved])]
+        if radius > max(world.get_size()):
+            break
+        radius *= 2
+    return nearest
+
+
+def get_cluster_sizes(world):
+    '''
+    Splits the flock into clusters, where two boids are in the same cluster if there is a chain of boids between them
+    each inside the sight of the next. Labels are spread along the neighbor pairs until every boid in a cluster has
+    the lowest index of the cluster. Returns the size of each cluster, largest first.
+    '''
+    n = len(world.flock)
+    if n == 0:
+        return np.zeros(0, dtype=np.intp)
+    world.grid.rebuild(world.flock.positions)
+    i, j = world.grid.query_pairs(world.flock.positions, np.arange(n), world.flock.sights)
+    labels = np.arange(n)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, i, labels[j])
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    return np.sort(np.bincount(labels)[np.unique(labels)])[::-1]
+
+
+def count_obstacle_collisions(world):
+    '''
+    Number of boids overlapping an obstacle.
+    '''
+    world.update_obstacle_index()
+    if len(world.obstacle_radii) == 0 or len(world.flock) == 0:
+        return 0
+    positions = world.flock.positions
+    radii = world.flock.radii
+    i, k = world.get_close_obstacle_pairs(positions, radii + world.obstacle_radii.max())
+    distance = world.flock.distance(positions[i], world.obstacle_positions[k])
+    return int(len(np.unique(i[distance < radii[i] + world.obstacle_radii[k]])))
+
+
+def run_config(task):
+    '''
+    Runs one headless world with the weights, sight and number of boids of config, and measures the flock. Every
+    run uses the same seed, so the configurations are compared on the same starting positions and obstacles.
+    Obstacle collisions are summed over all ticks, the other metrics are taken from the last tick.
+    '''
+    config, settings = task
+    start = time.perf_counter()
+    world = World(settings['width'], settings['height'], config['cohesion'], config['alignment'],
+                  config['separation'], config['avoidance'], seed=settings['seed'])
+    world.populate(int(config['boids']), boid_sight=config['sight'])
+    for i in range(settings['obstacles']):
+        world.add_obstacle((world.random.randrange(settings['width']), world.random.randrange(settings['height'])))
+    collisions = 0
+    for i in range(settings['ticks']):
+        world.step(settings['dt'])
+        collisions += count_obstacle_collisions(world)
+    clusters = get_cluster_sizes(world)
+    row = dict(config)
+    row.update({'polarization': get_polarization(world.flock.velocities),
+                'nearest_neighbor_distance': float(np.mean(get_nearest_neighbor_distances(world))),
+                'clusters': int(np.sum(clusters >= MIN_CLUSTER_SIZE)),
+                'largest_cluster': int(clusters[0]) if len(clusters) else 0,
+                'obstacle_collisions': collisions,
+                'seconds': time.perf_counter() - start})
+    world.close()
+    return row
+
+
+def run_sweep(configs, settings, processes=None, log=None):
+    '''
+    Runs every configuration in a pool of processes, and returns one row per configuration in the same order.
+    '''
+    tasks = [(config, settings) for config in configs]
+    rows = []
+    with multiprocessing.Pool(processes) as pool:
+        for row in pool.imap(run_config, tasks):
+            rows.append(row)
+            if log:
+                log("%d/%d  %s" % (len(rows), len(tasks), "  ".join("%s: %.3g" % (k, row[k]) for k in PARAMETERS)))
+    return rows
+
+
+def write_table(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=PARAMETERS + METRICS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run headless worlds for many weight configurations in parallel, '
+                                                 'and write the flock metrics of each to a CSV table.')
+    for p in PARAMETERS:
+        parser.add_argument('--' + p, type=int if p == 'boids' else float, nargs='+', default=DEFAULT_VALUES[p],
+                            help='values of %s to sweep' % p)
+    parser.add_argument('--samples', type=int, default=0,
+                        help='draw this many random configurations between the smallest and largest values, '
+                             'instead of running every combination')
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--dt', type=float, default=TIME_STEP, help='fixed time step in milliseconds')
+    parser.add_argument('--width', type=int, default=1200)
+    parser.add_argument('--height', type=int, default=600)
+    parser.add_argument('--obstacles', type=int, default=5, help='number of randomly placed obstacles')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, default one per CPU')
+    parser.add_argument('--output', default='sweep.csv', help='CSV file to write the results to')
+    args = parser.parse_args(argv)
+    values = {p: getattr(args, p) for p in PARAMETERS}
+    if args.samples:
+        configs = get_random_configs(values, args.samples, args.seed)
+    else:
+        configs = get_grid_configs(values)
+    settings = {'ticks': args.ticks, 'dt': args.dt, 'width': args.width, 'height': args.height,
+                'obstacles': args.obstacles, 'seed': args.seed}
+    rows = run_sweep(configs, settings, args.processes, log=lambda line: print(line, file=sys.stderr))
+    write_table(rows, args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,4 @@
+import os, sys
+
+#The modules live in the root of the repository, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+import numpy as np
+from world import World
+from batch import BatchWorld
+from creature import MAX_NEIGHBORS
+
+
+def test_batch_matches_separate_worlds():
+    '''
+    Every world of a BatchWorld moves like a World of its own with the same boids, weights and obstacles. The
+    worlds are sparse enough that no boid has more than MAX_NEIGHBORS neighbors, so the random prune, which draws
+    its salt from a different generator in the two, does not come into play.
+    '''
+    rng = np.random.default_rng(1)
+    nr_of_worlds, size = 4, (400, 300)
+    weights = np.column_stack((rng.uniform(0, 50, nr_of_worlds), rng.uniform(0, 50, nr_of_worlds),
+                               rng.uniform(0, 100, nr_of_worlds), np.full(nr_of_worlds, 100.0)))
+    obstacles = [rng.uniform(0, 1, (2, 2))*size for w in range(nr_of_worlds)]
+    batch = BatchWorld(np.tile(size, (nr_of_worlds, 1)), weights, obstacles, seed=1)
+    batch.populate(15)
+    worlds = []
+    for w in range(nr_of_worlds):
+        world = World(size[0], size[1], *weights[w], seed=1)
+        rows = batch.flock.worlds == w
+        world.add_boids(batch.flock.positions[rows], batch.flock.velocities[rows])
+        for pos in obstacles[w]:
+            world.add_obstacle(pos)
+        worlds.append(world)
+    for tick in range(10):
+        batch.step(batch.time_step)
+        for world in worlds:
+            world.step(world.time_step)
+            i, j = world.flock.get_neighbor_pairs(np.arange(len(world.flock)))
+            assert np.bincount(i, minlength=len(world.flock)).max() <= MAX_NEIGHBORS
+    positions = batch.get_world_view(batch.flock.positions)
+    velocities = batch.get_world_view(batch.flock.velocities)
+    for w, world in enumerate(worlds):
+        np.testing.assert_array_equal(positions[w], world.flock.positions)
+        np.testing.assert_array_equal(velocities[w], world.flock.velocities)
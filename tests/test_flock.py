@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from world import World
+from creature import MAX_NEIGHBORS, NEAREST_NEIGHBORS
+
+
+def get_brute_force_pairs(flock, k):
+    '''
+    The k nearest boids inside the sight of every boid, from the distances of all pairs, with ties broken by id.
+    Sorted by boid, distance and id like Flock.get_nearest_pairs.
+    '''
+    n = len(flock)
+    i = np.repeat(np.arange(n), n)
+    j = np.tile(np.arange(n), n)
+    keys = flock.get_distance_keys(i, j)
+    inside = (i != j) & (keys < flock.sights[i]**2)
+    i, j, keys = i[inside], j[inside], keys[inside]
+    order = np.lexsort((flock.ids[j], keys, i))
+    i, j = i[order], j[order]
+    starts = np.searchsorted(i, np.arange(n))
+    rank = np.arange(len(i)) - starts[i]
+    return i[rank < k], j[rank < k]
+
+
+@pytest.mark.parametrize('size', [(300, 200), (2400, 1200)])
+def test_nearest_neighbors_match_brute_force(size):
+    '''
+    Both ways of finding the nearest neighbors, the rings in a dense flock and the sorted grid query in a sparse
+    one, find the same pairs as a brute force search. populate places the boids on integer positions, so there
+    are many ties before the first step.
+    '''
+    world = World(size[0], size[1], 20, 20, 50, 10, seed=1, neighbor_mode=NEAREST_NEIGHBORS)
+    world.populate(1500)
+    flock = world.flock
+    for tick in range(3):
+        world.grid.rebuild(flock.positions)
+        i, j = flock.get_nearest_pairs(np.arange(len(flock)), MAX_NEIGHBORS)
+        expected_i, expected_j = get_brute_force_pairs(flock, MAX_NEIGHBORS)
+        np.testing.assert_array_equal(i, expected_i)
+        np.testing.assert_array_equal(j, expected_j)
+        world.step(world.time_step)
@@ -0,0 +1,33 @@
+import pytest
+from world import World
+from creature import NEIGHBOR_MODES
+
+
+def get_checksum(ticks=5, **options):
+    '''
+    The checksum of a seeded world with the flocking weights set, after ticks steps.
+    '''
+    world = World(1200, 600, 20, 20, 50, 10, seed=1, **options)
+    try:
+        world.populate(1000)
+        for tick in range(ticks):
+            world.step(world.time_step)
+        return world.get_checksum()
+    finally:
+        world.close()
+
+
+@pytest.mark.parametrize('neighbor_mode', NEIGHBOR_MODES)
+def test_workers_match_serial(neighbor_mode):
+    '''
+    The worker processes split the flock into tiles, which must give the same run as the serial flock.
+    '''
+    assert get_checksum(workers=2, neighbor_mode=neighbor_mode) == get_checksum(neighbor_mode=neighbor_mode)
+
+
+@pytest.mark.parametrize('neighbor_mode', NEIGHBOR_MODES)
+def test_threads_match_serial(neighbor_mode):
+    '''
+    The thread pool calculates the same tiles as the worker processes, and must also give the serial run.
+    '''
+    assert get_checksum(threads=3, neighbor_mode=neighbor_mode) == get_checksum(neighbor_mode=neighbor_mode)
@@ -0,0 +1,32 @@
+import numpy as np
+from world import World
+from recording import Recorder, Replay, get_frame
+
+
+def test_replay_matches_recorded_frames(tmp_path):
+    '''
+    Every frame read back from a recording equals the state of the world when it was recorded, across chunk
+    boundaries and while the number of creatures changes.
+    '''
+    world = World(600, 400, 20, 20, 50, 10, seed=1)
+    world.populate(100)
+    world.add_obstacle((300, 200))
+    path = str(tmp_path/'recording')
+    recorder = Recorder(path, world, chunk_frames=4)
+    expected = []
+    for tick in range(10):
+        world.step(world.time_step)
+        if tick == 6:
+            world.add_predator((100, 100))
+        recorder.record(world)
+        expected.append((world.steps, get_frame(world)))
+    recorder.close()
+
+    replay = Replay(path)
+    assert len(replay) == len(expected)
+    assert replay.size == (600.0, 400.0)
+    for frame, (step, columns) in enumerate(expected):
+        assert replay.get_step(frame) == step
+        for recorded, replayed in zip(columns, replay.get_frame(frame)):
+            np.testing.assert_array_equal(replayed, recorded)
+    np.testing.assert_array_equal(replay.get_frame(-1)[0], expected[-1][1][0])
@@ -0,0 +1,37 @@
+import pytest
+from world import World
+from creature import RANDOM_NEIGHBORS, NEAREST_NEIGHBORS
+
+
+def create_world(**options):
+    '''
+    A seeded world with flocking weights, obstacles and predators, stepped a few times.
+    '''
+    world = World(1200, 600, 20, 20, 50, 10, seed=1, **options)
+    world.populate(500)
+    for k in range(5):
+        world.add_obstacle((world.random.randrange(1200), world.random.randrange(600)))
+    for k in range(2):
+        world.add_predator((world.random.randrange(1200), world.random.randrange(600)))
+    for tick in range(5):
+        world.step(world.time_step)
+    return world
+
+
+@pytest.mark.parametrize('options', [{'neighbor_mode': RANDOM_NEIGHBORS},
+                                     {'neighbor_mode': NEAREST_NEIGHBORS, 'aggregate_theta': 0.5}])
+def test_snapshot_round_trip(tmp_path, options):
+    '''
+    A world loaded from a snapshot has the same state, and continues exactly like the saved world.
+    '''
+    world = create_world(**options)
+    path = str(tmp_path/'snapshot.npz')
+    world.save(path)
+    loaded = World.load(path)
+    assert loaded.get_checksum() == world.get_checksum()
+    assert loaded.steps == world.steps
+    assert len(loaded.obstacles) == len(world.obstacles)
+    for tick in range(5):
+        world.step(world.time_step)
+        loaded.step(loaded.time_step)
+    assert loaded.get_checksum() == world.get_checksum()
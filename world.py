@@ -1,59 +1,112 @@
-import pygame, random
+import pygame, random, hashlib, json, time
 import numpy as np
-from creature import Boid, Obstacle, Predator
-import math
+from creature import Boid, Obstacle, Predator, RANDOM_NEIGHBORS, NEIGHBOR_MODES, MAX_BOID_VELOCITY
+from flock import Flock
+from parallel import ParallelFlock, ThreadedFlock
+from spatial import create_spatial_hash, NeighborList
+from instrumentation import NULL_STATS
 
 #Constants
 OBSTACLE_RADIUS = 30
 PREDATOR_RADIUS = 10.0
 BOID_RADIUS = 8.0
 
-GRID_WIDTH = 10
+GRID_CELL_SIZE = 80.0
 
 BOID_SIGHT = 80.0
 PREDATOR_SIGHT = 100.0
 
+#Version of the file format written by World.save
+SNAPSHOT_VERSION = 1
+
+#Fixed simulation time step in milliseconds, and the most steps run to catch up in one frame
+TIME_STEP = 33.0
+MAX_STEPS_PER_FRAME = 5
+
 
 class World(object):
 
-    def __init__(self, screen, coh, align, sep, avoid):
+    def __init__(self, width, height, coh=0, align=0, sep=0, avoid=10, workers=0, seed=None,
+                 time_step=TIME_STEP, neighbor_skin=0, neighbor_mode=RANDOM_NEIGHBORS, threads=0,
+                 aggregate_theta=None):
         '''
         The world of all objects has some properties, like dimension
         and weights for separation alignment and cohesion. Boids
         will use these variables to calculate their new positions.
         All boids use the same weights. Logically the World class contain methods Creatures will use
         when interacting with the world. Getting neighboring Boids, Predators, obstacles etc.
-        '''
-        self.screen = screen
-        width, height = self.get_size()
-        self.grid =Grid(width, height)
-        self.separation = sep
-        self.separation.value = 0
-        self.alignment = align
-        self.alignment.value = 0
-        self.cohesion = coh
-        self.cohesion.value = 0
-        self.avoid = avoid
-        self.avoid.value = 10
-        self.all_things = pygame.sprite.Group()
-        self.boids = pygame.sprite.Group()
+        The world does not depend on a display. Weights are plain numbers on the same scale as the sliders, and
+        can be changed at any time with set_weights. If workers is set, the flock is updated by a pool of that many
+        worker processes, and close should be called when the world is no longer used. If threads is set instead,
+        the forces are calculated by a pool of that many threads in this process, which avoids copying the flock
+        into shared memory every tick. Whether either is faster than the serial flock depends on the machine, see
+        parallel.benchmark_scaling.
+        Everything random in the world, from the starting positions to the neighbor prune, is drawn from the world's
+        own generators seeded by seed, so two worlds with the same seed and the same inputs give the same run.
+        If neighbor_skin is set, the flock keeps a neighbor list of every boid's candidates within sight plus the
+        skin, and only queries the grid again when some boid has moved more than half the skin. It pays off with
+        short time steps, where boids move well under half the skin per step, like a skin of 10 to 20 with 8 ms
+        steps. At the default time step the list is rebuilt every few steps and costs about as much as the grid.
+        The list gives the pairs in another order, so with aggregate_theta set the sums over them can differ from
+        the grid's in the last bits.
+        The worker processes and threads of a parallel flock do not use it. neighbor_mode decides which
+        MAX_NEIGHBORS neighbors a creature with a larger neighborhood follows, see set_neighbor_mode. If aggregate_theta is set, cohesion and
+        alignment are taken over everything in sight, see set_aggregate_theta.
+        '''
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.rng = np.random.default_rng(seed)
+        self.time_step = time_step
+        self.accumulator = 0.0
+        self.steps = 0
+        self.grid = create_spatial_hash(width, height, GRID_CELL_SIZE)
+        self.set_weights(coh, align, sep, avoid)
+        self.all_things = pygame.sprite.RenderUpdates()
         self.predators = pygame.sprite.Group()
         self.obstacles = pygame.sprite.Group()
+        if workers:
+            self.flock = ParallelFlock(self, workers)
+        elif threads:
+            self.flock = ThreadedFlock(self, threads)
+        else:
+            self.flock = Flock(self)
+        self.neighbor_skin = neighbor_skin
+        if neighbor_skin:
+            self.flock.neighbor_list = NeighborList(self.grid, neighbor_skin)
+        self.set_neighbor_mode(neighbor_mode)
+        self.set_aggregate_theta(aggregate_theta)
+        self.boid_list = []
+        self.obstacle_grid = create_spatial_hash(width, height, GRID_CELL_SIZE)
+        self.obstacles_changed = True
+        self.predator_grid = create_spatial_hash(width, height, GRID_CELL_SIZE)
+        self.update_predator_index()
+        self.set_stats(NULL_STATS)
 
     def populate(self, nr_of_boids, boid_radius = BOID_RADIUS, boid_sight = BOID_SIGHT):
         '''
-        Will populate the 2D world with nr_of_boids boids with random position and velocity. These boids are also
-        added to the grid, the efficient bookkeeping structure used to retrieve neighborhoods.
+        Will populate the 2D world with nr_of_boids boids with random position and velocity. The positions and
+        velocities are drawn all at once from the world's generator.
         '''
         width, height = self.get_size()
-        for i in range(nr_of_boids):
-            x = random.randrange(width)
-            y = random.randrange(height)
-            v = np.array([random.uniform(-15, 15), random.uniform(-15, 15)])
-            boid = Boid(self, y, x, boid_radius, v, boid_sight)
-            self.grid.add_element(y,x, boid)
-            self.boids.add(boid)
-            self.all_things.add(boid)
+        corners = np.stack((self.rng.integers(0, width, nr_of_boids),
+                            self.rng.integers(0, height, nr_of_boids)), axis=1).astype(float)
+        velocities = self.rng.uniform(-15, 15, (nr_of_boids, 2))
+        self.add_boids(corners + boid_radius, velocities, boid_radius, boid_sight)
+
+    def add_boids(self, positions, velocities, radius=BOID_RADIUS, sight=BOID_SIGHT):
+        '''
+        Adds a batch of boids with the given center positions and velocities. The state of the boids is added to the
+        flock arrays in one batch, and each boid get the index of its row. radius and sight can be one value for
+        all boids or one per boid. Positions outside the world are wrapped around, like they are when boids move,
+        since the grid queries assume wrapped positions. The grid, the efficient bookkeeping structure used to
+        retrieve neighborhoods, is rebuilt with the new boids.
+        '''
+        positions = np.mod(np.asarray(positions, dtype=float).reshape(-1, 2), np.array(self.get_size(), dtype=float))
+        indices = self.flock.add_boids(positions, velocities, radius, sight)
+        self.boid_list.extend(Boid.create_views(self, indices))
+        self.grid.rebuild(self.flock.positions)
 
     def add_obstacle(self, pos):
         '''
@@ -63,6 +116,7 @@ class World(object):
         obstacle = Obstacle(self, pos[1]-OBSTACLE_RADIUS, pos[0]-OBSTACLE_RADIUS, OBSTACLE_RADIUS)
         self.all_things.add(obstacle)
         self.obstacles.add(obstacle)
+        self.obstacles_changed = True
 
     def remove_obstacle(self, pos):
         '''
@@ -71,8 +125,9 @@ class World(object):
         '''
         for obstacle in self.obstacles:
             if obstacle.rect.collidepoint(pos):
-                obstacle.image.fill((0,0,0))
+                self.all_things.remove(obstacle)
                 self.obstacles.remove(obstacle)
+                self.obstacles_changed = True
                 break #If obstacles is overlapping only one is removed.
 
     def add_predator(self, pos):
@@ -80,155 +135,346 @@ class World(object):
         Adds a predator to the 2D world. The predators starting position is decided by the method parameter pos.
         The predator has a fixed radius, and field of view (radius), and a random starting velocity.
         '''
-        v = np.array([random.uniform(-15, 15), random.uniform(-15, 15)])
+        v = np.array([self.random.uniform(-15, 15), self.random.uniform(-15, 15)])
         predator = Predator(self, pos[1], pos[0], PREDATOR_RADIUS, v, PREDATOR_SIGHT)
         self.all_things.add(predator)
         self.predators.add(predator)
+        self.update_predator_index()
 
     def remove_all_predators(self):
         for pred in self.predators:
             self.all_things.remove(pred)
-            pred.image.fill((0,0,0))
         self.predators = pygame.sprite.Group()
+        self.update_predator_index()
 
-    def get_cohesion_weight(self):
+    def set_neighbor_mode(self, mode):
         '''
-        Retrieve cohesion weight from slider
+        RANDOM_NEIGHBORS makes crowded creatures follow a random sample of their neighbors, NEAREST_NEIGHBORS makes
+        them follow their nearest neighbors, which does not depend on the seed. In a dense flock the nearest
+        neighbors are also cheaper to find, since most of the search is skipped. In a sparse flock, where a boid
+        has few more neighbors than MAX_NEIGHBORS, they cost somewhat more than the random sample.
         '''
-        return self.cohesion.value/100
+        if mode not in NEIGHBOR_MODES:
+            raise ValueError("unknown neighbor mode %r, expected one of %s" % (mode, ", ".join(NEIGHBOR_MODES)))
+        self.neighbor_mode = mode
+        self.flock.neighbor_mode = mode
 
-    def get_alignment_weight(self):
+    def set_aggregate_theta(self, theta):
+        '''
+        None makes boids and predators use their pruned neighborhood for cohesion and alignment. A number makes them
+        use the mean position and velocity of every boid in sight instead. The boids sum their pairs in sight
+        exactly, which costs less than any approximation. The few long sighted predators sum them Barnes-Hut style
+        from a pyramid of cell aggregates. theta is their accuracy threshold, the width of the largest cell taken
+        whole at the edge of the sight radius, as a fraction of the radius. 0 gives the exact means, larger values
+        are faster and less accurate.
+        '''
+        if theta is not None and not theta >= 0:
+            raise ValueError("aggregate theta must be None or at least 0, got %r" % (theta,))
+        self.aggregate_theta = theta
+        self.flock.aggregate_theta = theta
+
+    def set_scheduler(self, scheduler):
         '''
-        Retrieve alignment weight from slider
+        Set the UpdateScheduler deciding which boids get a new velocity each tick, or None to update every boid
+        every tick. The steps report their time to the scheduler. The worker processes and threads of a parallel
+        flock only calculate the forces when the whole flock is updated, a share of it is calculated in this thread.
         '''
-        #print(self.cohesion.value)
-        return self.alignment.value/100
+        self.flock.scheduler = scheduler
 
-    def get_separation_weight(self):
+    def set_stats(self, stats):
         '''
-        Retrieve separation weight from slider
+        Set the object collecting timings and counters for each phase of a tick, a TickStats. Use NULL_STATS to
+        disable the instrumentation.
         '''
-        #print(self.cohesion.value)
-        return self.separation.value/100
-        return self.separation.value/100
+        self.stats = stats
+        self.grid.stats = stats
+        if self.flock.neighbor_list:
+            self.flock.neighbor_list.stats = stats
 
-    def get_avoidance_weight(self):
-        return self.avoid.value/100
+    def close(self):
+        '''
+        Frees the resources held by the flock, like the worker processes or threads of a parallel flock.
+        '''
+        self.flock.close()
 
-    def get_size(self):
+    def update_obstacle_index(self):
+        '''
+        Obstacles never move, so the obstacle grid is only rebuilt when an obstacle has been added or removed since
+        the last time it was built.
+        '''
+        if not self.obstacles_changed:
+            return
+        self.obstacle_list = self.obstacles.sprites()
+        self.obstacle_positions = np.array([o.pos for o in self.obstacle_list], dtype=float).reshape(-1, 2)
+        self.obstacle_radii = np.array([float(o.radius) for o in self.obstacle_list])
+        self.obstacle_grid.rebuild(self.obstacle_positions)
+        self.obstacles_changed = False
+
+    def update_predator_index(self):
         '''
-        Neccesary for updating position of all moving objects, since the world
-        wraps around.
+        Predators move every tick, so the predator grid is rebuilt once per tick from their current positions.
         '''
-        return self.screen.get_size()
+        self.predator_list = self.predators.sprites()
+        self.predator_positions = np.array([p.pos for p in self.predator_list], dtype=float).reshape(-1, 2)
+        self.predator_grid.rebuild(self.predator_positions)
 
-    def get_close_neighbors(self, creature, remove_self):
+    def update_velocities(self):
+        '''
+        Updates the velocity of every creature. The grids are rebuilt from the current positions first. The boids
+        are then updated all at once by the flock, while the predators use their own update_velocity method.
+        '''
+        with self.stats.phase('grid'):
+            self.grid.rebuild(self.flock.positions)
+            self.update_obstacle_index()
+            self.update_predator_index()
+        self.flock.update_velocities()
+        with self.stats.phase('predators'):
+            for predator, aggregate in zip(self.predator_list, self.get_predator_aggregates()):
+                predator.update_velocity(aggregate)
+
+    def step(self, time_passed):
+        '''
+        Advances the simulation by time_passed, without drawing anything. New velocities are calculated first,
+        then the flock and the predators are moved. If the flock has a scheduler, it is told the time of the step.
+        '''
+        start = time.perf_counter()
+        self.update_velocities()
+        with self.stats.phase('integrate'):
+            self.flock.integrate(time_passed)
+            for predator in self.predators:
+                predator.move(time_passed)
+        self.steps += 1
+        if self.flock.scheduler:
+            self.flock.scheduler.end_tick(time.perf_counter() - start)
+
+    def advance(self, time_passed, max_steps=MAX_STEPS_PER_FRAME):
+        '''
+        Advances the simulation by the wall clock time_passed, in fixed steps of time_step. The time left over is
+        kept for the next call, and get_interpolation tells how far the display is between the last two steps.
+        When the display falls behind, several steps are run back to back, but never more than max_steps. Time
+        beyond that is dropped, so a long hitch slows the simulation down instead of freezing it. Returns the number
+        of steps run.
+        '''
+        self.accumulator = min(self.accumulator + time_passed, max_steps*self.time_step)
+        steps = 0
+        while self.accumulator >= self.time_step:
+            self.step(self.time_step)
+            self.accumulator -= self.time_step
+            steps += 1
+        return steps
+
+    def get_interpolation(self):
         '''
-        Returns all neighboring boids close to the creature. The neighborhood
-        will determine the next position of the creature
+        How far the time left over by advance is into the next step, from 0 to 1.
         '''
-        neighborhood = []
-        #for b in self.boids:
-        #    d = (b.rect.centerx-creature.rect.centerx)**2 + (b.rect.centery - creature.rect.centery)**2
-        #    if d < creature.sight**2:
-        #        neighborhood.append(b)
-        neighborhood = self.grid.get_all_elements(creature.pos[1], creature.pos[0], creature.sight)
-        if remove_self:
-            neighborhood.remove(creature)
-        return neighborhood
+        return self.accumulator/self.time_step
 
-    def get_close_predators(self, creature):
+    def update_sprites(self, alpha=1.0, visible=None):
         '''
-        The world return all predators detected by the creature's line of sight.
-        If a predator is close by, the flight path of creature will be influenced
+        Moves the boids and the predators to their positions interpolated alpha of the way from the previous step to
+        the current one, and redraws the predators whose heading has changed. Returns the sprites to draw, the
+        obstacles and predators. Boids are drawn from the flock's render_positions instead, see Camera. If visible
+        is given, the indices of the boids on screen from get_visible_boids, only those boids are moved, so drawing
+        a view costs the same no matter how many boids are outside it.
+        '''
+        self.flock.interpolate(alpha, visible)
+        self.all_things.update(alpha)
+        return self.all_things.sprites()
+
+    def get_predator_aggregates(self):
+        '''
+        One (count, offset sum, velocity sum) aggregate of the boids in sight of each predator in predator_list,
+        from the flock's aggregates, or None for each when aggregate_theta is not set. All the predators are
+        queried in one batch.
+        '''
+        if self.aggregate_theta is None or len(self.flock) == 0 or not self.predator_list:
+            return [None]*len(self.predator_list)
+        sights = [predator.sight for predator in self.predator_list]
+        return list(zip(*self.flock.get_aggregate_sums(self.predator_positions, sights)))
+
+    def get_visible_boids(self, view):
+        '''
+        Indices of the boids that can be seen in view, an (x, y, width, height) rectangle of the world, found with
+        the grid. The grid holds the positions from the start of the last step, so the rectangle is widened by the
+        distance a boid can move in a step and by the boid radius.
         '''
-        close_predators = []
+        if len(self.flock) == 0:
+            return np.zeros(0, dtype=np.intp)
+        x, y, width, height = view
+        margin = MAX_BOID_VELOCITY*self.time_step + self.flock.radii.max()
+        return self.grid.query_rect(x - margin, y - margin, width + 2*margin, height + 2*margin)
+
+    def save(self, path):
+        '''
+        Saves the complete state of the world to one .npz file: the flock arrays, the predators, the obstacles,
+        the weights, the time stepping and the state of the random generators. A world loaded from the file
+        continues exactly like this one would. The grids are not stored, they are rebuilt from the positions.
+        '''
+        predators = self.predators.sprites()
+        obstacles = self.obstacles.sprites()
+        flock = self.flock
+        state = {'version': SNAPSHOT_VERSION, 'size': [self.width, self.height], 'seed': self.seed,
+                 'weights': [self.cohesion, self.alignment, self.separation, self.avoid],
+                 'time_step': self.time_step, 'accumulator': self.accumulator, 'steps': self.steps,
+                 'neighbor_mode': self.neighbor_mode, 'aggregate_theta': self.aggregate_theta,
+                 'neighbor_skin': self.neighbor_skin,
+                 'salt': flock.salt, 'random': self.random.getstate(), 'rng': self.rng.bit_generator.state}
+        np.savez(path, state=np.array(json.dumps(state)),
+                 positions=flock.positions, previous_positions=flock.previous_positions,
+                 velocities=flock.velocities, prev_velocities=flock.prev_velocities,
+                 radii=flock.radii, sights=flock.sights, ids=flock.ids,
+                 predator_positions=np.array([p.pos for p in predators], dtype=float).reshape(-1, 2),
+                 predator_previous_positions=np.array([p.previous_pos for p in predators], dtype=float).reshape(-1, 2),
+                 predator_velocities=np.array([p.velocity for p in predators], dtype=float).reshape(-1, 2),
+                 predator_prev_velocities=np.array([p.prev_velocity for p in predators], dtype=float).reshape(-1, 2),
+                 predator_radii=np.array([p.radius for p in predators], dtype=float),
+                 predator_sights=np.array([p.sight for p in predators], dtype=float),
+                 obstacle_positions=np.array([o.pos for o in obstacles], dtype=float).reshape(-1, 2),
+                 obstacle_radii=np.array([o.radius for o in obstacles], dtype=int))
+
+    @staticmethod
+    def load(path, workers=0, threads=0, neighbor_skin=None):
+        '''
+        Creates a world from a file written by World.save. The boids are added in one batch, like in populate. The
+        neighbor list skin of the saved world is used, unless neighbor_skin is given.
+        '''
+        with np.load(path) as data:
+            state = json.loads(str(data['state']))
+            if state['version'] != SNAPSHOT_VERSION:
+                raise ValueError("unsupported snapshot version %s" % state['version'])
+            world = World(state['size'][0], state['size'][1], *state['weights'], workers=workers,
+                          threads=threads, seed=state['seed'], time_step=state['time_step'],
+                          neighbor_skin=state.get('neighbor_skin', 0) if neighbor_skin is None else neighbor_skin,
+                          neighbor_mode=state.get('neighbor_mode', RANDOM_NEIGHBORS),
+                          aggregate_theta=state.get('aggregate_theta'))
+            world.add_boids(data['positions'], data['velocities'], data['radii'], data['sights'])
+            flock = world.flock
+            flock.previous_positions = data['previous_positions'].copy()
+            flock.render_positions = flock.positions.copy()
+            flock.prev_velocities = data['prev_velocities'].copy()
+            flock.ids = data['ids'].copy()
+            flock.salt = state['salt']
+            for k in range(len(data['predator_positions'])):
+                radius = float(data['predator_radii'][k])
+                pos = data['predator_positions'][k]
+                predator = Predator(world, pos[1] - radius, pos[0] - radius, radius,
+                                    data['predator_velocities'][k].copy(), float(data['predator_sights'][k]))
+                predator.pos = pos.copy()
+                predator.previous_pos = data['predator_previous_positions'][k].copy()
+                predator.prev_velocity = data['predator_prev_velocities'][k].copy()
+                world.all_things.add(predator)
+                world.predators.add(predator)
+            for pos, radius in zip(data['obstacle_positions'], data['obstacle_radii']):
+                obstacle = Obstacle(world, pos[1] - radius, pos[0] - radius, int(radius))
+                world.all_things.add(obstacle)
+                world.obstacles.add(obstacle)
+        world.update_predator_index()
+        world.accumulator = state['accumulator']
+        world.steps = state['steps']
+        version, internal, gauss_next = state['random']
+        world.random.setstate((version, tuple(internal), gauss_next))
+        world.rng.bit_generator.state = state['rng']
+        return world
+
+    def get_checksum(self):
+        '''
+        A hash of the state of every creature. Two runs with the same seed and inputs have the same checksum after
+        the same number of steps, so runs can be compared without storing them.
+        '''
+        h = hashlib.sha1()
+        for array in (self.flock.positions, self.flock.velocities):
+            h.update(np.ascontiguousarray(array).tobytes())
         for predator in self.predators:
-            distance = np.linalg.norm(predator.pos-creature.pos)
-            if distance < creature.sight:
-                close_predators.append(predator)
-        return close_predators
+            h.update(np.asarray(predator.pos, dtype=float).tobytes())
+            h.update(np.asarray(predator.velocity, dtype=float).tobytes())
+        return h.hexdigest()
 
-    def get_close_obstacles(self, creature):
+    def set_weights(self, coh, align, sep, avoid):
         '''
-        All close obstacles to the creature is returned. Close obstacles are defined as objects within the creatures
-        line of sight, or radius of sight.
+        Set the weights used by the flocking rules. The values use the same scale as the sliders, and are divided by
+        100 when retrieved.
         '''
-        neighborhood = []
-        for b in self.obstacles:
-            d = (b.rect.centerx-creature.rect.centerx)**2 + (b.rect.centery - creature.rect.centery)**2
-            if d < creature.sight**2:
-                neighborhood.append(b)
-        return neighborhood
+        self.cohesion = coh
+        self.alignment = align
+        self.separation = sep
+        self.avoid = avoid
 
-    def set_new_element_position(self, old_pos, new_pos, element):
+    def get_cohesion_weight(self):
         '''
-        Updates the grid position of an element. The grid class is utilized for boids, to speed up the get_close_neigbors
-        method. This require each boid to announce its new position to the world. This announcement is then relayed to the
-        grid.
+        Retrieve cohesion weight
         '''
-        self.grid.move_element(old_pos[1], old_pos[0], new_pos[1], new_pos[0], element)
+        return self.cohesion/100
 
+    def get_alignment_weight(self):
+        '''
+        Retrieve alignment weight
+        '''
+        return self.alignment/100
 
+    def get_separation_weight(self):
+        '''
+        Retrieve separation weight
+        '''
+        return self.separation/100
 
+    def get_avoidance_weight(self):
+        return self.avoid/100
 
-class Grid(object):
+    def get_size(self):
+        '''
+        Neccesary for updating position of all moving objects, since the world
+        wraps around.
+        '''
+        return self.width, self.height
 
-    def __init__(self, width, height, square_dim=40):
+    def get_close_neighbors(self, creature, remove_self):
         '''
-        The Grid class is a structure to more efficiently retrieve local neighborhoods. The 2D world is split into
-        a coarse grid, and each element is assigned to a cell in this grid.
+        Returns all neighboring boids close to the creature. The neighborhood
+        will determine the next position of the creature
         '''
-        self.grid = []
-        self.square_dim = square_dim
-        self.nr_of_rows = (int)(height/square_dim)
-        self.nr_of_cols = (int)(width/square_dim)
-        for i in range(self.nr_of_rows):
-            row = []
-            for j in range(self.nr_of_cols):
-                row.append({})
-            self.grid.append(row)
+        indices = self.grid.query_radius(creature.pos, creature.sight)
+        neighborhood = [self.boid_list[i] for i in indices]
+        if remove_self:
+            neighborhood.remove(creature)
+        return neighborhood
 
-    def add_element(self, y, x, element):
+    def get_difference(self, a, b):
         '''
-        Add elements adds element to the grid. The grid coordinates are calculated and the element put into this
-        cell or bucket.
+        Returns the vector from position b to position a. Since the world wraps around, the shortest way across the
+        edges is used.
         '''
-        grid_y = (int)(y/self.square_dim)
-        grid_x = (int)(x/self.square_dim)
-        self.grid[grid_y][grid_x][element.thing_id] = element
+        return self.grid.difference(a, b)
 
-    def remove_element(self, y, x, element):
+    def get_close_predators(self, creature):
         '''
-        When a element is moved for example, the element has to be removed from the previous bucket or cell. This method
-        calculate the coarse grid coordinates and remove the element from the cell.
+        The world return all predators detected by the creature's line of sight.
+        If a predator is close by, the flight path of creature will be influenced
         '''
-        grid_y = (int)(y/self.square_dim)
-        grid_x = (int)(x/self.square_dim)
-        self.grid[grid_y][grid_x][element.thing_id] = None
-        del  self.grid[grid_y][grid_x][element.thing_id]
+        indices = self.predator_grid.query_radius(creature.pos, creature.sight)
+        return [self.predator_list[i] for i in indices if self.predator_list[i] is not creature]
 
-    def move_element(self, oy, ox, ny, nx, element):
+    def get_close_obstacles(self, creature):
         '''
-        Composed of remove and add element method.
+        All close obstacles to the creature is returned. Close obstacles are defined as objects within the creatures
+        line of sight, or radius of sight, including the ones only partly inside it.
         '''
-        self.remove_element(oy, ox, element)
-        self.add_element(ny, nx, element)
+        self.update_obstacle_index()
+        if not self.obstacle_list:
+            return []
+        indices = self.obstacle_grid.query_radius(creature.pos, creature.sight + self.obstacle_radii.max())
+        return [self.obstacle_list[i] for i in indices]
 
-    def get_all_elements(self, y,x, radius):
+    def get_close_predator_pairs(self, positions, sights):
         '''
-        Retrives all elements inside a radius. Perfect for neighborhood. A small area of the grid defined by the radius
-        is explored. Each bucket or cell in this area is then added to element list if it's inside the search radius.
+        Batched version of get_close_predators. Returns (i, j) index pairs, one for each predator j inside the sight
+        radius of position i. j is an index into predator_list and predator_positions.
         '''
-        grid_y = (int)(y/self.square_dim)
-        grid_x = (int)(x/self.square_dim)
-        r = math.ceil(radius/self.square_dim)
-        elements = []
-        for i in range(-r, r):
-            for j in range(-r, r):
-                tx = (grid_x + j)
-                ty = grid_y + i
-                if ty >= 0 and ty < self.nr_of_rows and tx >= 0 and tx < self.nr_of_cols and r**2 >= i**2 + j**2:
-                    elements.extend(self.grid[ty][tx].values())
-        return elements
+        return self.predator_grid.query_points(positions, sights)
 
+    def get_close_obstacle_pairs(self, positions, sights):
+        '''
+        Batched version of get_close_obstacles. Returns (i, j) index pairs, one for each obstacle j inside the sight
+        radius of position i. j is an index into obstacle_list, obstacle_positions and obstacle_radii.
+        '''
+        self.update_obstacle_index()
+        return self.obstacle_grid.query_points(positions, sights)